@@ -1,18 +1,76 @@
 # app.py - 主應用入口，處理 Flask 路由和啟動應用
 from flask import Flask, request, jsonify, render_template, send_from_directory
-from models import init_db, db, SensorData
-from line_bot import handle_line_bot
-from apscheduler.schedulers.background import BackgroundScheduler
+from models import init_db, db
+from line_bot import handle_event, parse_events, push_texts, verify_signature
+from event_dispatcher import EventDispatcher
+from sensor_buffer import SensorBuffer, parse_readings
+from table_renderer import table_renderer
+from shelf_life import shelf_life_index
+from reminders import expiry_reminders, REMINDER_INTERVAL
+from sensor_monitor import sensor_monitor
+from sensor_history import (get_history, max_span, prune_sensor_data, parse_time, verify_device_token,
+                            SENSOR_RETENTION_INTERVAL, SENSOR_HISTORY_MAX_HOURS)
+from sensor_chart import sensor_chart, CHART_DAYS
+from metrics import registry, webhook_requests, profiler, PROFILER_TOKEN
+from geminiAI import chat_cache
+from image_pipeline import image_cache, image_stats
+from sensor_buffer import latest_readings
+from users import user_cache
+from places import places_cache
+from storage import DATABASE_URL, engine_options
+from lazy import lazy, LAZY_PRELOAD
+import atexit
 import os
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
 
 load_dotenv()
 
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///database.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(DATABASE_URL)  # 連線池大小；SQLite 另外在連線時設定 WAL 與忙碌等待
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 db.init_app(app)
 
+# 感應器讀數先進緩衝區，再由背景執行緒批次寫入，異常時通知使用者
+sensor_monitor.notify = push_texts
+sensor_buffer = SensorBuffer(app)
+atexit.register(sensor_buffer.close)
+
+# LINE 事件交給背景 worker 處理，webhook 驗證簽章後立即回應
+event_dispatcher = EventDispatcher(app, handle_event)
+atexit.register(event_dispatcher.close)
+
+# 龐大的套件預設在第一次使用時才載入；LAZY_PRELOAD 列出的項目在背景先載入，matplotlib 另外預先載入字型
+if LAZY_PRELOAD:
+    lazy.preload(LAZY_PRELOAD)
+    if 'matplotlib' in LAZY_PRELOAD:
+        table_renderer.warm_up()
+
+# 抓取 /metrics 時才讀取的佇列長度與快取統計
+registry.gauge('fridge_queue_depth', '背景佇列中等待處理的項目數', lambda: {
+    ('webhook_events',): event_dispatcher.depth(),
+    ('sensor_readings',): sensor_buffer.pending(),
+    ('expiry_reminders',): expiry_reminders.pending(),
+}, ['queue'])
+CACHES = {'chat': chat_cache, 'image': image_cache, 'latest_reading': latest_readings, 'user': user_cache}
+registry.gauge('fridge_cache_hits', '快取命中次數', lambda: {
+    (name,): cache.stats()['hits'] for name, cache in CACHES.items()}, ['cache'])
+registry.gauge('fridge_cache_misses', '快取未命中次數', lambda: {
+    (name,): cache.stats()['misses'] for name, cache in CACHES.items()}, ['cache'])
+registry.gauge('fridge_image_bytes', '送去辨識的圖片處理前（in）與處理後（out）的總位元組數', lambda: {
+    ('in',): image_stats.summary()['bytes_in'], ('out',): image_stats.summary()['bytes_out']}, ['stage'])
+registry.gauge('fridge_images', '處理過的圖片數：prepared 縮圖重新壓縮，rejected 像素數超過上限', lambda: {
+    ('prepared',): image_stats.summary()['count'], ('rejected',): image_stats.summary()['rejected']}, ['result'])
+registry.gauge('fridge_places_saved_calls', 'geohash 快取省下的 Places API 呼叫數',
+               lambda: places_cache.stats()['saved_calls'])
+registry.gauge('fridge_sensor_readings_lost', '沒有寫入資料庫的感應器讀數：rejected 違反資料庫限制，dropped 暫存超過上限', lambda: {
+    ('rejected',): sensor_buffer.rejected,
+    ('dropped',): sensor_buffer.dropped,
+}, ['reason'])
+registry.gauge('fridge_lazy_load_seconds', '延遲載入的套件與 client 第一次載入的秒數', lambda: {
+    (name,): seconds for name, seconds in lazy.load_seconds.items()}, ['name'])
+
 @app.route("/", methods=['GET'])
 def home():
     return render_template('index.html')
@@ -31,38 +89,138 @@ def linebot():
     body = request.get_data(as_text=True)
     signature = request.headers.get('X-Line-Signature')
     if not signature:
+        webhook_requests.inc(status='missing_signature')
         return 'Missing signature', 400
+    if not verify_signature(body, signature):
+        webhook_requests.inc(status='invalid_signature')
+        return 'Invalid signature', 400
     try:
-        handle_line_bot(body, signature)
-    except:
-        print(body) # 如果發生錯誤，印出收到的內容
+        events = parse_events(body)
+    except ValueError:
+        webhook_requests.inc(status='invalid_body')
+        print(body) # 如果內容無法解析，印出收到的內容
+        return 'Invalid body', 400
+    if not event_dispatcher.submit(events):
+        webhook_requests.inc(status='busy')
+        return 'Busy', 503  # 佇列已滿，讓 LINE 稍後重送
+    webhook_requests.inc(status='ok')
     return 'OK'
 
 @app.route('/post_data', methods=['POST'])
 def post_data():
-    data = request.json
-    temperature = data.get('temperature')
-    humidity = data.get('humidity')
-    esp32_id = data.get('esp32_id')
-    
-    sensor_data = SensorData(
-        temperature=temperature,
-        humidity=humidity,
-        esp32_id=esp32_id
-    )
-    db.session.add(sensor_data)
-    db.session.commit()
-    
-    return jsonify({"status": "success", "message": "Data received"}), 200
+    """接收 ESP32 上傳的溫溼度，可以是單筆物件或多筆讀數的陣列"""
+    data = request.get_json(silent=True)
+    try:
+        readings = parse_readings(data)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    sensor_buffer.add(readings)
+    return jsonify({"status": "success", "message": "Data received", "count": len(readings)}), 200
+
+@app.route('/sensor_history', methods=['GET'])
+def sensor_history():
+    """查詢裝置的溫溼度歷史，參數：esp32_id、start/end（ISO 8601，未帶時區視為 UTC）或 hours，可指定 resolution（0、60、3600）
+    需要以 X-Sensor-Token 標頭或 token 參數帶入裝置的查詢金鑰"""
+    esp32_id = request.args.get('esp32_id')
+    if not esp32_id:
+        return jsonify({"status": "error", "message": "需要 esp32_id"}), 400
+    if not verify_device_token(esp32_id, request.headers.get('X-Sensor-Token') or request.args.get('token')):
+        return jsonify({"status": "error", "message": "查詢金鑰錯誤"}), 403
+    try:
+        end = parse_time(request.args['end']) if 'end' in request.args else datetime.utcnow()
+        if 'start' in request.args:
+            start = parse_time(request.args['start'])
+        else:
+            hours = float(request.args.get('hours', 24))
+            if not 0 < hours <= SENSOR_HISTORY_MAX_HOURS:
+                raise ValueError(hours)
+            start = end - timedelta(hours=hours)
+        resolution = int(request.args['resolution']) if 'resolution' in request.args else None
+    except (OverflowError, ValueError):
+        return jsonify({"status": "error", "message": "時間或解析度格式錯誤"}), 400
+    if (start >= end or end - start > timedelta(hours=SENSOR_HISTORY_MAX_HOURS)
+            or resolution not in (None, 0, 60, 3600)):
+        return jsonify({"status": "error", "message": f"時間範圍必須在 {SENSOR_HISTORY_MAX_HOURS:g} 小時內，解析度必須是 0、60 或 3600"}), 400
+    if resolution is not None and (end - start).total_seconds() > max_span(resolution):
+        # 未指定時會自動選擇點數不超過上限的解析度，指定時也不能超過
+        return jsonify({"status": "error", "message": f"解析度 {resolution} 秒最多可查詢 {max_span(resolution) / 3600:g} 小時"}), 400
+
+    resolution, points = get_history(esp32_id, start, end, resolution)
+    for point in points:
+        point['timestamp'] = point['timestamp'].isoformat()
+    return jsonify({"status": "success", "esp32_id": esp32_id, "resolution": resolution, "points": points}), 200
+
+@app.route('/sensor_chart', methods=['GET'])
+def sensor_chart_image():
+    """裝置近 days 天（預設 1，需為 CHART_DAYS 之一）的溫溼度圖表，與 /sensor_history 相同需要裝置的查詢金鑰"""
+    esp32_id = request.args.get('esp32_id')
+    if esp32_id and not verify_device_token(esp32_id, request.headers.get('X-Sensor-Token') or request.args.get('token')):
+        return jsonify({"status": "error", "message": "查詢金鑰錯誤"}), 403
+    days = request.args.get('days', '1')
+    days = int(days) if days.isdigit() else 0
+    if not esp32_id or days not in CHART_DAYS:
+        return jsonify({"status": "error", "message": f"需要 esp32_id，days 必須是 {', '.join(map(str, CHART_DAYS))} 之一"}), 400
+    filename = sensor_chart.render(esp32_id, days)
+    if filename is None:
+        return jsonify({"status": "error", "message": "這段時間沒有感應器資料"}), 404
+    return send_from_directory(sensor_chart.output_dir, filename)
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus 格式的效能指標，多個 worker 時每個行程各自統計"""
+    return registry.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@app.route('/debug/profiler', methods=['GET', 'POST'])
+def debug_profiler():
+    """取樣分析器：POST action=start 開始、action=stop 停止並回傳 collapsed 堆疊，GET 查看目前結果
+    需要設定 PROFILER_TOKEN 並以 X-Profiler-Token 標頭帶入"""
+    if not PROFILER_TOKEN or request.headers.get('X-Profiler-Token') != PROFILER_TOKEN:
+        return 'Not Found', 404
+    if request.method == 'POST':
+        action = request.args.get('action') or request.form.get('action')
+        if action == 'start':
+            started = profiler.start()
+            return ('Profiler started' if started else 'Profiler already running'), 200
+        if action == 'stop':
+            return profiler.stop(), 200, {'Content-Type': 'text/plain; charset=utf-8'}
+        return 'action 必須是 start 或 stop', 400
+    status = f"# running={profiler.running} samples={sum(profiler.samples.values())}\n"
+    return status + profiler.collapsed(), 200, {'Content-Type': 'text/plain; charset=utf-8'}
+
+def with_app_context(func):
+    """讓排程工作可以使用資料庫"""
+    def job():
+        with app.app_context():
+            func()
+    return job
+
+def start_scheduler():
+    """設置定時任務，檢查即將過期的食物並提醒用戶，並清除超過保留期限的感應器資料"""
+    from apscheduler.schedulers.background import BackgroundScheduler  # 只有執行排程的 worker 需要
+
+    expiry_reminders.notify = push_texts
+    scheduler = BackgroundScheduler()
+    scheduler.add_job(with_app_context(expiry_reminders.tick), 'interval', seconds=REMINDER_INTERVAL,
+                      max_instances=1, coalesce=True)
+    scheduler.add_job(with_app_context(prune_sensor_data), 'interval', seconds=SENSOR_RETENTION_INTERVAL,
+                      max_instances=1, coalesce=True)
+    scheduler.start()
+    atexit.register(scheduler.shutdown, wait=False)
+    return scheduler
+
+# gunicorn 等方式啟動時以 RUN_SCHEDULER=1 開啟排程；已提醒的食品會被標記，多個 worker 同時執行也不會重複通知
+if os.getenv('RUN_SCHEDULER') == '1':
+    start_scheduler()
 
 # 初始化数据库和填充食品保质期表
 
 if __name__ == "__main__":
     with app.app_context():
         init_db()
+        shelf_life_index.load_from_db()
 
-    # 設置定時任務，檢查即將過期的食物並提醒用戶
-    scheduler = BackgroundScheduler()
-    scheduler.start()
+    if os.getenv('RUN_SCHEDULER') != '1':
+        start_scheduler()
 
     app.run(port=5000, debug=True)
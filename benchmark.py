@@ -0,0 +1,653 @@
+# benchmark.py - 離線效能量測，不需要連線到 LINE 或 Google 服務
+# 用法: python benchmark.py sensor --readings 5000 --devices 20
+import argparse
+import glob
+import os
+import random
+import tempfile
+import time
+from flask import Flask
+from models import db, SensorData, ESP32Device
+
+RECIPE_FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'icook')
+
+
+def make_app(db_path):
+    """建立一個指向暫存資料庫的 Flask app"""
+    from storage import engine_options
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(f'sqlite:///{db_path}')  # 與 app.py 相同的連線設定
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+def fake_readings(count, devices):
+    """產生模擬的 ESP32 讀數"""
+    from sensor_buffer import parse_readings
+    return parse_readings([
+        {
+            'temperature': round(random.uniform(2, 9), 1),
+            'humidity': round(random.uniform(60, 85), 1),
+            'esp32_id': f"esp{i % devices:04d}",
+        }
+        for i in range(count)
+    ])
+
+
+def report(name, count, elapsed):
+    print(f"{name:<24} {count:>8} 筆  {elapsed:8.3f} 秒  {count / elapsed:12.1f} 筆/秒")
+
+
+def bench_sensor(args):
+    """比較每筆讀數各自 commit 與批次緩衝寫入的吞吐量"""
+    from sensor_buffer import SensorBuffer
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = make_app(os.path.join(tmp, 'bench.db'))
+        readings = fake_readings(args.readings, args.devices)
+        with app.app_context():
+            db.session.add_all(ESP32Device(esp32_id=f"esp{i:04d}") for i in range(args.devices))
+            db.session.commit()
+
+        # 舊做法：每筆讀數一個交易
+        single = readings[:args.single_readings]
+        start = time.perf_counter()
+        with app.app_context():
+            for reading in single:
+                db.session.add(SensorData(**reading))
+                db.session.commit()
+        report('single-row commit', len(single), time.perf_counter() - start)
+
+        # 新做法：所有裝置的讀數進入同一個緩衝區
+        buffer = SensorBuffer(app, batch_size=args.batch_size, flush_interval=args.flush_interval)
+        start = time.perf_counter()
+        for reading in readings:
+            buffer.add([reading])
+        buffer.close()
+        report(f'buffered (batch={args.batch_size})', len(readings), time.perf_counter() - start)
+
+        with app.app_context():
+            stored = SensorData.query.count()
+        assert stored == len(single) + len(readings), stored
+
+
+def bench_gemini(args):
+    """量測共用 Gemini 用戶端相對於直接呼叫假模型的額外延遲，以及並行上限下的吞吐量"""
+    from concurrent.futures import ThreadPoolExecutor
+    from geminiAI import GeminiClient, StubModel
+
+    stub = StubModel(latency=0)
+    start = time.perf_counter()
+    for _ in range(args.calls):
+        ''.join(r.text for r in stub.generate_content(['prompt'], stream=True))
+    direct = (time.perf_counter() - start) / args.calls
+
+    client = GeminiClient(backend='stub', max_concurrency=args.concurrency)
+    client.generate(['warm up'])
+    start = time.perf_counter()
+    for _ in range(args.calls):
+        client.generate(['prompt'])
+    wrapped = (time.perf_counter() - start) / args.calls
+    print(f"直接呼叫假模型     {direct * 1e6:10.1f} µs/次")
+    print(f"經由 GeminiClient  {wrapped * 1e6:10.1f} µs/次（額外 {(wrapped - direct) * 1e6:.1f} µs）")
+
+    client.model.latency = args.latency
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.callers) as pool:
+        list(pool.map(lambda _: client.generate(['prompt']), range(args.calls // 10)))
+    report(f'stub {args.latency}s x{args.concurrency}', args.calls // 10, time.perf_counter() - start)
+    client.close()
+
+
+def bench_images(args):
+    """以範例圖片比較不同縮圖邊長與 JPEG 品質的檔案大小，加上 --recognize 時順便比較辨識結果"""
+    import glob
+    from image_pipeline import prepare_image, stream_food_items
+
+    paths = args.images or sorted(glob.glob('static/images/example/*.jpg'))
+    print(f"{'圖片':<36} {'邊長':>6} {'品質':>4} {'原始':>10} {'處理後':>10} {'比例':>6} {'耗時':>8}")
+    for path in paths:
+        with open(path, 'rb') as f:
+            original = f.read()
+        for max_edge in args.max_edge:
+            for quality in args.quality:
+                start = time.perf_counter()
+                processed, _ = prepare_image(original, max_edge=max_edge, quality=quality)
+                elapsed = time.perf_counter() - start
+                print(f"{path:<36} {max_edge:>6} {quality:>4} {len(original):>10} {len(processed):>10} "
+                      f"{len(processed) / len(original):>6.2f} {elapsed * 1000:>6.1f}ms")
+                if args.recognize:
+                    print(f"    辨識結果：{list(stream_food_items(processed))}")
+
+
+def legacy_extract_recipes(html_content):
+    """原本以 BeautifulSoup 解析整頁的做法，用來比對新解析器的速度與結果"""
+    import json
+    from bs4 import BeautifulSoup
+
+    recipes = []
+    soup = BeautifulSoup(html_content, 'html.parser')
+    for script_tag in soup.find_all('script', type='application/ld+json'):
+        try:
+            json_data = json.loads(script_tag.string)
+        except json.JSONDecodeError:
+            continue
+        if '@graph' in json_data:
+            for item in json_data['@graph']:
+                if '@type' in item and item['@type'] == 'ItemList' and 'itemListElement' in item:
+                    for element in item['itemListElement']:
+                        if '@type' in element and element['@type'] == 'ListItem':
+                            recipes.append({
+                                'url': element.get('url', ''),
+                                'description': element.get('description', ''),
+                                'additionalType': json.dumps(element.get('additionalType', '')),
+                                'name': element.get('name', ''),
+                                'image': element.get('image', '')
+                            })
+    return recipes
+
+
+def bench_recipes(args):
+    """比較 BeautifulSoup 與串流 ld+json 解析器的速度，並確認輸出一致"""
+    from cook_keyword import CookKeyword, RECIPE_LIMIT
+    from fake_services import fake_search_page
+
+    pages = []
+    for path in args.fixtures or sorted(glob.glob(os.path.join(RECIPE_FIXTURES, '*.html'))):
+        with open(path, encoding='utf-8') as f:
+            pages.append((path, f.read()))
+    pages.append(('synthetic', fake_search_page()))  # 大量卡片的頁面，比較解析速度
+
+    cook = CookKeyword('benchmark')
+    for name, html in pages:
+        expected = legacy_extract_recipes(html)[:RECIPE_LIMIT]
+        actual = cook.extract_recipes(html)
+        assert actual == expected, f"{name}: 解析結果不一致"
+
+        timings = {}
+        for label, func in (('BeautifulSoup', lambda: legacy_extract_recipes(html)[:RECIPE_LIMIT]),
+                            ('ld+json stream', lambda: cook.extract_recipes(html))):
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                func()
+            timings[label] = (time.perf_counter() - start) / args.repeat
+        print(f"{name}（{len(html) / 1024:.0f} KB，{len(actual)} 筆，結果一致）")
+        for label, elapsed in timings.items():
+            print(f"  {label:<16} {elapsed * 1000:8.3f} ms/頁")
+        print(f"  加速 {timings['BeautifulSoup'] / timings['ld+json stream']:.1f} 倍")
+
+
+def bench_shelf_life(args):
+    """隨著保質期表變大，量測索引建立與各種查詢的成本"""
+    from shelf_life import ShelfLifeIndex
+
+    rng = random.Random(0)
+    chars = [chr(c) for c in range(0x4E00, 0x4E00 + 3000)]
+    print(f"{'名稱數':>8} {'建立':>10} {'完全相符':>12} {'前後綴':>12} {'n-gram':>12} {'找不到':>12}")
+    for size in args.sizes:
+        names = list({''.join(rng.choices(chars, k=rng.randint(2, 5))) for _ in range(size)})
+        start = time.perf_counter()
+        index = ShelfLifeIndex()
+        index.load((name, 7) for name in names)
+        build = time.perf_counter() - start
+
+        samples = rng.sample(names, min(1000, len(names)))
+        queries = {
+            'exact': samples,
+            'affix': ['紅' + name for name in samples],
+            'ngram': [name[:2] + '的' + name[2:] + '片' for name in samples],
+            'miss': [''.join(rng.choices('ㄅㄆㄇㄈ', k=4)) for _ in samples],
+        }
+        costs = {}
+        for kind, items in queries.items():
+            start = time.perf_counter()
+            for item in items:
+                index.lookup(item)
+            costs[kind] = (time.perf_counter() - start) / len(items)
+        print(f"{len(names):>8} {build * 1000:>8.1f}ms " +
+              ' '.join(f"{costs[kind] * 1e6:>10.1f}µs" for kind in ('exact', 'affix', 'ngram', 'miss')))
+
+
+def bench_monitor(args):
+    """量測寫入路徑上異常偵測的額外成本，並確認模擬的故障會產生警告"""
+    from datetime import timedelta
+    from sensor_monitor import SensorMonitor
+
+    readings = fake_readings(args.readings, args.devices)
+    # 讓時間遞增，模擬每台裝置約每 10 秒一筆
+    base = readings[0]['timestamp']
+    for i, reading in enumerate(readings):
+        reading['timestamp'] = base + timedelta(seconds=10 * (i // args.devices))
+
+    monitor = SensorMonitor()
+    start = time.perf_counter()
+    for reading in readings:
+        monitor.observe([reading])
+    report('observe', len(readings), time.perf_counter() - start)
+
+    # 一台裝置的溫度逐步升高並持續超標
+    monitor = SensorMonitor()
+    last = readings[-1]['timestamp']
+    for minute in range(30):
+        monitor.observe([{'esp32_id': 'esp-broken', 'timestamp': last + timedelta(minutes=minute),
+                          'temperature': 4 + minute * 0.5, 'humidity': 70}])
+    kinds = sorted({alert[1] for alert in monitor._alerts})
+    print(f"模擬故障產生 {len(monitor._alerts)} 則警告：{kinds}")
+    assert monitor._alerts
+
+
+def bench_history(args):
+    """比較長時間範圍直接彙總原始讀數與查詢彙總表的耗時"""
+    from datetime import datetime, timedelta
+    from sqlalchemy import func
+    from sensor_buffer import SensorBuffer
+    from sensor_history import get_history
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = make_app(os.path.join(tmp, 'bench.db'))
+        # 每台裝置每分鐘一筆，共 args.days 天
+        end = datetime.utcnow()
+        start = end - timedelta(days=args.days)
+        readings = fake_readings(args.days * 1440 * args.devices, args.devices)
+        for i, reading in enumerate(readings):
+            reading['timestamp'] = start + timedelta(minutes=i // args.devices)
+        buffer = SensorBuffer(app)
+        begin = time.perf_counter()
+        for i in range(0, len(readings), 100):
+            buffer.add(readings[i:i + 100])
+        buffer.close()
+        report('ingest + rollup', len(readings), time.perf_counter() - begin)
+
+        with app.app_context():
+            begin = time.perf_counter()
+            for _ in range(args.repeat):
+                db.session.query(
+                    func.strftime('%Y-%m-%d %H', SensorData.timestamp),
+                    func.min(SensorData.temperature), func.max(SensorData.temperature), func.avg(SensorData.temperature),
+                ).filter(SensorData.esp32_id == 'esp0000', SensorData.timestamp >= start) \
+                    .group_by(func.strftime('%Y-%m-%d %H', SensorData.timestamp)).all()
+            report('raw GROUP BY hour', args.repeat, time.perf_counter() - begin)
+
+            begin = time.perf_counter()
+            for _ in range(args.repeat):
+                resolution, points = get_history('esp0000', start, end)
+            report(f'get_history ({resolution}s)', args.repeat, time.perf_counter() - begin)
+
+
+def bench_chart(args):
+    """量測長時間範圍的圖表：載入與重新取樣、第一次繪圖以及快取命中的耗時"""
+    from datetime import datetime, timedelta
+    from sensor_history import upsert_rollups
+    from sensor_chart import SensorChartRenderer, chart_window, load_series, resample
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = make_app(os.path.join(tmp, 'bench.db'))
+        # 直接寫入 args.days 天、每分鐘一筆的彙總
+        end = datetime.utcnow()
+        readings = fake_readings(args.days * 1440, 1)
+        for i, reading in enumerate(readings):
+            reading['timestamp'] = end - timedelta(minutes=len(readings) - i)
+        with app.app_context():
+            upsert_rollups(db.session, readings)
+            db.session.commit()
+
+            renderer = SensorChartRenderer(output_dir=tmp)
+            for days in args.ranges:
+                resolution, step, start_epoch, end_epoch, points = chart_window(days * 24)
+                begin = time.perf_counter()
+                data = load_series('esp0000', start_epoch, end_epoch, resolution)
+                resample(data, start_epoch, step, points)
+                prepared = time.perf_counter() - begin
+
+                begin = time.perf_counter()
+                renderer.render('esp0000', days)
+                cold = time.perf_counter() - begin
+                begin = time.perf_counter()
+                renderer.render('esp0000', days)
+                cached = time.perf_counter() - begin
+                print(f"{days:>4} 天  {len(data):>7} 列（{resolution}s）→ {points} 點  載入+取樣 {prepared * 1000:7.1f}ms  "
+                      f"繪圖 {cold * 1000:7.1f}ms  快取 {cached * 1000:6.2f}ms")
+
+
+def bench_line(args):
+    """以假的 LINE 伺服器比較 SDK 預設 client 與連線池 client 的推播吞吐量，以及相同內容合併成 multicast 的效果"""
+    from concurrent.futures import ThreadPoolExecutor
+    from linebot import LineBotApi
+    from linebot.models import TextSendMessage
+    from fake_services import start_fake_line
+    from line_client import PooledHttpClient, LineStats, send_texts
+
+    server = start_fake_line(latency=args.latency, failure_rate=args.failure_rate)
+    users = [f"U{i:032x}" for i in range(args.users)]
+
+    def push_all(api):
+        errors = 0
+        def push(user):
+            nonlocal errors
+            try:
+                api.push_message(user, TextSendMessage(text='hello'))
+            except Exception:
+                errors += 1
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.threads) as pool:
+            list(pool.map(push, users))
+        return time.perf_counter() - start, errors
+
+    default = LineBotApi('token', endpoint=server.url, data_endpoint=server.url)
+    elapsed, errors = push_all(default)
+    report(f'default client ({errors} 失敗)', len(users), elapsed)
+
+    stats = LineStats()
+    pooled = LineBotApi('token', endpoint=server.url, data_endpoint=server.url,
+                        http_client=lambda timeout: PooledHttpClient(timeout, backoff=0.01, stats=stats))
+    elapsed, errors = push_all(pooled)
+    report(f'pooled client ({errors} 失敗)', len(users), elapsed)
+    for name, summary in stats.summary().items():
+        print(f"    {name}: {summary}")
+
+    # 同一則通知送給所有使用者
+    server.counts.clear()
+    start = time.perf_counter()
+    failed = send_texts(pooled, {user: '感應器數據超過10分鐘未更新' for user in users})
+    report(f'send_texts ({len(failed)} 失敗)', len(users), time.perf_counter() - start)
+    print(f"    伺服器收到：{dict(server.counts)}")
+    server.stop()
+
+
+def bench_places(args):
+    """以模擬的使用者位置量測 geohash 格子快取的命中率與省下的 Places API 呼叫"""
+    import math
+    from concurrent.futures import ThreadPoolExecutor
+    from places import PlacesCache
+
+    class FakePlaces:
+        """回傳固定結果的假 Places client"""
+        def places_nearby(self, location, radius, type):
+            time.sleep(args.latency)
+            return {'results': [{'name': f'餐廳{i}', 'vicinity': '台北市', 'place_id': str(i),
+                                 'geometry': {'location': {'lat': location[0], 'lng': location[1]}}} for i in range(20)]}
+
+    # 使用者集中在幾個熱門地點附近，與地點的距離呈常態分布（公尺）
+    random.seed(1)
+    hotspots = [(25.0330 + random.uniform(-0.1, 0.1), 121.5654 + random.uniform(-0.1, 0.1)) for _ in range(args.hotspots)]
+    locations = []
+    for _ in range(args.lookups):
+        lat, lng = random.choice(hotspots)
+        dy, dx = random.gauss(0, args.spread), random.gauss(0, args.spread)
+        locations.append((lat + dy / 111320, lng + dx / (111320 * math.cos(math.radians(lat)))))
+
+    for precision in args.precision:
+        cache = PlacesCache(client=FakePlaces(), precision=precision)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.threads) as pool:
+            list(pool.map(lambda location: cache.nearby_restaurants(*location), locations))
+        elapsed = time.perf_counter() - start
+        stats = cache.stats()
+        print(f"geohash {precision} 碼  {stats['lookups']:>6} 次查詢  API {stats['api_calls']:>5} 次  "
+              f"省下 {stats['saved_calls']:>6} 次  命中率 {stats['hit_rate']:.1%}  平均 {elapsed / len(locations) * 1000:.2f}ms")
+
+
+def _storage_worker(url, legacy, seconds, args, start, results):
+    """壓力測試的 worker 行程：以與 SensorBuffer 相同的交易寫入讀數與彙總，並穿插讀取最新讀數"""
+    import storage
+    from sqlalchemy import create_engine, select
+    from sqlalchemy.exc import OperationalError
+    from sqlalchemy.orm import Session
+    from sqlalchemy.pool import NullPool
+    from sensor_history import upsert_rollups
+
+    if legacy:
+        storage.SQLITE_PRAGMAS = {}  # 改版前：rollback journal、synchronous=FULL、每次查詢重新連線
+        engine = create_engine(url, poolclass=NullPool)
+    else:
+        engine = create_engine(url, **storage.engine_options(url))
+    table = SensorData.__table__
+    latest = select(table).where(table.c.esp32_id == 'esp0000').order_by(table.c.timestamp.desc()).limit(20)
+    writes = reads = locked = 0
+    latencies = []
+    start.wait()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        began = time.perf_counter()
+        try:
+            if random.random() < args.read_ratio:
+                with engine.connect() as conn:
+                    conn.execute(latest).fetchall()
+                reads += 1
+            else:
+                batch = fake_readings(args.batch_size, args.devices)
+                with Session(engine) as session, session.begin():
+                    session.execute(table.insert(), batch)
+                    upsert_rollups(session, batch)
+                writes += 1
+                latencies.append(time.perf_counter() - began)
+        except OperationalError:
+            locked += 1  # database is locked
+    engine.dispose()
+    results.put((writes, reads, locked, latencies))
+
+
+def bench_storage(args):
+    """多個行程同時寫入同一個 SQLite 檔案：比較改版前的預設設定與 WAL + busy_timeout + 連線池的吞吐量"""
+    import multiprocessing
+    import sqlite3
+    import numpy as np
+    from sqlalchemy import create_engine
+    from storage import configure_sqlite
+
+    print(f"{'設定':<8} {'行程':>4} {'寫入交易/秒':>12} {'讀數/秒':>10} {'讀取/秒':>10} {'鎖定錯誤':>8} {'寫入 p99':>10}")
+    for mode in ('legacy', 'tuned'):
+        for workers in args.workers:
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, 'stress.db')
+                url = f'sqlite:///{path}'
+                engine = create_engine(url)
+                db.metadata.create_all(engine)
+                engine.dispose()
+                conn = sqlite3.connect(path)
+                configure_sqlite(conn, {'journal_mode': 'DELETE' if mode == 'legacy' else 'WAL'})  # journal_mode 會存在檔案中
+                conn.close()
+
+                start = multiprocessing.Event()
+                results = multiprocessing.Queue()
+                processes = [multiprocessing.Process(target=_storage_worker,
+                                                     args=(url, mode == 'legacy', args.seconds, args, start, results))
+                             for _ in range(workers)]
+                for process in processes:
+                    process.start()
+                start.set()
+                collected = [results.get() for _ in processes]
+                for process in processes:
+                    process.join()
+
+            writes = sum(result[0] for result in collected)
+            reads = sum(result[1] for result in collected)
+            locked = sum(result[2] for result in collected)
+            latencies = [latency for result in collected for latency in result[3]]
+            p99 = np.percentile(latencies, 99) * 1000 if latencies else float('nan')
+            print(f"{mode:<8} {workers:>4} {writes / args.seconds:>12.1f} {writes * args.batch_size / args.seconds:>10.0f} "
+                  f"{reads / args.seconds:>10.1f} {locked:>8} {p99:>8.1f}ms")
+
+
+STARTUP_DEFERRED = ('vertexai', 'google.cloud', 'matplotlib', 'googlemaps', 'numpy', 'PIL', 'bs4', 'apscheduler')  # 應該延遲載入的套件
+
+
+def bench_recognition(args):
+    """食物辨識的串流解析：假模型逐段輸出 JSON 時第一項與全部項目可用的時間，以及解析器本身的成本"""
+    import json
+    from food_service import food_list
+    from geminiAI import GeminiClient, StubModel, food_generation_config
+    from image_pipeline import FoodStreamParser
+
+    foods = [{'name': f'食物{i}', 'quantity': i % 3 + 1} for i in range(args.items)]
+    reply = json.dumps(foods, ensure_ascii=False)
+    client = GeminiClient(backend='stub')
+    client._model = StubModel(latency=args.latency, json_reply=reply,
+                              chunk_size=args.chunk_size, chunk_latency=args.chunk_latency)
+    firsts, totals = [], []
+    for _ in range(args.repeat):
+        parser = FoodStreamParser()
+        first = None
+        start = time.perf_counter()
+        for chunk in client.stream(['prompt'], food_generation_config):
+            if parser.feed(chunk) and first is None:
+                first = time.perf_counter() - start
+        items, result = parser.finish()
+        totals.append(time.perf_counter() - start)
+        firsts.append(first)
+        assert result == 'json' and len(items) == args.items, (result, items)
+    client.close()
+    print(f"{args.items} 項  第一項 {sum(firsts) / len(firsts) * 1000:.1f}ms  全部 {sum(totals) / len(totals) * 1000:.1f}ms")
+
+    chunks = [reply[i:i + args.chunk_size] for i in range(0, len(reply), args.chunk_size)]
+    text = ' '.join(f"{food['name']} {food['quantity']}" for food in foods)
+    for label, func in (('串流 JSON 解析', lambda: [FoodStreamParser().feed(chunk) for chunk in chunks]),
+                        ('文字 food_list', lambda: food_list(text.split()))):
+        start = time.perf_counter()
+        for _ in range(args.parse_repeat):
+            func()
+        print(f"{label:<16} {(time.perf_counter() - start) / args.parse_repeat * 1e6:8.1f} µs/次")
+
+
+def bench_startup(args):
+    """以 python -X importtime 量測匯入 app 的時間，超過預算或提早載入龐大套件時以狀態碼 1 結束"""
+    import subprocess
+    import sys
+
+    env = dict(os.environ, GEMINI_BACKEND='stub')
+    env.setdefault('LINE_CHANNEL_ACCESS_TOKEN', 'x')
+    env.setdefault('LINE_CHANNEL_SECRET', 'y')
+    root = os.path.dirname(os.path.abspath(__file__))
+    runs = []
+    for _ in range(args.repeat):
+        # 每次都是新的行程；importtime 的輸出在 stderr，格式為「self | cumulative | 模組」（微秒）
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'], cwd=root, env=env,
+                                capture_output=True, text=True, check=True)
+        modules = []
+        for line in result.stderr.splitlines():
+            if line.startswith('import time:') and not line.endswith('imported package'):
+                _, self_us, cumulative_us, name = (part.strip() for part in line.replace('import time:', '|', 1).split('|'))
+                if self_us.isdigit():
+                    modules.append((name, int(cumulative_us)))
+        runs.append(modules)
+
+    fastest = min(runs, key=lambda modules: dict(modules)['app'])
+    total_ms = dict(fastest)['app'] / 1000
+    print(f"import app：{total_ms:.0f}ms（{args.repeat} 次中最快的一次，預算 {args.budget_ms:.0f}ms）")
+    for name, cumulative_us in sorted(fastest, key=lambda item: -item[1])[1:args.top + 1]:
+        print(f"  {cumulative_us / 1000:8.1f}ms  {name}")
+
+    loaded = sorted({package for name, _ in fastest for package in STARTUP_DEFERRED
+                     if name == package or name.startswith(f'{package}.')})
+    problems = []
+    if total_ms > args.budget_ms:
+        problems.append(f"匯入時間 {total_ms:.0f}ms 超過預算 {args.budget_ms:.0f}ms")
+    if loaded:
+        problems.append(f"啟動時就載入了應該延遲載入的套件：{', '.join(loaded)}")
+    for problem in problems:
+        print(f"退步：{problem}")
+    if problems:
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    sub = parser.add_subparsers(dest='scenario', required=True)
+
+    sensor = sub.add_parser('sensor', help='感應器資料寫入吞吐量')
+    sensor.add_argument('--readings', type=int, default=20000)
+    sensor.add_argument('--single-readings', type=int, default=2000)
+    sensor.add_argument('--devices', type=int, default=50)
+    sensor.add_argument('--batch-size', type=int, default=500)
+    sensor.add_argument('--flush-interval', type=float, default=1.0)
+    sensor.set_defaults(func=bench_sensor)
+
+    gemini = sub.add_parser('gemini', help='Gemini 用戶端額外開銷（使用假模型）')
+    gemini.add_argument('--calls', type=int, default=2000)
+    gemini.add_argument('--concurrency', type=int, default=4)
+    gemini.add_argument('--callers', type=int, default=16)
+    gemini.add_argument('--latency', type=float, default=0.05)
+    gemini.set_defaults(func=bench_gemini)
+
+    images = sub.add_parser('images', help='辨識前圖片縮圖與壓縮的大小比較')
+    images.add_argument('images', nargs='*', help='預設使用 static/images/example/*.jpg')
+    images.add_argument('--max-edge', type=int, nargs='+', default=[512, 768, 1024])
+    images.add_argument('--quality', type=int, nargs='+', default=[70, 85])
+    images.add_argument('--recognize', action='store_true', help='呼叫 Gemini 辨識處理後的圖片（需要憑證）')
+    images.set_defaults(func=bench_images)
+
+    recipes = sub.add_parser('recipes', help='icook 搜尋頁解析速度與結果比對')
+    recipes.add_argument('fixtures', nargs='*', help=f'存下來的 icook 搜尋頁 HTML，未指定時使用 {RECIPE_FIXTURES} 下的頁面')
+    recipes.add_argument('--repeat', type=int, default=50)
+    recipes.set_defaults(func=bench_recipes)
+
+    shelf = sub.add_parser('shelf-life', help='保質期索引在不同表格大小下的查詢成本')
+    shelf.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000, 50000])
+    shelf.set_defaults(func=bench_shelf_life)
+
+    monitor = sub.add_parser('monitor', help='感應器異常偵測的額外成本')
+    monitor.add_argument('--readings', type=int, default=200000)
+    monitor.add_argument('--devices', type=int, default=50)
+    monitor.set_defaults(func=bench_monitor)
+
+    history = sub.add_parser('history', help='感應器歷史查詢：原始讀數與彙總表')
+    history.add_argument('--days', type=int, default=30)
+    history.add_argument('--devices', type=int, default=5)
+    history.add_argument('--repeat', type=int, default=20)
+    history.set_defaults(func=bench_history)
+
+    chart = sub.add_parser('chart', help='溫溼度歷史圖表的產生與快取')
+    chart.add_argument('--days', type=int, default=180)
+    chart.add_argument('--ranges', type=int, nargs='+', default=[1, 7, 30, 90], help='需為 CHART_DAYS 之一')
+    chart.set_defaults(func=bench_chart)
+
+    line = sub.add_parser('line', help='LINE 推播吞吐量（使用本機假伺服器）')
+    line.add_argument('--users', type=int, default=2000)
+    line.add_argument('--threads', type=int, default=8)
+    line.add_argument('--latency', type=float, default=0.01)
+    line.add_argument('--failure-rate', type=float, default=0.02)
+    line.set_defaults(func=bench_line)
+
+    places = sub.add_parser('places', help='附近餐廳 geohash 快取的命中率')
+    places.add_argument('--lookups', type=int, default=5000)
+    places.add_argument('--hotspots', type=int, default=30)
+    places.add_argument('--spread', type=float, default=400, help='使用者與熱門地點距離的標準差（公尺）')
+    places.add_argument('--precision', type=int, nargs='+', default=[5, 6, 7])
+    places.add_argument('--latency', type=float, default=0.05)
+    places.add_argument('--threads', type=int, default=8)
+    places.set_defaults(func=bench_places)
+
+    storage = sub.add_parser('storage', help='多個 worker 行程同時寫入 SQLite 的吞吐量與鎖定錯誤')
+    storage.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    storage.add_argument('--seconds', type=float, default=5)
+    storage.add_argument('--batch-size', type=int, default=20, help='每個寫入交易的讀數筆數')
+    storage.add_argument('--devices', type=int, default=20)
+    storage.add_argument('--read-ratio', type=float, default=0.5, help='讀取佔所有操作的比例')
+    storage.set_defaults(func=bench_storage)
+
+    recognition = sub.add_parser('recognition', help='食物辨識：串流 JSON 與完整文字的延遲與解析（使用假模型）')
+    recognition.add_argument('--items', type=int, default=5)
+    recognition.add_argument('--latency', type=float, default=0.3, help='第一段回應前的等待秒數')
+    recognition.add_argument('--chunk-size', type=int, default=16)
+    recognition.add_argument('--chunk-latency', type=float, default=0.02, help='每段回應之間的秒數')
+    recognition.add_argument('--repeat', type=int, default=5)
+    recognition.add_argument('--parse-repeat', type=int, default=2000)
+    recognition.set_defaults(func=bench_recognition)
+
+    startup = sub.add_parser('startup', help='匯入 app 的時間預算（python -X importtime）')
+    startup.add_argument('--budget-ms', type=float, default=1500)
+    startup.add_argument('--repeat', type=int, default=3)
+    startup.add_argument('--top', type=int, default=15, help='列出累計時間最長的幾個模組')
+    startup.set_defaults(func=bench_startup)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+# cache.py - 行程內的快取工具（有上限的 LRU + TTL）
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from storage import connect_sqlite
+
+_MISSING = object()
+
+
+class TTLCache:
+    """執行緒安全的 LRU 快取，每筆資料在 ttl 秒後失效，超過 maxsize 時淘汰最久未用的項目"""
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (到期時間, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """取得快取值，不存在或已過期時回傳 default"""
+        value = self._get(key)
+        self._count(value is not _MISSING)
+        return default if value is _MISSING else value
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self._data.move_to_end(key)
+                    return entry[1]
+                del self._data[key]
+            return _MISSING
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def set(self, key, value, ttl=None):
+        """寫入快取，ttl 未指定時使用預設值"""
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """移除並回傳快取值"""
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """回傳命中統計"""
+        with self._lock:
+            return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses}
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+
+class LatestReadingCache(TTLCache):
+    """每台 ESP32 最新一筆溫溼度讀數，ttl 決定最多信任記憶體中的資料多久"""
+
+    def update(self, readings):
+        """以較新的讀數覆蓋快取，readings 為含 esp32_id 與 timestamp 的 dict"""
+        latest = {}
+        for reading in readings:
+            current = latest.get(reading['esp32_id'])
+            if current is None or reading['timestamp'] >= current['timestamp']:
+                latest[reading['esp32_id']] = reading
+
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            for esp32_id, reading in latest.items():
+                entry = self._data.get(esp32_id)
+                if entry is not None and entry[0] > time.monotonic() and entry[1]['timestamp'] > reading['timestamp']:
+                    continue
+                self._data[esp32_id] = (expires, reading)
+                self._data.move_to_end(esp32_id)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+class ResponseCache(TTLCache):
+    """以正規化後的問題文字為鍵的回答快取，可選擇同時寫入 SQLite，重新啟動後仍然有效"""
+
+    def __init__(self, maxsize=1000, ttl=86400, db_path=None):
+        super().__init__(maxsize=maxsize, ttl=ttl)
+        self._conn = None
+        if db_path:
+            self._conn = connect_sqlite(db_path)  # 多個 worker 共用同一個檔案
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS responses
+                                  (key TEXT PRIMARY KEY, value TEXT, expires_at REAL)''')
+            self._conn.execute("DELETE FROM responses WHERE expires_at < ?", (time.time(),))
+            self._conn.commit()
+        self._db_lock = threading.Lock()
+
+    @staticmethod
+    def normalize(text):
+        """全形轉半形、忽略大小寫、合併空白並去掉結尾標點，讓同樣的問題對應到同一個鍵"""
+        text = unicodedata.normalize('NFKC', text).lower()
+        text = re.sub(r'\s+', ' ', text)
+        return text.strip(' ?!.,~。！？，、～…')
+
+    def get(self, text, default=None):
+        key = self.normalize(text)
+        value = self._get(key)
+        if value is _MISSING and self._conn is not None:
+            value = self._load(key)
+        self._count(value is not _MISSING)
+        return default if value is _MISSING else value
+
+    def set(self, text, value, ttl=None):
+        key = self.normalize(text)
+        ttl = self.ttl if ttl is None else ttl
+        super().set(key, value, ttl)
+        if self._conn is not None:
+            with self._db_lock:
+                self._conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)",
+                                   (key, value, time.time() + ttl))
+                self._conn.commit()
+
+    def _load(self, key):
+        with self._db_lock:
+            row = self._conn.execute("SELECT value, expires_at FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None or row[1] <= time.time():
+            return _MISSING
+        super().set(key, row[0], row[1] - time.time())
+        return row[0]
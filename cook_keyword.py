@@ -1,74 +1,164 @@
+import atexit
 import json
+import os
+import re
 import sqlite3
+import threading
+import time
+from itertools import islice
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
 from linebot.models import TemplateSendMessage, CarouselTemplate, CarouselColumn, URITemplateAction, TextSendMessage
+from metrics import track
+from storage import connect_sqlite
+
+load_dotenv()
+
+RECIPE_BASE_URL = os.getenv('RECIPE_BASE_URL', 'https://icook.tw')  # 負載測試時指向 fake_services 的假 icook
+RECIPE_DB_PATH = os.getenv('RECIPE_DB_PATH', '/tmp/icook.db')
+RECIPE_CACHE_TTL = float(os.getenv('RECIPE_CACHE_TTL', 86400))  # 快取的食譜多久後重新爬取
+RECIPE_TIMEOUT = float(os.getenv('RECIPE_TIMEOUT', 10))
+RECIPE_LIMIT = 5  # 每次查詢保留的食譜數
+
+# 所有查詢共用一個 Session，重複使用與 icook 的連線
+session = requests.Session()
+session.headers['User-Agent'] = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+session.mount('https://', HTTPAdapter(pool_connections=2, pool_maxsize=16))
+
+# 只找出 ld+json 的 script 區塊，不需要把整頁 HTML 解析成樹；type 前必須是空白，data-type 之類的屬性不算
+LD_JSON_SCRIPT = re.compile(
+    r'<script\b[^>]*\stype\s*=\s*["\']?application/ld\+json["\']?[^>]*>(.*?)</script\s*>',
+    re.IGNORECASE | re.DOTALL,
+)
+
+
+def iter_recipes(html_content):
+    """依序產生搜尋頁 ld+json 中的 ListItem 食譜，呼叫端拿夠了就可以停止"""
+    for match in LD_JSON_SCRIPT.finditer(html_content):
+        try:
+            json_data = json.loads(match.group(1))
+        except json.JSONDecodeError as e:
+            print(f"解析 JSON 时出错：{e}")
+            continue
+        if '@graph' in json_data:
+            for item in json_data['@graph']:
+                if '@type' in item and item['@type'] == 'ItemList' and 'itemListElement' in item:
+                    for element in item['itemListElement']:
+                        if '@type' in element and element['@type'] == 'ListItem':
+                            yield {
+                                'url': element.get('url', ''),
+                                'description': element.get('description', ''),
+                                'additionalType': json.dumps(element.get('additionalType', '')),  # 转换为 JSON 字符串
+                                'name': element.get('name', ''),
+                                'image': element.get('image', '')
+                            }
+
+
+class RecipeStore:
+    """以 keyword 為索引的食譜快取，整個行程共用同一個 SQLite 連線"""
+
+    def __init__(self, db_path):
+        self.conn = connect_sqlite(db_path)  # 多個 worker 共用同一個檔案
+        self.lock = threading.Lock()
+        self._migrate()
+
+    def _migrate(self):
+        c = self.conn
+        # 多個 worker 同時啟動時，BEGIN IMMEDIATE 先取得寫入鎖，一次只有一個行程檢查並修改結構，其他行程等待 busy_timeout
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            c.execute('''CREATE TABLE IF NOT EXISTS recipes
+                         (url TEXT, description TEXT, additionalType TEXT, name TEXT, image TEXT, keyword TEXT)''')
+            columns = {row[1] for row in c.execute("PRAGMA table_info(recipes)")}
+            for column, ddl in (('position', "ALTER TABLE recipes ADD COLUMN position INTEGER DEFAULT 0"),
+                                ('fetched_at', "ALTER TABLE recipes ADD COLUMN fetched_at REAL DEFAULT 0")):  # 舊資料視為已過期
+                if column in columns:
+                    continue
+                try:
+                    c.execute(ddl)
+                except sqlite3.OperationalError as e:
+                    if 'duplicate column' not in str(e):  # 沒有經過鎖的舊版行程已經加上了
+                        raise
+            # 舊版每次查詢都會重複寫入，同一個 keyword 的同一份食譜只保留最新一筆
+            c.execute("DELETE FROM recipes WHERE rowid NOT IN (SELECT MAX(rowid) FROM recipes GROUP BY keyword, url)")
+            c.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_recipes_keyword_url ON recipes (keyword, url)")
+            c.commit()
+        except Exception:
+            c.rollback()
+            raise
+
+    def get(self, keyword):
+        """回傳 (食譜列表, 最早的抓取時間)，沒有資料時回傳 ([], None)"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT url, description, additionalType, name, image, fetched_at FROM recipes "
+                "WHERE keyword = ? ORDER BY position", (keyword,)).fetchall()
+        if not rows:
+            return [], None
+        recipes = [
+            {'url': url, 'description': description, 'additionalType': additional_type, 'name': name, 'image': image}
+            for url, description, additional_type, name, image, _ in rows
+        ]
+        return recipes, min(row[5] for row in rows)
+
+    def put(self, keyword, recipes):
+        """以新的爬取結果取代這個 keyword 的快取"""
+        now = time.time()
+        with self.lock:
+            try:
+                with self.conn:
+                    self.conn.execute("DELETE FROM recipes WHERE keyword = ?", (keyword,))
+                    self.conn.executemany(
+                        "INSERT OR REPLACE INTO recipes (url, description, additionalType, name, image, keyword, position, fetched_at) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        [(r['url'], r['description'], r['additionalType'], r['name'], r['image'], keyword, i, now)
+                         for i, r in enumerate(recipes)])
+            except sqlite3.Error as e:
+                print(f"保存食谱到数据库时出错：{e}")
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+recipe_store = RecipeStore(RECIPE_DB_PATH)
+atexit.register(recipe_store.close)
+
 
 class CookKeyword:
-    def __init__(self, keyword):
-        self.keyword = keyword
+    def __init__(self, keyword, store=recipe_store):
+        self.keyword = keyword.strip()
         self.recipes = []  # 初始化 recipes 属性
-        db_path = '/tmp/icook.db'
-        self.conn = sqlite3.connect(db_path)
-        self.c = self.conn.cursor()
-        self.c.execute('''CREATE TABLE IF NOT EXISTS recipes
-                         (url TEXT, description TEXT, additionalType TEXT, name TEXT, image TEXT, keyword TEXT)''')
+        self.store = store
 
     def scrape(self):
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
+        """先查本地快取，沒有或已過期時才到 icook 爬取"""
+        cached, fetched_at = self.store.get(self.keyword)
+        if cached and time.time() - fetched_at < RECIPE_CACHE_TTL:
+            self.recipes = cached
+            return self.recipes
 
         try:
-            response = requests.get(f"https://icook.tw/search/{self.keyword}/", headers=headers)
-            response.raise_for_status()
+            with track('icook'):
+                response = session.get(f"{RECIPE_BASE_URL}/search/{self.keyword}/", timeout=RECIPE_TIMEOUT)
+                response.raise_for_status()
             html_content = response.text
         except requests.RequestException as e:
             print(f"请求错误：{e}")
-            return []
+            self.recipes = cached  # 連線失敗時先用過期的快取
+            return self.recipes
 
-        self.recipes = self.extract_recipes(html_content)[:5]  # 将爬取到的食谱存储在 self.recipes 中
+        self.recipes = self.extract_recipes(html_content)  # 将爬取到的食谱存储在 self.recipes 中
         self.save_to_db(self.recipes)  # 将食谱存储到数据库
         return self.recipes
 
-    def extract_recipes(self, html_content):
-        recipes = []
-        soup = BeautifulSoup(html_content, 'html.parser')
-        script_tags = soup.find_all('script', type='application/ld+json')
-
-        for script_tag in script_tags:
-            try:
-                json_data = json.loads(script_tag.string)
-                if '@graph' in json_data:
-                    for item in json_data['@graph']:
-                        if '@type' in item and item['@type'] == 'ItemList' and 'itemListElement' in item:
-                            for element in item['itemListElement']:
-                                if '@type' in element and element['@type'] == 'ListItem':
-                                    recipe = {
-                                        'url': element.get('url', ''),
-                                        'description': element.get('description', ''),
-                                        'additionalType': json.dumps(element.get('additionalType', '')),  # 转换为 JSON 字符串
-                                        'name': element.get('name', ''),
-                                        'image': element.get('image', '')
-                                    }
-                                    recipes.append(recipe)
-            except json.JSONDecodeError as e:
-                print(f"解析 JSON 时出错：{e}")
-                continue
-
-        return recipes
+    def extract_recipes(self, html_content, limit=RECIPE_LIMIT):
+        return list(islice(iter_recipes(html_content), limit))
 
     def save_to_db(self, recipes):
-        for recipe in recipes:
-            try:
-                self.c.execute("INSERT INTO recipes VALUES (?, ?, ?, ?, ?, ?)",
-                               (recipe['url'], recipe['description'], recipe['additionalType'], recipe['name'], recipe['image'], self.keyword))
-            except sqlite3.Error as e:
-                print(f"保存食谱到数据库时出错：{e}")
-        self.conn.commit()
-
-    def close_db(self):
-        self.conn.close()
+        if recipes:
+            self.store.put(self.keyword, recipes)
 
     def get_carousel_message(self):
         if not self.recipes:
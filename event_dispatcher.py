@@ -0,0 +1,84 @@
+# event_dispatcher.py - 背景處理 LINE webhook 事件，讓 /webhook 可以立即回應
+import os
+import queue
+import threading
+import zlib
+from dotenv import load_dotenv
+
+load_dotenv()
+
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', 8))  # 同時處理事件的執行緒數
+WEBHOOK_MAX_QUEUE = int(os.getenv('WEBHOOK_MAX_QUEUE', 200))  # 排隊中事件的上限
+
+_STOP = object()
+
+
+def event_key(event):
+    """事件的排序鍵，同一個來源（使用者、群組）的事件依序處理"""
+    source = event.get('source', {})
+    return source.get('userId') or source.get('groupId') or source.get('roomId') or ''
+
+
+class EventDispatcher:
+    """固定數量的 worker，依來源將事件分配到各自的佇列，保證同一使用者的事件按順序處理"""
+
+    def __init__(self, app, handle, workers=WEBHOOK_WORKERS, max_queue=WEBHOOK_MAX_QUEUE):
+        self.app = app
+        self.handle = handle
+        self.max_queue = max_queue
+        self._queues = [queue.Queue() for _ in range(workers)]
+        self._threads = []
+        self._depth = 0
+        self._lock = threading.Lock()
+
+    def submit(self, events):
+        """將一次 webhook 的所有事件排入佇列，超過上限時整批拒絕並回傳 False"""
+        with self._lock:
+            if self._depth + len(events) > self.max_queue:
+                return False
+            self._depth += len(events)
+        self._ensure_started()
+        for event in events:
+            shard = zlib.crc32(event_key(event).encode('utf-8')) % len(self._queues)
+            self._queues[shard].put(event)
+        return True
+
+    def depth(self):
+        """目前排隊與處理中的事件數"""
+        with self._lock:
+            return self._depth
+
+    def close(self, timeout=30):
+        """處理完已排入的事件後停止 worker"""
+        for q in self._queues:
+            q.put(_STOP)
+        for thread in self._threads:
+            thread.join(timeout=timeout)
+        self._threads = []
+
+    def _ensure_started(self):
+        # 與 SensorBuffer 相同，等到 fork 之後第一次使用才啟動執行緒
+        if self._threads:
+            return
+        with self._lock:
+            if not self._threads:
+                self._threads = [
+                    threading.Thread(target=self._run, args=(q,), name=f'webhook-{i}', daemon=True)
+                    for i, q in enumerate(self._queues)
+                ]
+                for thread in self._threads:
+                    thread.start()
+
+    def _run(self, q):
+        while True:
+            event = q.get()
+            if event is _STOP:
+                return
+            try:
+                with self.app.app_context():
+                    self.handle(event)
+            except Exception as e:
+                print(f"處理 LINE 事件時出錯：{e}，事件內容：{event}")
+            finally:
+                with self._lock:
+                    self._depth -= 1
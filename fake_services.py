@@ -0,0 +1,219 @@
+# fake_services.py - 本機的假外部服務（LINE、icook、Google Places），讓效能量測與負載測試不必連線到外部
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeServer(ThreadingHTTPServer):
+    """在背景執行緒提供服務的 HTTP 伺服器，記錄每個路徑的請求數，可模擬延遲與失敗"""
+
+    daemon_threads = True
+
+    def __init__(self, handler, latency=0.0, failure_rate=0.0, port=0):
+        super().__init__(('127.0.0.1', port), handler)
+        self.latency = latency
+        self.failure_rate = failure_rate  # 以 500 或 429 回應的比例
+        self.counts = Counter()
+        self.replies = {}  # replyToken -> 收到回覆的 perf_counter 時間，負載測試用來計算端到端延遲
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name='fake-server', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # 支援 keep-alive，才量得出連線池的效果
+    disable_nagle_algorithm = True  # 標頭與內容分開寫出，keep-alive 連線上不關掉 Nagle 會多等一次延遲 ACK
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def send(self, status, body=b'', content_type='application/json', headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def simulate(self):
+        """模擬延遲與失敗，已回應錯誤時回傳 True"""
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.failure_rate and random.random() < self.server.failure_rate:
+            self.server.count('failed')
+            if random.random() < 0.5:
+                self.send(429, {'message': 'The API rate limit has been exceeded.'}, headers={'Retry-After': '0'})
+            else:
+                self.send(500, {'message': 'Internal server error'})
+            return True
+        return False
+
+
+class FakeLineHandler(FakeHandler):
+    """Messaging API 中 line_bot 用到的端點"""
+
+    PROFILE = re.compile(r'^/v2/bot/profile/([^/]+)$')
+    CONTENT = re.compile(r'^/v2/bot/message/([^/]+)/content$')
+    image = b'\xff\xd8\xff\xe0' + b'\0' * 2048  # 下載圖片時回傳的假內容
+
+    def do_GET(self):
+        if self.simulate():
+            return
+        if self.PROFILE.match(self.path):
+            self.server.count('profile')
+            user_id = self.PROFILE.match(self.path).group(1)
+            return self.send(200, {'userId': user_id, 'displayName': f'user-{user_id[-4:]}'})
+        if self.CONTENT.match(self.path):
+            self.server.count('content')
+            return self.send(200, self.image, content_type='image/jpeg')
+        self.send(404, {'message': 'Not found'})
+
+    def do_POST(self):
+        body = self.read_body()
+        if self.simulate():
+            return
+        name = {
+            '/v2/bot/message/reply': 'reply',
+            '/v2/bot/message/push': 'push',
+            '/v2/bot/message/multicast': 'multicast',
+        }.get(self.path)
+        if name is None:
+            return self.send(404, {'message': 'Not found'})
+        data = json.loads(body or b'{}')
+        self.server.count(name)
+        with self.server._lock:
+            if name == 'multicast':
+                self.server.counts['multicast_recipients'] += len(data.get('to', []))
+            if name == 'reply':
+                self.server.replies[data.get('replyToken')] = time.perf_counter()
+        self.send(200, {})
+
+
+def fake_search_page(recipes=24, filler=400):
+    """產生類似 icook 搜尋結果頁的 HTML：大量一般標籤加上 ld+json 區塊"""
+    elements = [
+        {
+            '@type': 'ListItem', 'position': i + 1, 'url': f'https://icook.tw/recipes/{400000 + i}',
+            'name': f'蘋果料理 {i} by 測試', 'description': '簡單又好吃的蘋果料理 ' * 5,
+            'image': f'https://tokyo-kitchen.icook.network/uploads/recipe/cover/{400000 + i}/cover.jpg',
+            'additionalType': 'Recipe',
+        }
+        for i in range(recipes)
+    ]
+    graph = {'@context': 'https://schema.org', '@graph': [
+        {'@type': 'WebSite', 'name': '愛料理'},
+        {'@type': 'ItemList', 'itemListElement': elements},
+    ]}
+    cards = ''.join(
+        f'<li class="browse-recipe-item"><a href="/recipes/{i}"><div class="card"><img src="x{i}.jpg" alt="料理 {i}">'
+        f'<span class="name">料理 {i}</span><p>描述 {i} &amp; 更多</p></div></a></li>'
+        for i in range(filler)
+    )
+    return (
+        '<!DOCTYPE html><html><head><title>蘋果食譜</title>'
+        '<script type="application/ld+json">{"@context":"https://schema.org","@type":"Organization"}</script>'
+        '<script src="app.js"></script></head><body><ul>' + cards + '</ul>'
+        f'<script type="application/ld+json">{json.dumps(graph, ensure_ascii=False)}</script>'
+        '<script>window.__STATE__ = {"a": 1};</script></body></html>'
+    )
+
+
+class FakeIcookHandler(FakeHandler):
+    """icook 搜尋頁，每個關鍵字回傳同樣結構的假頁面"""
+
+    page = None
+
+    def do_GET(self):
+        if self.simulate():
+            return
+        if not self.path.startswith('/search/'):
+            return self.send(404, b'')
+        self.server.count('search')
+        if FakeIcookHandler.page is None:
+            FakeIcookHandler.page = fake_search_page().encode('utf-8')
+        self.send(200, self.page, content_type='text/html; charset=utf-8')
+
+
+class FakePlacesHandler(FakeHandler):
+    """Places API 的 nearbysearch，回傳以查詢位置為中心的假餐廳"""
+
+    def do_GET(self):
+        if self.simulate():
+            return
+        url = urlparse(self.path)
+        if url.path != '/maps/api/place/nearbysearch/json':
+            return self.send(404, {'status': 'NOT_FOUND'})
+        self.server.count('nearbysearch')
+        lat, lng = (float(v) for v in parse_qs(url.query)['location'][0].split(','))
+        results = [{
+            'name': f'餐廳 {i}', 'vicinity': f'測試路 {i} 號', 'place_id': f'fake-{i}',
+            'geometry': {'location': {'lat': lat + i * 1e-4, 'lng': lng - i * 1e-4}},
+            'photos': [{'photo_reference': f'photo-{i}'}],
+        } for i in range(20)]
+        self.send(200, {'status': 'OK', 'results': results})
+
+
+def start_fake_line(latency=0.0, failure_rate=0.0, port=0):
+    """啟動假的 LINE API 伺服器，以 server.url 設定 LINE_API_ENDPOINT 與 LINE_API_DATA_ENDPOINT"""
+    return FakeServer(FakeLineHandler, latency=latency, failure_rate=failure_rate, port=port).start()
+
+
+def start_fake_icook(latency=0.0, failure_rate=0.0, port=0):
+    """啟動假的 icook，以 server.url 設定 RECIPE_BASE_URL"""
+    return FakeServer(FakeIcookHandler, latency=latency, failure_rate=failure_rate, port=port).start()
+
+
+def start_fake_places(latency=0.0, failure_rate=0.0, port=0):
+    """啟動假的 Google Places，以 server.url 設定 PLACES_BASE_URL"""
+    return FakeServer(FakePlacesHandler, latency=latency, failure_rate=failure_rate, port=port).start()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='啟動假的外部服務')
+    parser.add_argument('--port', type=int, default=8801)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    args = parser.parse_args()
+    servers = [
+        start_fake_line(args.latency, args.failure_rate, args.port),
+        start_fake_icook(args.latency, args.failure_rate, args.port + 1),
+        start_fake_places(args.latency, args.failure_rate, args.port + 2),
+    ]
+    line, icook, places = (server.url for server in servers)
+    print(f"LINE_API_ENDPOINT={line} LINE_API_DATA_ENDPOINT={line} RECIPE_BASE_URL={icook} PLACES_BASE_URL={places}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        for server in servers:
+            server.stop()
@@ -1,75 +1,172 @@
 # food_service.py - 處理食物相關的業務邏輯
 
 from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
 from models import db, Food, FoodExpiration
+from shelf_life import shelf_life_index, SHELF_LIFE_DEFAULT_DAYS
+from reminders import expiry_reminders, format_expiring
 from datetime import datetime, timedelta
 
+def food_list(parts):
+    """把「蘋果 2 香蕉」之類的字詞列表轉成 (名稱, 數量) 列表，沒有數量的預設為 1"""
+    foods = []
+    i = 0
+    while i < len(parts):
+        if i < len(parts) - 1 and parts[i+1].isdigit():
+            # 當前部分是食物名稱，下一部分是數量
+            food_name = parts[i]
+            quantity = int(parts[i+1])
+            i += 2  # 跳過名稱和數量
+        else:
+            # 當前部分是食物名稱，數量為預設值1
+            food_name = parts[i]
+            quantity = 1
+            i += 1  # 跳過名稱
+        
+        foods.append((food_name, quantity))
+    return foods
+
+
+def user_foods_query(user_id, names):
+    """使用者冰箱中指定名稱的食品，新增與刪除共用；(user_id, name) 有唯一索引，每個名稱最多一筆，不需要排序"""
+    return Food.query.filter(Food.user_id == user_id, Food.name.in_(names))
+
+
+def foods_query(user_id):
+    return Food.query.filter_by(user_id=user_id).order_by(Food.expiration_date)
+
+
+def expiring_foods_query(user_id, now):
+    """一天內即將到期的食品"""
+    return Food.query.filter(
+        Food.user_id == user_id,
+        Food.expiration_date >= now,
+        Food.expiration_date <= now + timedelta(days=1)
+    )
+
+
 def add_food(food_name, user_id, quantity=1):
     """添加食品到資料庫並設定正確的過期日期"""
-    # 從 FoodExpiration 表中查找相應的食品保質期
-    food_expiration = FoodExpiration.query.filter_by(food_name=food_name).first()
-    
-    # 如果找不到保質期資訊，預設為 7 天並保存新的食品保質期
-    if not food_expiration:
-        food_expiration = FoodExpiration(food_name=food_name, shelf_life_days=7)
-        db.session.add(food_expiration)
-        db.session.commit()
+    return add_foods([(food_name, quantity)], user_id)[0]
+
+
+def add_foods(food_list, user_id):
+    """一次添加多項食品，現有食品用一次查詢取得，所有變更在同一個交易提交
+    food_list 為 (食品名稱, 數量) 列表，回傳每一項的結果訊息"""
+    if not food_list:
+        return []
+    try:
+        return _add_foods(food_list, user_id)
+    except IntegrityError:
+        # 另一個 worker 同時新增了同樣的食品（違反 user_id, name 唯一限制），重新讀取後再做一次
+        db.session.rollback()
+        return _add_foods(food_list, user_id)
+
+
+def _add_foods(food_list, user_id):
+    names = {food_name for food_name, _ in food_list}
+
+    # 從記憶體中的保質期索引查找，「紅蘋果」之類的名稱會對應到已知的「蘋果」
+    shelf_life_index.ensure_loaded()
+    shelf_lives = {}
+    for food_name in names:
+        match = shelf_life_index.lookup(food_name)
+        if match:
+            shelf_lives[food_name] = match[1]
 
     # 檢查是否已經有相同的食品
-    existing_food = Food.query.filter_by(name=food_name, user_id=user_id).first()
-    if existing_food:
-        existing_food.quantity += quantity  # 累加數量
-        db.session.commit()
-        return f"已更新 {food_name} 的數量。現有數量: {existing_food.quantity}"
-
-    # 計算過期日期
-    expiration_date = datetime.now() + timedelta(days=food_expiration.shelf_life_days)
-
-    # 創建新的食品項目
-    new_food = Food(name=food_name, quantity=quantity, added_date=datetime.now(), expiration_date=expiration_date, user_id=user_id)
-    db.session.add(new_food)
+    existing = {}
+    for food in user_foods_query(user_id, names):
+        existing.setdefault(food.name, food)
+
+    messages = []
+    now = datetime.now()
+    new_expirations = []
+    new_foods = {}  # 食品名稱 -> 待新增的資料列
+    for food_name, quantity in food_list:
+        # 如果找不到保質期資訊，使用預設天數並保存新的食品保質期
+        shelf_life_days = shelf_lives.get(food_name)
+        if shelf_life_days is None:
+            shelf_life_days = shelf_lives[food_name] = SHELF_LIFE_DEFAULT_DAYS
+            new_expirations.append({'food_name': food_name, 'shelf_life_days': shelf_life_days})
+
+        existing_food = existing.get(food_name)
+        if existing_food:
+            existing_food.quantity += quantity  # 累加數量
+            messages.append(f"已更新 {food_name} 的數量。現有數量: {existing_food.quantity}")
+        elif food_name in new_foods:
+            new_foods[food_name]['quantity'] += quantity
+            messages.append(f"已更新 {food_name} 的數量。現有數量: {new_foods[food_name]['quantity']}")
+        else:
+            # 計算過期日期並創建新的食品項目
+            new_foods[food_name] = {
+                'name': food_name, 'quantity': quantity, 'added_date': now,
+                'expiration_date': now + timedelta(days=shelf_life_days), 'user_id': user_id,
+            }
+            messages.append(f"{food_name} 添加成功")
+
+    # 新的資料列以 executemany 一次寫入
+    if new_expirations:
+        db.session.execute(FoodExpiration.__table__.insert(), new_expirations)
+    if new_foods:
+        db.session.execute(Food.__table__.insert(), list(new_foods.values()))
     db.session.commit()
-    return f"{food_name} 添加成功"
+    for row in new_expirations:
+        shelf_life_index.add(row['food_name'], row['shelf_life_days'])
+    for row in new_foods.values():
+        expiry_reminders.schedule(user_id, row['expiration_date'])
+    return messages
 
 
 def remove_food(food_name, user_id, quantity=1):
     """從資料庫中刪除或減少食品的數量"""
+    return remove_foods([(food_name, quantity)], user_id)[0]
+
+
+def remove_foods(food_list, user_id):
+    """一次刪除或減少多項食品，只查詢一次並在同一個交易提交，回傳每一項的結果訊息"""
+    if not food_list:
+        return []
+    names = {food_name for food_name, _ in food_list}
+
     # 查找相應的食品項目
-    food = Food.query.filter_by(name=food_name, user_id=user_id).first()
-    if not food:
-        return "錯誤: 您的冰箱中沒有這種食品。"
-
-    # 檢查刪除的數量是否有效
-    if quantity > food.quantity:
-        return f"錯誤: 你不能刪除超過現有數量的 {food_name}。目前數量: {food.quantity}"
-
-    # 減少食品數量或刪除記錄
-    if quantity < food.quantity:
-        food.quantity -= quantity
-        message = f"已減少 {food_name} 的數量。剩餘數量: {food.quantity}"
-    else:
-        db.session.delete(food)
-        message = f"已刪除 {food_name}。"
+    existing = {}
+    for food in user_foods_query(user_id, names):
+        existing.setdefault(food.name, food)
+
+    messages = []
+    for food_name, quantity in food_list:
+        food = existing.get(food_name)
+        if not food:
+            messages.append("錯誤: 您的冰箱中沒有這種食品。")
+            continue
+
+        # 檢查刪除的數量是否有效
+        if quantity > food.quantity:
+            messages.append(f"錯誤: 你不能刪除超過現有數量的 {food_name}。目前數量: {food.quantity}")
+            continue
+
+        # 減少食品數量或刪除記錄
+        if quantity < food.quantity:
+            food.quantity -= quantity
+            messages.append(f"已減少 {food_name} 的數量。剩餘數量: {food.quantity}")
+        else:
+            db.session.delete(food)
+            del existing[food_name]
+            messages.append(f"已刪除 {food_name}。")
 
     db.session.commit()
-    return message
+    return messages
 
 def get_foods(user):
     """獲取用戶冰箱中的所有食物，並按有效期限排序"""
-    return Food.query.filter_by(user_id=user.id).order_by(Food.expiration_date).all()
+    return foods_query(user.id).all()
 
 def get_expiring_food(user_id):
     """查詢一天內即將到期的食物，包括數量，並格式化日期"""
-    now = datetime.now()
-    one_day_later = now + timedelta(days=1)
-
     # 查詢即將到期的食品
-    expiring_foods = Food.query.filter(
-        Food.user_id == user_id,
-        Food.expiration_date >= now,
-        Food.expiration_date <= one_day_later
-    ).all()
+    expiring_foods = expiring_foods_query(user_id, datetime.now()).all()
 
     # 生成食品名稱、數量及到期時間的列表，日期格式為 YYYY/MM/DD HH:MM
-    food_list = [f"{food.name}, 剩餘數量：{food.quantity} \n到期時間：{food.expiration_date.strftime('%Y/%m/%d %H:%M')}" for food in expiring_foods]
+    food_list = [format_expiring(food) for food in expiring_foods]
     return food_list
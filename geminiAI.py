@@ -1,62 +1,34 @@
 import os
-import base64
-import vertexai
-from vertexai.generative_models import GenerativeModel, Part
-import vertexai.preview.generative_models as generative_models
+import queue
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from types import SimpleNamespace
 from dotenv import load_dotenv
+from cache import ResponseCache
+from lazy import lazy
+from metrics import track
 
-def identify_food(image_base64):
-    
-    load_dotenv()
-    # 初始化 Vertex AI
-    project_id = os.getenv('PROJECT_ID')
-    location = os.getenv('LOCATION')
-    vertexai.init(project=project_id, location=location)
-    model = GenerativeModel("gemini-1.5-flash-001")
-
-    image = Part.from_data(
-        mime_type="image/jpeg",
-        data=image_base64
-    )
-
-    responses = model.generate_content(
-        ["""#zh-tw，請繁體中文說明，請辨識以下食物，我要將食物名稱與數量存進資料庫，例如: 蘋果 2 香蕉 5等等，如果是便當、湯麵之類的複合食物，只要告訴是哪種口味的，像是 雞腿便當 1 海鮮湯麵 1，如果沒有食物或是不是食物，請回傳 錯誤""", image],
-        generation_config=generation_config,
-        safety_settings=safety_settings,
-        stream=True,
-    )
+load_dotenv()
 
-    result = ""
-    for response in responses:
-        result += response.text
+GEMINI_MODEL = os.getenv('GEMINI_MODEL', 'gemini-1.5-flash-001')
+GEMINI_BACKEND = os.getenv('GEMINI_BACKEND', 'vertex')  # vertex 或 stub（離線測試用）
+GEMINI_MAX_CONCURRENCY = int(os.getenv('GEMINI_MAX_CONCURRENCY', 4))  # 同時進行的請求上限
+GEMINI_TIMEOUT = float(os.getenv('GEMINI_TIMEOUT', 30))  # 單次請求（含排隊）的秒數上限
+GEMINI_RETRIES = int(os.getenv('GEMINI_RETRIES', 2))  # 暫時性錯誤的重試次數
+GEMINI_BACKOFF = float(os.getenv('GEMINI_BACKOFF', 0.5))  # 第一次重試前等待的秒數，之後倍增
+GEMINI_STUB_LATENCY = float(os.getenv('GEMINI_STUB_LATENCY', 0))
+CHAT_CACHE_SIZE = int(os.getenv('CHAT_CACHE_SIZE', 1000))
+CHAT_CACHE_TTL = float(os.getenv('CHAT_CACHE_TTL', 86400))  # 聊天回答保留的秒數
+CHAT_CACHE_DB = os.getenv('CHAT_CACHE_DB')  # 設定後回答會同時存進這個 SQLite 檔案
+FOOD_OUTPUT = os.getenv('FOOD_OUTPUT', 'json')  # json：要求精簡的 JSON 清單並串流解析；text：舊的自由文字格式
+FOOD_MAX_OUTPUT_TOKENS = int(os.getenv('FOOD_MAX_OUTPUT_TOKENS', 256))  # 約可容納 20 項食品
+FOOD_TEMPERATURE = float(os.getenv('FOOD_TEMPERATURE', 0.1))  # 辨識不需要創意，低溫度讓格式穩定
 
-    return result.strip()
-
-def chat(msg):
-    
-    load_dotenv()
-    # 初始化 Vertex AI
-    project_id = os.getenv('PROJECT_ID')
-    location = os.getenv('LOCATION')
-    vertexai.init(project=project_id, location=location)
-    model = GenerativeModel("gemini-1.5-flash-001")
-    
-    responses = model.generate_content(
-        ["""#zh-tw，請繁體中文回答，你現在是可愛的智能冰箱小冰，以下是使用者問你的問題，請回答""", msg],
-        generation_config=generation_config,
-        safety_settings=safety_settings,
-        stream=True,
-    )
-
-    result = ""
-    for response in responses:
-        result += response.text
-
-    return result.strip()
-
-def read_image_as_base64(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+FOOD_PROMPT = """#zh-tw，請繁體中文說明，請辨識以下食物，我要將食物名稱與數量存進資料庫，例如: 蘋果 2 香蕉 5等等，如果是便當、湯麵之類的複合食物，只要告訴是哪種口味的，像是 雞腿便當 1 海鮮湯麵 1，如果沒有食物或是不是食物，請回傳 錯誤"""
+FOOD_JSON_PROMPT = """#zh-tw，請辨識圖片中的食物，以 JSON 陣列回傳繁體中文的食物名稱與數量，每一項為 {"name": 名稱, "quantity": 數量}，例如 [{"name": "蘋果", "quantity": 2}, {"name": "香蕉", "quantity": 5}]。便當、湯麵之類的複合食物只要寫出口味，例如 {"name": "雞腿便當", "quantity": 1}。沒有食物或不是食物時回傳 []，不要輸出其他文字"""
+CHAT_PROMPT = """#zh-tw，請繁體中文回答，你現在是可愛的智能冰箱小冰，以下是使用者問你的問題，請回答"""
 
 # 配置生成参数
 generation_config = {
@@ -65,13 +37,221 @@ generation_config = {
     "top_p": 0.95,
 }
 
-# 配置安全设置
-safety_settings = {
-    generative_models.HarmCategory.HARM_CATEGORY_HATE_SPEECH: generative_models.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
-    generative_models.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: generative_models.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
-    generative_models.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: generative_models.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
-    generative_models.HarmCategory.HARM_CATEGORY_HARASSMENT: generative_models.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
+# 食物辨識：輸出很短，限制 token 數並要求 JSON
+food_generation_config = {
+    "max_output_tokens": FOOD_MAX_OUTPUT_TOKENS,
+    "temperature": FOOD_TEMPERATURE,
+    "top_p": 0.95,
+    "response_mime_type": "application/json",
 }
 
+_END = object()  # 串流結束的標記
+
+# 可以重試的暫時性錯誤，使用 Vertex AI 時再加上 google.api_core 的例外
+RETRYABLE_ERRORS = (TimeoutError, ConnectionError)
+
+
+def _load_vertexai():
+    """匯入 Vertex AI SDK（約需數秒），只在第一次呼叫真正的模型時執行"""
+    import vertexai
+    from vertexai.generative_models import GenerativeModel, Part
+    import vertexai.preview.generative_models as generative_models
+    from google.api_core import exceptions as google_exceptions
+
+    # 配置安全设置
+    safety_settings = {
+        generative_models.HarmCategory.HARM_CATEGORY_HATE_SPEECH: generative_models.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
+        generative_models.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: generative_models.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
+        generative_models.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: generative_models.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
+        generative_models.HarmCategory.HARM_CATEGORY_HARASSMENT: generative_models.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
+    }
+    retryable_errors = (
+        google_exceptions.TooManyRequests,
+        google_exceptions.ResourceExhausted,
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.InternalServerError,
+        google_exceptions.DeadlineExceeded,
+    )
+    return SimpleNamespace(init=vertexai.init, GenerativeModel=GenerativeModel, Part=Part,
+                           safety_settings=safety_settings, retryable_errors=retryable_errors)
+
+
+vertex = lazy.register('vertexai', _load_vertexai)
+
+
+class StubModel:
+    """離線用的假模型，等待固定延遲後回傳固定內容，用來量測用戶端本身的額外開銷
+    要求 JSON 時回傳 json_reply；設定 chunk_size 時串流會分段送出，每段之間等待 chunk_latency 秒"""
+
+    def __init__(self, latency=GEMINI_STUB_LATENCY, reply="蘋果 2 香蕉 5",
+                 json_reply='[{"name": "蘋果", "quantity": 2}, {"name": "香蕉", "quantity": 5}]',
+                 chunk_size=None, chunk_latency=0.0):
+        self.latency = latency
+        self.reply = reply
+        self.json_reply = json_reply
+        self.chunk_size = chunk_size
+        self.chunk_latency = chunk_latency
+
+    def generate_content(self, contents, generation_config=None, safety_settings=None, stream=False):
+        if self.latency:
+            time.sleep(self.latency)
+        wants_json = (generation_config or {}).get('response_mime_type') == 'application/json'
+        text = self.json_reply if wants_json else self.reply
+        if not stream:
+            return SimpleNamespace(text=text)
+        return self._chunks(text)
 
+    def _chunks(self, text):
+        size = self.chunk_size or len(text) or 1
+        for i in range(0, len(text), size):
+            if i and self.chunk_latency:
+                time.sleep(self.chunk_latency)
+            yield SimpleNamespace(text=text[i:i + size])
 
+
+class GeminiClient:
+    """每個行程共用的 Gemini 用戶端：模型只初始化一次，並限制同時請求數、逾時與重試"""
+
+    def __init__(self, backend=GEMINI_BACKEND, max_concurrency=GEMINI_MAX_CONCURRENCY,
+                 timeout=GEMINI_TIMEOUT, retries=GEMINI_RETRIES, backoff=GEMINI_BACKOFF):
+        self.backend = backend
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.retryable_errors = RETRYABLE_ERRORS
+        self.safety_settings = None
+        self._model = None
+        self._init_lock = threading.Lock()
+        # 執行緒池的大小就是同時請求數的上限，超過的請求會排隊
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='gemini')
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self._init_lock:
+                if self._model is None:
+                    self._model = self._create_model()
+        return self._model
+
+    def _create_model(self):
+        if self.backend == 'stub':
+            return StubModel()
+        # 初始化 Vertex AI
+        vertex.init(project=os.getenv('PROJECT_ID'), location=os.getenv('LOCATION'))
+        self.retryable_errors = RETRYABLE_ERRORS + vertex.retryable_errors
+        self.safety_settings = vertex.safety_settings
+        return vertex.GenerativeModel(GEMINI_MODEL)
+
+    def part(self, data, mime_type):
+        """圖片等二進位內容；假模型不需要載入 Vertex AI"""
+        if self.backend == 'stub':
+            return SimpleNamespace(data=data, mime_type=mime_type)
+        return vertex.Part.from_data(mime_type=mime_type, data=data)
+
+    def generate(self, contents, config=None):
+        """送出請求並回傳完整文字，暫時性錯誤會以指數退避重試"""
+        model = self.model
+        with track('gemini'):  # 包含排隊與重試的時間
+            for attempt in range(self.retries + 1):
+                future = self._executor.submit(self._generate_once, model, contents, config or generation_config)
+                try:
+                    return future.result(timeout=self.timeout)
+                except FutureTimeoutError:
+                    future.cancel()
+                    error = TimeoutError(f"Gemini 超過 {self.timeout} 秒未回應")
+                except self.retryable_errors as e:
+                    error = e
+                if attempt < self.retries:
+                    time.sleep(self._backoff_delay(attempt))
+            raise error
+
+    def stream(self, contents, config=None):
+        """逐段產生回應文字，呼叫端可以邊收邊處理；還沒收到內容前的暫時性錯誤會重試，
+        已經交出部分內容後的錯誤直接丟出。逾時以整個回應計算"""
+        model = self.model
+        with track('gemini'):
+            for attempt in range(self.retries + 1):
+                chunks = queue.Queue()
+                cancelled = threading.Event()
+                deadline = time.monotonic() + self.timeout
+                self._executor.submit(self._stream_once, model, contents, config or generation_config, chunks, cancelled)
+                received = False
+                try:
+                    while True:
+                        chunk = chunks.get(timeout=max(0.0, deadline - time.monotonic()))
+                        if chunk is _END:
+                            return
+                        if isinstance(chunk, Exception):
+                            raise chunk
+                        received = True
+                        yield chunk
+                except queue.Empty:
+                    error = TimeoutError(f"Gemini 超過 {self.timeout} 秒未回應")
+                except self.retryable_errors as e:
+                    error = e
+                finally:
+                    cancelled.set()  # 逾時、出錯或呼叫端提早停止時，背景執行緒不再讀取剩下的回應
+                if received or attempt == self.retries:
+                    raise error
+                time.sleep(self._backoff_delay(attempt))
+
+    def _backoff_delay(self, attempt):
+        return self.backoff * (2 ** attempt) * (1 + random.random())
+
+    def _generate_once(self, model, contents, config):
+        responses = model.generate_content(
+            contents,
+            generation_config=config,
+            safety_settings=self.safety_settings,
+            stream=True,
+        )
+
+        result = ""
+        for response in responses:
+            result += response.text
+
+        return result.strip()
+
+    def _stream_once(self, model, contents, config, chunks, cancelled):
+        if cancelled.is_set():
+            return  # 排隊期間已經逾時
+        try:
+            responses = model.generate_content(
+                contents,
+                generation_config=config,
+                safety_settings=self.safety_settings,
+                stream=True,
+            )
+            for response in responses:
+                if cancelled.is_set():
+                    return
+                chunks.put(response.text)
+            chunks.put(_END)
+        except Exception as e:
+            chunks.put(e)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+client = GeminiClient()
+
+# 常見問題的回答快取，相同的問題不必再呼叫 Gemini
+chat_cache = ResponseCache(maxsize=CHAT_CACHE_SIZE, ttl=CHAT_CACHE_TTL, db_path=CHAT_CACHE_DB)
+
+
+def identify_food(image_bytes, mime_type="image/jpeg", output=FOOD_OUTPUT):
+    """串流辨識結果，回傳文字片段的迭代器；output 為 json 時內容是 [{"name", "quantity"}, ...]"""
+    image = client.part(image_bytes, mime_type)
+    if output == 'json':
+        return client.stream([FOOD_JSON_PROMPT, image], food_generation_config)
+    return client.stream([FOOD_PROMPT, image])
+
+def chat(msg):
+    cached = chat_cache.get(msg)
+    if cached is not None:
+        return cached
+    result = client.generate([CHAT_PROMPT, msg])
+    if result:
+        chat_cache.set(msg, result)
+    return result
@@ -0,0 +1,220 @@
+# image_pipeline.py - 圖片辨識流程：在記憶體中處理 LINE 圖片，相同或相近的照片重用先前的辨識結果
+import io
+import json
+import os
+import threading
+from collections import deque
+from dotenv import load_dotenv
+from cache import TTLCache, _MISSING
+from food_service import food_list
+from geminiAI import identify_food
+from lazy import lazy
+from metrics import food_recognitions
+
+load_dotenv()
+
+IMAGE_CACHE_SIZE = int(os.getenv('IMAGE_CACHE_SIZE', 512))
+IMAGE_CACHE_TTL = float(os.getenv('IMAGE_CACHE_TTL', 86400))
+IMAGE_HASH_DISTANCE = int(os.getenv('IMAGE_HASH_DISTANCE', 6))  # 64 位元雜湊中最多允許幾個位元不同
+IMAGE_MAX_EDGE = int(os.getenv('IMAGE_MAX_EDGE', 1024))  # 送去辨識前長邊縮到多少像素
+IMAGE_JPEG_QUALITY = int(os.getenv('IMAGE_JPEG_QUALITY', 85))
+FOOD_MAX_ITEMS = int(os.getenv('FOOD_MAX_ITEMS', 30))  # 一張照片最多加入幾項
+FOOD_MAX_QUANTITY = int(os.getenv('FOOD_MAX_QUANTITY', 99))
+
+Image = lazy.module('PIL.Image')
+ImageOps = lazy.module('PIL.ImageOps')
+
+
+def download_content(message_content):
+    """把 LINE 的圖片內容直接讀進記憶體"""
+    return b''.join(message_content.iter_content())
+
+
+def _dhash_image(image):
+    """計算 64 位元的差異雜湊（dHash），縮放或重新壓縮過的同一張照片雜湊會很接近"""
+    pixels = list(image.convert('L').resize((9, 8), Image.BILINEAR).getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value
+
+
+class ImageStats:
+    """記錄每張圖片處理前後的位元組數，用來調整縮圖大小與壓縮品質"""
+
+    def __init__(self, maxlen=1000):
+        self.recent = deque(maxlen=maxlen)  # (原始位元組數, 處理後位元組數)
+        self.count = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.rejected = 0  # 像素數超過 PIL 上限而拒絕的圖片
+        self._lock = threading.Lock()
+
+    def record(self, original, processed):
+        with self._lock:
+            self.recent.append((original, processed))
+            self.count += 1
+            self.bytes_in += original
+            self.bytes_out += processed
+
+    def reject(self):
+        with self._lock:
+            self.rejected += 1
+
+    def summary(self):
+        with self._lock:
+            ratio = self.bytes_out / self.bytes_in if self.bytes_in else 1.0
+            return {'count': self.count, 'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out, 'ratio': ratio,
+                    'rejected': self.rejected}
+
+
+image_stats = ImageStats()
+
+
+def prepare_image(image_bytes, max_edge=IMAGE_MAX_EDGE, quality=IMAGE_JPEG_QUALITY):
+    """縮小圖片、去除 EXIF 等中繼資料並重新壓縮成 JPEG，回傳 (JPEG 位元組, 感知雜湊)
+    無法解碼的內容原樣回傳，雜湊為 None；像素數超過上限的圖片（解壓縮炸彈）回傳 (None, None)"""
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            image.draft('RGB', (max_edge, max_edge))  # JPEG 解碼時直接縮小，省下記憶體與時間
+            image = ImageOps.exif_transpose(image)  # 先依照 EXIF 方向轉正，之後 EXIF 會被丟棄
+            image_hash = _dhash_image(image)
+            image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+            output = io.BytesIO()
+            image.convert('RGB').save(output, 'JPEG', quality=quality, optimize=True)
+    except Image.DecompressionBombError:
+        image_stats.reject()
+        return None, None
+    except (OSError, ValueError):
+        return image_bytes, None
+    processed = output.getvalue()
+    image_stats.record(len(image_bytes), len(processed))
+    return processed, image_hash
+
+
+class ImageResultCache(TTLCache):
+    """以感知雜湊為鍵的辨識結果快取，漢明距離在門檻內的照片視為同一張"""
+
+    def find(self, image_hash, max_distance=IMAGE_HASH_DISTANCE):
+        """找出最接近的已辨識照片，回傳其辨識結果或 None"""
+        value = self._get(image_hash)
+        if value is _MISSING:
+            with self._lock:
+                best = None
+                for key in self._data:
+                    distance = (key ^ image_hash).bit_count()
+                    if distance <= max_distance and (best is None or distance < best[0]):
+                        best = (distance, key)
+            if best is not None:
+                value = self._get(best[1])
+        self._count(value is not _MISSING)
+        return None if value is _MISSING else value
+
+
+image_cache = ImageResultCache(maxsize=IMAGE_CACHE_SIZE, ttl=IMAGE_CACHE_TTL)
+
+
+def food_item(value):
+    """把模型輸出的 {"name", "quantity"} 轉成 (名稱, 數量)，格式不對時回傳 None"""
+    if not isinstance(value, dict):
+        return None
+    name = str(value.get('name') or '').strip()
+    if not name or name == '錯誤':
+        return None
+    try:
+        quantity = int(float(value.get('quantity', 1)))
+    except (TypeError, ValueError):
+        quantity = 1
+    return name, min(max(quantity, 1), FOOD_MAX_QUANTITY)
+
+
+class FoodStreamParser:
+    """從串流的 JSON 回應中逐一取出食物，每個 {...} 一完整就能使用，不必等整個回應結束
+    模型沒有照格式回答時，finish() 改用文字格式（蘋果 2 香蕉 5）解析"""
+
+    def __init__(self, max_items=FOOD_MAX_ITEMS):
+        self.max_items = max_items
+        self.items = []
+        self.text = ''
+        self._pos = 0  # 還沒檢查過的位置
+
+    @property
+    def full(self):
+        return len(self.items) >= self.max_items
+
+    def feed(self, chunk):
+        """加入一段回應，回傳因此完整的 (名稱, 數量) 列表"""
+        self.text += chunk
+        found = []
+        while not self.full:
+            end = self.text.find('}', self._pos)
+            if end < 0:
+                break
+            # 食物物件沒有巢狀結構，取 } 之前最近的 {，外層若包了一層物件也能處理
+            start = self.text.rfind('{', self._pos, end)
+            self._pos = end + 1
+            if start < 0:
+                continue
+            try:
+                item = food_item(json.loads(self.text[start:end + 1]))
+            except ValueError:
+                continue
+            if item:
+                self.items.append(item)
+                found.append(item)
+        return found
+
+    def finish(self):
+        """回應結束後呼叫，回傳 (所有項目, 解析方式)，解析方式為 json、text 或 empty"""
+        if self.items:
+            return self.items, 'json'
+        text = self.text.strip()
+        try:
+            json.loads(text)
+            return [], 'empty'  # 合法的 JSON 但沒有食物，例如 []
+        except ValueError:
+            pass
+        text = text.strip('`').strip()  # 有時會包在 ``` 程式碼區塊裡
+        if not text or text == '錯誤' or text.startswith(('[', '{', 'json')):
+            return [], 'empty'
+        self.items = food_list(text.split())[:self.max_items]
+        return self.items, 'text'
+
+
+def stream_food_items(image_bytes, mime_type="image/jpeg"):
+    """辨識圖片中的食物，每解析出一項就產生一個 (名稱, 數量)；回應不是 JSON 時在最後一次產生文字解析的結果"""
+    parser = FoodStreamParser()
+    chunks = identify_food(image_bytes, mime_type)
+    try:
+        for chunk in chunks:
+            yield from parser.feed(chunk)
+            if parser.full:
+                break  # 已達上限，不再讀取剩下的回應
+    finally:
+        chunks.close()
+    count = len(parser.items)
+    items, result = parser.finish()
+    food_recognitions.inc(result=result)
+    yield from items[count:]
+
+
+def recognize_food(image_bytes, mime_type="image/jpeg"):
+    """縮小並重新壓縮圖片後辨識其中的食物，回傳 (名稱, 數量) 列表，沒有辨識到食物時為空列表
+    相同或相近的照片直接使用先前的結果
+
+    這裡會等串流結束才回傳：LINE 的回覆只有一則訊息，保質期查詢在記憶體中、寫入也是一個交易，逐項處理不會更快。
+    機器人得到的好處是輸出 token 上限，以及達到 FOOD_MAX_ITEMS 時提早結束；逐項產生的時間只在 benchmark.py 量測"""
+    processed, image_hash = prepare_image(image_bytes)
+    if processed is None:
+        return []
+    if image_hash is not None:
+        cached = image_cache.find(image_hash)
+        if cached is not None:
+            return cached
+        mime_type = "image/jpeg"
+
+    items = list(stream_food_items(processed, mime_type))
+    if image_hash is not None and items:
+        image_cache.set(image_hash, items)
+    return items
@@ -0,0 +1,89 @@
+# lazy.py - 延遲載入：龐大的套件與外部服務 client 在第一次使用時才匯入或建立，縮短每個 worker 的啟動時間
+import importlib
+import os
+import threading
+import time
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# 以逗號分隔的項目名稱，例如 matplotlib,vertexai；啟動後在背景先載入，第一位使用者就不必等待
+LAZY_PRELOAD = [name.strip() for name in os.getenv('LAZY_PRELOAD', '').split(',') if name.strip()]
+
+_MISSING = object()
+
+
+class LazyProxy:
+    """代替尚未載入的物件，第一次存取屬性時才載入，之後的存取轉給真正的物件"""
+
+    __slots__ = ('_registry', '_name')
+
+    def __init__(self, registry, name):
+        self._registry = registry
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(self._registry.get(self._name), attr)
+
+    def __repr__(self):
+        state = 'loaded' if self._registry.loaded(self._name) else 'not loaded'
+        return f"<lazy {self._name} ({state})>"
+
+
+class LazyRegistry:
+    """名稱 -> 工廠函式，第一次 get() 時才呼叫工廠，之後都回傳同一個物件，並記錄每一項的載入秒數"""
+
+    def __init__(self):
+        self.load_seconds = {}
+        self._factories = {}
+        self._values = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, factory):
+        """登記工廠並回傳代理物件；同名時以後登記的為準"""
+        with self._lock:
+            self._factories[name] = factory
+            self._locks.setdefault(name, threading.Lock())
+            self._values.pop(name, None)
+        return LazyProxy(self, name)
+
+    def module(self, name):
+        """延遲匯入的模組，多個檔案登記同一個模組時共用"""
+        with self._lock:
+            registered = name in self._factories
+        if registered:
+            return LazyProxy(self, name)
+        return self.register(name, lambda: importlib.import_module(name))
+
+    def get(self, name):
+        value = self._values.get(name, _MISSING)
+        if value is not _MISSING:
+            return value
+        with self._locks[name]:  # 只有等待同一項的執行緒會被擋住
+            value = self._values.get(name, _MISSING)
+            if value is _MISSING:
+                start = time.perf_counter()
+                value = self._factories[name]()
+                self.load_seconds[name] = time.perf_counter() - start
+                self._values[name] = value
+        return value
+
+    def loaded(self, name):
+        return name in self._values
+
+    def preload(self, names):
+        """在背景執行緒依序載入，失敗時只印出錯誤，真正使用時會再試一次"""
+        def run():
+            for name in names:
+                try:
+                    self.get(name)
+                except Exception as e:
+                    print(f"預先載入 {name} 時出錯：{e}")
+
+        thread = threading.Thread(target=run, name='lazy-preload', daemon=True)
+        thread.start()
+        return thread
+
+
+lazy = LazyRegistry()
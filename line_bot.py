@@ -1,45 +1,95 @@
-import googlemaps
 import json
 import os
-import matplotlib
-import matplotlib.pyplot as plt
 from linebot.models import TextSendMessage   
-from linebot import LineBotApi, WebhookHandler
-from linebot.models import *
-from models import User, SensorData, ESP32Device, db
-from food_service import add_food, get_foods, get_expiring_food, remove_food
-from geminiAI import identify_food, read_image_as_base64, chat
+from linebot import WebhookHandler
+from linebot.webhook import SignatureValidator
+from line_client import create_line_bot_api, send_texts
+from linebot.models import (ButtonsTemplate, CarouselColumn, CarouselTemplate, ImageSendMessage, MessageAction,
+                            MessageTemplateAction, QuickReply, QuickReplyButton, TemplateSendMessage,
+                            URITemplateAction)
+from lazy import lazy
+from models import device_query
+from users import get_user, create_user, set_esp32_id
+from food_service import add_foods, get_foods, get_expiring_food, remove_foods, food_list
+from geminiAI import chat
+from image_pipeline import download_content, recognize_food
 from cook_keyword import CookKeyword
+from sensor_buffer import latest_readings, load_latest_reading
+from sensor_monitor import TEMPERATURE_LIMIT, HUMIDITY_LIMIT
+from sensor_chart import sensor_chart, chart_days
+from sensor_history import device_token
+from places import places_cache
+from metrics import command_seconds, command_errors
+from table_renderer import table_renderer
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
-import matplotlib.font_manager as fm
 
 load_dotenv()  # 加載 .env 文件中的環境變量
 
-line_bot_api = LineBotApi(os.getenv('LINE_CHANNEL_ACCESS_TOKEN'))
+line_bot_api = lazy.register('line_bot_api', lambda: create_line_bot_api(os.getenv('LINE_CHANNEL_ACCESS_TOKEN')))  # 共用連線池並自動重試，第一次呼叫時才建立
 handler = WebhookHandler(os.getenv('LINE_CHANNEL_SECRET'))
-gmaps = googlemaps.Client(key=os.getenv('PLACE_API_KEY'))
+signature_validator = SignatureValidator(os.getenv('LINE_CHANNEL_SECRET'))
+PUBLIC_BASE_URL = os.getenv('PUBLIC_BASE_URL', 'https://1e3c-2401-e180-88a0-121f-f07f-6413-8366-17b7.ngrok-free.app')  # LINE 下載圖片用的對外網址
+
+def verify_signature(body, signature):
+    """驗證 X-Line-Signature 是否由 LINE 簽發"""
+    return signature_validator.validate(body, signature)
+
+def parse_events(body):
+    """取出 webhook 內容中的所有事件"""
+    return json.loads(body).get('events', [])
 
 def handle_line_bot(body, signature):
-    """處理來自 LINE BOT 的請求"""
-    json_data = json.loads(body)
-    tk = json_data['events'][0]['replyToken']
-    type = json_data['events'][0]['message']['type']
-    user_id = json_data['events'][0]['source']['userId']
-    user_name = line_bot_api.get_profile(user_id).display_name
+    """處理來自 LINE BOT 的請求（同步處理所有事件）"""
+    for event in parse_events(body):
+        handle_event(event)
+
+# 指標中以這些名稱區分指令，聊天內容本身不會成為標籤
+COMMANDS = ("食物管理", "刪除食物", "查詢即期品", "看看冰箱", "查看庫存", "冰箱現況", "查詢食譜",
+            "文字輸入新增食物", "功能介紹", "圖片辨識新增食物", "溫溼度紀錄")
+PREFIX_COMMANDS = ("刪除 ", "新增 ", "設定 ", "查詢 ", "溫溼度紀錄 ")
+
+def command_name(event):
+    """事件對應的指令名稱，其他文字訊息都算聊天"""
+    message = event.get('message') or {}
+    if message.get('type') != 'text':
+        return message.get('type') or event.get('type', 'unknown')
+    text = message.get('text', '')
+    if text in COMMANDS:
+        return text
+    for prefix in PREFIX_COMMANDS:
+        if text.startswith(prefix):
+            return prefix.strip()
+    return 'chat'
+
+def handle_event(event):
+    """處理單一 LINE 事件，並記錄各指令的處理時間與錯誤"""
+    command = command_name(event)
+    try:
+        with command_seconds.time(command=command):
+            _handle_event(event)
+    except Exception:
+        command_errors.inc(command=command)
+        raise
 
-    # 檢查用戶是否存在
-    user = User.query.filter_by(line_id=user_id).first()
+def _handle_event(event):
+    if event.get('type') != 'message' or 'replyToken' not in event:
+        return  # 只處理使用者傳來的訊息，追蹤、封鎖等事件略過
+    tk = event['replyToken']
+    type = event['message']['type']
+    user_id = event['source']['userId']
+
+    # 檢查用戶是否存在，一般訊息由快取取得
+    user = get_user(user_id)
     if not user:
-        # 新增用戶
-        new_user = User(name=user_name, line_id=user_id)
-        db.session.add(new_user)
-        db.session.commit()
+        # 新增用戶，只有第一次互動才需要向 LINE 取得個人資料
+        user_name = line_bot_api.get_profile(user_id).display_name
+        create_user(user_id, user_name)
         line_bot_api.reply_message(tk, TextSendMessage(text=f"Hello {user_name}, 您的虛擬冰箱剛建立完成，請重新選擇功能！"))
         return
     
     if type == 'text':
-        msg = json_data['events'][0]['message']['text']
+        msg = event['message']['text']
         if msg == "食物管理":
             reply_message = []
             reply_message.append(
@@ -73,13 +123,9 @@ def handle_line_bot(body, signature):
             reply_message = TextSendMessage(text="請輸入: 刪除 食物名稱 數量（數量為選填）")
         elif msg.startswith("刪除 "):
             parts = msg[3:].split()
-            foods = food_list(parts)
             try:
                 foods = food_list(parts)
-                reply_texts = []
-                for food_name, quantity in foods:
-                    result = remove_food(food_name, user.id, quantity)
-                    reply_texts.append(result)
+                reply_texts = remove_foods(foods, user.id)
                 reply_message = TextSendMessage(text="\n".join(reply_texts))
             except ValueError as e:
                 reply_message = TextSendMessage(text="格式錯誤，請輸入: 刪除 食物名稱 數量（數量為選填）")
@@ -109,6 +155,10 @@ def handle_line_bot(body, signature):
                                 label='查看庫存',
                                 text='查看庫存',
                             ),
+                            MessageTemplateAction(
+                                label='溫溼度紀錄',
+                                text='溫溼度紀錄',
+                            ),
                         ]
                     )
                 )
@@ -116,31 +166,11 @@ def handle_line_bot(body, signature):
         elif msg == "查看庫存":
             foods = get_foods(user)
             if foods:
-                matplotlib.rc('font', family='Microsoft JhengHei')
-                fig, ax = plt.subplots(figsize=(10, len(foods) * 0.6 + 2)) 
-                ax.axis('tight')
-                ax.axis('off')
-                
-                table_data = [["名稱", "數量", "有效期限"]]
-                for food in foods:
-                    table_data.append([food.name, food.quantity, food.expiration_date.strftime("%Y-%m-%d")])
-                
-                table = ax.table(cellText=table_data, cellLoc='center', loc='center', cellColours=[['#f5f5f5']*3]*len(table_data))
-                table.auto_set_font_size(False)
-                table.set_fontsize(16)
-                table.scale(1, 2)
-                
-                for i in range(len(table_data)):
-                    for j in range(3):
-                        cell = table[(i, j)]
-                        cell.set_edgecolor('#000000')  # 邊框顏色
-                        cell.set_linewidth(0.5)  # 邊框寬度
-                        cell.set_facecolor('#e0f7fa' if i == 0 else '#ffffff')  # 頭部背景色 & 行背景色
-                        cell.set_text_props(weight='bold' if i == 0 else 'normal')  # 字體樣式
-
-                plt.savefig('tmp/fridge.png')
+                # 每位使用者的圖片以庫存內容命名，庫存沒變就直接使用先前的圖片
+                rows = [(food.name, food.quantity, food.expiration_date.strftime("%Y-%m-%d")) for food in foods]
+                filename = table_renderer.render_inventory(user.id, rows)
 
-                image_url = 'https://1e3c-2401-e180-88a0-121f-f07f-6413-8366-17b7.ngrok-free.app/tmp/fridge.png'
+                image_url = f'{PUBLIC_BASE_URL}/tmp/{filename}'
                 reply_message = ImageSendMessage(
                     original_content_url=image_url,
                     preview_image_url=image_url
@@ -148,23 +178,25 @@ def handle_line_bot(body, signature):
             else:
                 reply_message = TextSendMessage(text="你的冰箱裡沒有食物。")
         elif msg == "冰箱現況":
-            esp32 = ESP32Device.query.filter_by(esp32_id=user.esp32_id).first()
+            # 先看記憶體中的最新讀數，快取未命中才查資料庫
+            reading = latest_readings.get(user.esp32_id) if user.esp32_id is not None else None
             if user.esp32_id is None:
                 reply_message = TextSendMessage(text="您還没有設置感應器ID，請查看機器上的id來連接，請輸入: 設定 123456")
-            elif not esp32:
+            elif reading is None and not device_query(user.esp32_id).first():
                 reply_message = TextSendMessage(text="感應器ID設定錯誤，請查看機器上的id來重新連接，請輸入: 設定 123456")
             else:
-                sensor_data = SensorData.query.filter_by(esp32_id=user.esp32_id).order_by(SensorData.timestamp.desc()).first()
-                if sensor_data:
+                if reading is None:
+                    reading = load_latest_reading(user.esp32_id)
+                if reading:
                     now = datetime.utcnow()
-                    if now - sensor_data.timestamp < timedelta(minutes=10):
-                        temperature = sensor_data.temperature
-                        humidity = sensor_data.humidity
+                    if now - reading['timestamp'] < timedelta(minutes=10):
+                        temperature = reading['temperature']
+                        humidity = reading['humidity']
                         alert_messages = []
-                        if temperature > 7:
-                            alert_messages.append("您的冰箱溫度異常，正常應該是7度以下")
-                        if humidity > 78:
-                            alert_messages.append("您的冰箱濕度異常，正常應該是78%以下")
+                        if temperature > TEMPERATURE_LIMIT:
+                            alert_messages.append(f"您的冰箱溫度異常，正常應該是{TEMPERATURE_LIMIT}度以下")
+                        if humidity > HUMIDITY_LIMIT:
+                            alert_messages.append(f"您的冰箱濕度異常，正常應該是{HUMIDITY_LIMIT}%以下")
                         if alert_messages:
                             alert_text = "，".join(alert_messages)
                             reply_message = TextSendMessage(
@@ -180,15 +212,36 @@ def handle_line_bot(body, signature):
                         )
                 else:
                     reply_message = TextSendMessage(text="目前没有檢測到冰箱到溫溼度數據。請確認您的感應器是否已正确連接。")
+        elif msg == "溫溼度紀錄" or msg.startswith("溫溼度紀錄 "):
+            # 預設顯示一天，可輸入天數，例如：溫溼度紀錄 7
+            days = msg[6:].strip()
+            if user.esp32_id is None:
+                reply_message = TextSendMessage(text="您還没有設置感應器ID，請查看機器上的id來連接，請輸入: 設定 123456")
+            elif days and not days.isdigit():
+                reply_message = TextSendMessage(text="格式錯誤，請輸入: 溫溼度紀錄 天數，例如：溫溼度紀錄 7")
+            else:
+                filename = sensor_chart.render(user.esp32_id, chart_days(int(days or 1)))
+                if filename is None:
+                    reply_message = TextSendMessage(text="這段時間沒有檢測到冰箱的溫溼度數據。")
+                else:
+                    image_url = f'{PUBLIC_BASE_URL}/tmp/{filename}'
+                    reply_message = ImageSendMessage(
+                        original_content_url=image_url,
+                        preview_image_url=image_url,
+                        quick_reply=QuickReply(items=[
+                            QuickReplyButton(action=MessageAction(label=f"{n} 天", text=f"溫溼度紀錄 {n}"))
+                            for n in (1, 7, 30, 90)
+                        ])
+                    )
         elif msg.startswith("設定 "):
             esp32_id = msg[3:]
-            esp32 = ESP32Device.query.filter_by(esp32_id=esp32_id).first()
+            esp32 = device_query(esp32_id).first()
             if not esp32:
                 reply_message = TextSendMessage(text=f"找不到這個感應器ID，請重新確認。")
             else:
-                user.esp32_id = esp32_id
-                db.session.commit()
-                reply_message = TextSendMessage(text=f"感應器ID 已設為 {esp32_id}")
+                user = set_esp32_id(user, esp32_id)
+                reply_message = TextSendMessage(
+                    text=f"感應器ID 已設為 {esp32_id}\n查詢溫溼度歷史資料的金鑰：{device_token(esp32_id)}")
         elif msg == "查詢食譜":
             foods = get_foods(user)
             if foods:
@@ -207,10 +260,7 @@ def handle_line_bot(body, signature):
             parts = msg[3:].split()
             try:
                 foods = food_list(parts)
-                reply_texts = []
-                for food_name, quantity in foods:
-                    result = add_food(food_name, user.id, quantity)
-                    reply_texts.append(result)
+                reply_texts = add_foods(foods, user.id)
                 reply_message = TextSendMessage(text="\n".join(reply_texts))
             except ValueError as e:
                 reply_message = TextSendMessage(text="格式錯誤，請輸入: 新增 食物名稱 數量（數量為選填）")
@@ -251,34 +301,25 @@ def handle_line_bot(body, signature):
                 reply_message = TextSendMessage(text=f"小冰不懂你的問題，請重新試試看")
     elif type == 'image':
         # 下載圖片
-        message_id = json_data['events'][0]['message']['id']
+        message_id = event['message']['id']
         message_content = line_bot_api.get_message_content(message_id)
-        image_path = f'tmp/image.jpg'
-        with open(image_path, 'wb') as fd:
-            for chunk in message_content.iter_content():
-                fd.write(chunk)
+        image_data = download_content(message_content)
         
-        # 調用 Gemini API 進行圖片辨識
-        image_data_base64 = read_image_as_base64(image_path)
-        food_name = identify_food(image_data_base64)
-
-        #print(food_name)
-        if (food_name != '錯誤'):
-            foods = food_list(food_name.split())
-            reply_texts = []
-            for food_name, quantity in foods:
-                result = add_food(food_name, user.id, quantity)
-                reply_texts.append(result)
+        # 調用 Gemini API 進行圖片辨識，相同的照片直接使用先前的結果；回覆只有一則，辨識完再一次新增所有食物
+        foods = recognize_food(image_data, message_content.content_type or "image/jpeg")
+        if foods:
+            reply_texts = add_foods(foods, user.id)
             reply_message = TextSendMessage(text="\n".join(reply_texts))
         else:
             reply_message = TextSendMessage(text=f"無法辨識到食物，請重傳")
     elif type == 'location':
-        lat = json_data['events'][0]['message']['latitude']
-        long = json_data['events'][0]['message']['longitude']
-        places_result = gmaps.places_nearby(location=(lat, long), radius=1000, type='restaurant')
-        if places_result['results']:
+        lat = event['message']['latitude']
+        long = event['message']['longitude']
+        # 同一個 geohash 格子內的位置共用快取的查詢結果
+        places = places_cache.nearby_restaurants(lat, long)
+        if places:
             columns = []
-            for place in places_result['results'][:10]:
+            for place in places:
                 photo_reference = place.get('photos', [{}])[0].get('photo_reference', '')
                 photo_url = f"https://maps.googleapis.com/maps/api/place/photo?maxwidth=400&photoreference={photo_reference}&key={os.getenv('PLACE_API_KEY')}" if photo_reference else ''
                 column = CarouselColumn(
@@ -307,20 +348,6 @@ def handle_line_bot(body, signature):
     
     line_bot_api.reply_message(tk, reply_message)
 
-def food_list(parts):
-    foods = []
-    i = 0
-    while i < len(parts):
-        if i < len(parts) - 1 and parts[i+1].isdigit():
-            # 當前部分是食物名稱，下一部分是數量
-            food_name = parts[i]
-            quantity = int(parts[i+1])
-            i += 2  # 跳過名稱和數量
-        else:
-            # 當前部分是食物名稱，數量為預設值1
-            food_name = parts[i]
-            quantity = 1
-            i += 1  # 跳過名稱
-        
-        foods.append((food_name, quantity))
-    return foods
+def push_texts(messages):
+    """主動推播文字訊息，messages 為 {line_id: 文字}，相同內容合併成 multicast，回傳推播失敗的 line_id"""
+    return send_texts(line_bot_api, messages)
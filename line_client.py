@@ -0,0 +1,167 @@
+# line_client.py - LINE Messaging API 的連線層：共用連線池、逾時、429/5xx 重試，統計延遲與錯誤，並合併相同內容的推播
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+from linebot import LineBotApi
+from linebot.exceptions import LineBotApiError
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
+from linebot.models import TextSendMessage
+from metrics import dependency_seconds, dependency_errors
+
+load_dotenv()
+
+LINE_API_ENDPOINT = os.getenv('LINE_API_ENDPOINT', 'https://api.line.me')  # 測試時可指向 fake_services 的假伺服器
+LINE_API_DATA_ENDPOINT = os.getenv('LINE_API_DATA_ENDPOINT', 'https://api-data.line.me')
+LINE_CONNECT_TIMEOUT = float(os.getenv('LINE_CONNECT_TIMEOUT', 3))
+LINE_READ_TIMEOUT = float(os.getenv('LINE_READ_TIMEOUT', 10))
+LINE_POOL_SIZE = int(os.getenv('LINE_POOL_SIZE', 20))  # 與 WEBHOOK_WORKERS、推播執行緒數相當即可
+LINE_RETRIES = int(os.getenv('LINE_RETRIES', 3))
+LINE_BACKOFF = float(os.getenv('LINE_BACKOFF', 0.5))  # 第一次重試前的平均等待秒數，之後加倍
+LINE_MULTICAST_SIZE = int(os.getenv('LINE_MULTICAST_SIZE', 500))  # 每次 multicast 的收件人上限
+LINE_PUSH_WORKERS = int(os.getenv('LINE_PUSH_WORKERS', 8))  # 內容不同的推播同時送出的數量
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+RETRY_KEY_PATHS = ('/message/push', '/message/multicast')  # 重試時以 X-Line-Retry-Key 避免重複送達
+ID_SEGMENT = re.compile(r'/(?:[UCR][0-9a-f]{32}|\d+)(?=/|$)')
+
+
+def endpoint_name(url):
+    """統計用的端點名稱，去掉使用者與訊息 ID，例如 /v2/bot/profile/{id}"""
+    return ID_SEGMENT.sub('/{id}', urlparse(url).path)
+
+
+class LineStats:
+    """依端點記錄呼叫次數、重試、錯誤與延遲"""
+
+    def __init__(self):
+        self._endpoints = {}  # 端點 -> [呼叫, 重試, 錯誤, 總延遲, 最大延遲]
+        self._lock = threading.Lock()
+
+    def record(self, name, elapsed, retried=False, error=False):
+        with self._lock:
+            entry = self._endpoints.setdefault(name, [0, 0, 0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += retried
+            entry[2] += error
+            entry[3] += elapsed
+            entry[4] = max(entry[4], elapsed)
+        dependency_seconds.observe(elapsed, dependency='line')
+        if error:
+            dependency_errors.inc(dependency='line')
+
+    def summary(self):
+        with self._lock:
+            return {
+                name: {'calls': calls, 'retries': retries, 'errors': errors,
+                       'avg_ms': total / calls * 1000, 'max_ms': slowest * 1000}
+                for name, (calls, retries, errors, total, slowest) in self._endpoints.items()
+            }
+
+
+line_stats = LineStats()
+
+
+class PooledHttpClient(RequestsHttpClient):
+    """LineBotApi 用的 HTTP client：以 keep-alive 連線池取代每次新建連線，遇到 429/5xx 或連線錯誤時以隨機退避重試"""
+
+    def __init__(self, timeout=(LINE_CONNECT_TIMEOUT, LINE_READ_TIMEOUT), pool_size=LINE_POOL_SIZE,
+                 retries=LINE_RETRIES, backoff=LINE_BACKOFF, stats=line_stats):
+        super().__init__(timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.stats = stats
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)  # api 與 api-data 兩個主機
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        return self._request('GET', url, headers=headers, params=params, stream=stream, timeout=timeout)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        return self._request('POST', url, headers=headers, data=data, timeout=timeout)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        return self._request('DELETE', url, headers=headers, data=data, timeout=timeout)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        return self._request('PUT', url, headers=headers, data=data, timeout=timeout)
+
+    def _delay(self, attempt, response=None):
+        if response is not None and response.status_code == 429:
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                return float(retry_after)
+        return self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)  # 加上抖動，避免所有執行緒同時重試
+
+    def _request(self, method, url, headers=None, timeout=None, **kwargs):
+        headers = dict(headers or {})
+        if method == 'POST' and urlparse(url).path.endswith(RETRY_KEY_PATHS):
+            headers.setdefault('X-Line-Retry-Key', str(uuid.uuid4()))
+        name = endpoint_name(url)
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            start = time.monotonic()
+            try:
+                response = self.session.request(method, url, headers=headers, timeout=timeout or self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self.stats.record(name, time.monotonic() - start, retried=not last, error=True)
+                if last:
+                    raise
+                time.sleep(self._delay(attempt))
+                continue
+
+            status = response.status_code
+            if attempt and status == 409 and 'X-Line-Accepted-Request-Id' in response.headers:
+                response.status_code = 200  # 先前的嘗試其實已經送達
+            elif status in RETRY_STATUS and not last:
+                self.stats.record(name, time.monotonic() - start, retried=True, error=True)
+                response.close()
+                time.sleep(self._delay(attempt, response))
+                continue
+            self.stats.record(name, time.monotonic() - start, error=response.status_code >= 400)
+            return RequestsHttpResponse(response)
+
+
+def create_line_bot_api(channel_access_token):
+    """建立使用共用連線池的 LineBotApi"""
+    return LineBotApi(channel_access_token, endpoint=LINE_API_ENDPOINT, data_endpoint=LINE_API_DATA_ENDPOINT,
+                      timeout=(LINE_CONNECT_TIMEOUT, LINE_READ_TIMEOUT), http_client=PooledHttpClient)
+
+
+def send_texts(api, messages, multicast_size=LINE_MULTICAST_SIZE, workers=LINE_PUSH_WORKERS):
+    """推播 {line_id: 文字}：內容相同的收件人合併成 multicast，其餘的 push 並行送出，回傳推播失敗的 line_id 列表"""
+    recipients = {}
+    for line_id, text in messages.items():
+        recipients.setdefault(text, []).append(line_id)
+
+    calls = []
+    for text, line_ids in recipients.items():
+        if len(line_ids) == 1:
+            calls.append((api.push_message, line_ids[0], text))
+            continue
+        for i in range(0, len(line_ids), multicast_size):
+            calls.append((api.multicast, line_ids[i:i + multicast_size], text))
+    if not calls:
+        return []
+
+    def send(call):
+        method, to, text = call
+        try:
+            method(to, TextSendMessage(text=text))
+        except (LineBotApiError, requests.RequestException) as e:
+            # 一位使用者失敗（例如封鎖了帳號）不影響其他人
+            print(f"推播訊息時出錯：{e}")
+            return [to] if isinstance(to, str) else list(to)
+        return []
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(calls)), thread_name_prefix='line-push') as pool:
+        return [line_id for failed in pool.map(send, calls) for line_id in failed]
@@ -0,0 +1,277 @@
+# loadtest.py - 離線負載測試：以本機假服務取代 LINE、icook、Google Places 與 Gemini，量測每個情境的延遲與吞吐量
+# 用法: python loadtest.py                         執行所有情境
+#       python loadtest.py post_data 查看庫存       只執行指定的情境
+#       python loadtest.py --save                  把結果存成基準線
+#       python loadtest.py --compare               與基準線比較，p99 或吞吐量退步超過門檻時回傳 1
+import argparse
+import base64
+import glob
+import hashlib
+import hmac
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+BASELINE_PATH = 'loadtest_baseline.json'
+CHANNEL_SECRET = 'loadtest-secret'
+DEVICE_ID = '123456'  # init_db 建立的感應器
+
+# 每個 LINE 情境的訊息產生器，i 為第幾個請求；文字會變化，避免全部命中快取
+TEXT_SCENARIOS = {
+    '查看庫存': lambda i: '查看庫存',
+    '新增': lambda i: f"新增 {random.choice(['蘋果', '香蕉', '牛奶', '雞蛋', '番茄'])} {random.randint(1, 3)}",
+    '查詢即期品': lambda i: '查詢即期品',
+    '冰箱現況': lambda i: '冰箱現況',
+    '查詢食譜': lambda i: f"查詢 {random.choice(['蘋果', '香蕉', '牛奶', '雞蛋', '番茄', '豆腐', '高麗菜', '雞肉'])}",
+    'chat': lambda i: f"小冰 今天晚餐吃什麼好 {i}",
+}
+SCENARIOS = ['post_data', 'webhook_ack'] + list(TEXT_SCENARIOS) + ['image', 'location']
+
+
+def start_fakes(args):
+    """啟動假服務並設定環境變數，必須在匯入 app 之前呼叫"""
+    from fake_services import start_fake_line, start_fake_icook, start_fake_places, FakeLineHandler
+
+    images = sorted(glob.glob('static/images/example/*.jpg'))
+    if images:
+        with open(images[0], 'rb') as f:
+            FakeLineHandler.image = f.read()  # 下載圖片時回傳真的照片，讓縮圖與雜湊照常執行
+
+    line = start_fake_line(latency=args.line_latency)
+    icook = start_fake_icook(latency=args.icook_latency)
+    places = start_fake_places(latency=args.places_latency)
+    workdir = tempfile.mkdtemp(prefix='loadtest-')
+    os.makedirs(os.path.join(workdir, 'tmp'))
+    os.environ.update({
+        'LINE_CHANNEL_ACCESS_TOKEN': 'loadtest-token',
+        'LINE_CHANNEL_SECRET': CHANNEL_SECRET,
+        'LINE_API_ENDPOINT': line.url,
+        'LINE_API_DATA_ENDPOINT': line.url,
+        'LINE_BACKOFF': '0.05',
+        'RECIPE_BASE_URL': icook.url,
+        'RECIPE_DB_PATH': os.path.join(workdir, 'icook.db'),
+        'PLACES_BASE_URL': places.url,
+        'PLACE_API_KEY': 'AIza-loadtest',
+        'GEMINI_BACKEND': 'stub',
+        'GEMINI_STUB_LATENCY': str(args.gemini_latency),
+        'PUBLIC_BASE_URL': 'http://127.0.0.1',
+        'DATABASE_URL': f"sqlite:///{os.path.join(workdir, 'loadtest.db')}",
+    })
+    return line, [line, icook, places], workdir
+
+
+def start_app(workdir, users):
+    """在背景執行緒啟動 app（DATABASE_URL 已指向暫存資料庫），回傳 (app 模組, 網址)"""
+    from werkzeug.serving import make_server, WSGIRequestHandler
+
+    os.chdir(workdir)  # 圖表與庫存圖片寫到暫存目錄的 tmp/
+    import app as app_module
+    from models import db, User, init_db
+
+    app = app_module.app
+    with app.app_context():
+        init_db()
+        app_module.shelf_life_index.load_from_db()
+        db.session.add_all(User(name=f'user{i}', line_id=user_id(i), esp32_id=DEVICE_ID) for i in range(users))
+        db.session.commit()
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass  # 每個請求一行的存取紀錄會蓋過結果
+
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, name='loadtest-app', daemon=True).start()
+    return app_module, f"http://127.0.0.1:{server.server_port}"
+
+
+def user_id(i):
+    return f"U{i:032x}"
+
+
+def sign(body):
+    digest = hmac.new(CHANNEL_SECRET.encode('utf-8'), body.encode('utf-8'), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode('utf-8')
+
+
+def webhook_body(token, user, message):
+    event = {'type': 'message', 'replyToken': token, 'source': {'type': 'user', 'userId': user},
+             'timestamp': int(time.time() * 1000), 'mode': 'active', 'message': message}
+    return json.dumps({'destination': 'loadtest', 'events': [event]}, ensure_ascii=False)
+
+
+def message_for(scenario, i):
+    if scenario in TEXT_SCENARIOS:
+        return {'type': 'text', 'id': str(i), 'text': TEXT_SCENARIOS[scenario](i)}
+    if scenario == 'image':
+        return {'type': 'image', 'id': str(100000 + i), 'contentProvider': {'type': 'line'}}
+    # 使用者集中在幾個地點附近
+    lat, lng = random.choice([(25.0330, 121.5654), (25.0478, 121.5170), (24.9968, 121.5416)])
+    return {'type': 'location', 'id': str(i), 'title': 'pin', 'address': '台北市',
+            'latitude': lat + random.gauss(0, 0.003), 'longitude': lng + random.gauss(0, 0.003)}
+
+
+def run(requests_count, concurrency, send):
+    """以 concurrency 個執行緒送出 requests_count 個請求，send(i) 回傳延遲秒數或 None（失敗），回傳 (延遲列表, 失敗數, 總秒數)"""
+    latencies, errors = [], 0
+    lock = threading.Lock()
+
+    def task(i):
+        nonlocal errors
+        try:
+            latency = send(i)
+        except Exception:
+            latency = None
+        with lock:
+            if latency is None:
+                errors += 1
+            else:
+                latencies.append(latency)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(task, range(requests_count)))
+    return latencies, errors, time.perf_counter() - start
+
+
+def summarize(latencies, errors, elapsed):
+    values = np.array(latencies) * 1000 if latencies else np.array([np.nan])
+    return {
+        'requests': len(latencies) + errors,
+        'errors': errors,
+        'p50_ms': round(float(np.percentile(values, 50)), 2),
+        'p99_ms': round(float(np.percentile(values, 99)), 2),
+        'rps': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+    }
+
+
+def scenario_post_data(session, url, args):
+    def send(i):
+        readings = {'temperature': round(random.uniform(2, 9), 1), 'humidity': round(random.uniform(60, 85), 1),
+                    'esp32_id': DEVICE_ID}
+        start = time.perf_counter()
+        response = session.post(f"{url}/post_data", json=readings, timeout=10)
+        return time.perf_counter() - start if response.status_code == 200 else None
+    return run(args.requests, args.concurrency, send)
+
+
+def scenario_webhook_ack(session, url, args):
+    """只量測 webhook 驗證簽章並排入佇列的時間；事件用處理快的指令，避免佇列滿了回 503"""
+    def send(i):
+        body = webhook_body(f"ack-{i}-{time.time()}", user_id(i % args.users), message_for('冰箱現況', i))
+        start = time.perf_counter()
+        response = session.post(f"{url}/webhook", data=body.encode('utf-8'),
+                                headers={'Content-Type': 'application/json', 'X-Line-Signature': sign(body)}, timeout=10)
+        return time.perf_counter() - start if response.status_code == 200 else None
+    return run(args.requests, args.concurrency, send)
+
+
+def scenario_event(name, session, url, args, line):
+    """送出 webhook 並等待假 LINE 伺服器收到回覆，量測端到端延遲"""
+    def send(i):
+        token = f"{name}-{i}-{time.time()}"
+        body = webhook_body(token, user_id(i % args.users), message_for(name, i))
+        start = time.perf_counter()
+        response = session.post(f"{url}/webhook", data=body.encode('utf-8'),
+                                headers={'Content-Type': 'application/json', 'X-Line-Signature': sign(body)}, timeout=10)
+        if response.status_code != 200:
+            return None
+        deadline = start + args.reply_timeout
+        while time.perf_counter() < deadline:
+            replied = line.replies.pop(token, None)
+            if replied is not None:
+                return replied - start
+            time.sleep(0.002)
+        return None
+    return run(args.requests, args.concurrency, send)
+
+
+def compare(results, baseline, tolerance, slack_ms):
+    """回傳退步的項目說明；p99 要同時超過比例與 slack_ms 毫秒才算，避免短時間量測的雜訊造成誤報"""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if result['p99_ms'] > max(base['p99_ms'] * (1 + tolerance), base['p99_ms'] + slack_ms):
+            regressions.append(f"{name}: p99 {base['p99_ms']}ms → {result['p99_ms']}ms")
+        if result['rps'] < base['rps'] * (1 - tolerance):
+            regressions.append(f"{name}: 吞吐量 {base['rps']} → {result['rps']} req/s")
+        if result['errors'] > base['errors']:
+            regressions.append(f"{name}: 失敗 {base['errors']} → {result['errors']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='離線負載測試')
+    parser.add_argument('scenarios', nargs='*', help=f"預設執行全部：{' '.join(SCENARIOS)}")
+    parser.add_argument('--requests', type=int, default=300, help='每個情境的請求數')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--line-latency', type=float, default=0.02)
+    parser.add_argument('--icook-latency', type=float, default=0.15)
+    parser.add_argument('--places-latency', type=float, default=0.08)
+    parser.add_argument('--gemini-latency', type=float, default=0.5)
+    parser.add_argument('--reply-timeout', type=float, default=30)
+    parser.add_argument('--baseline', default=os.path.join(ROOT, BASELINE_PATH))
+    parser.add_argument('--save', action='store_true', help='把結果寫入基準線檔案')
+    parser.add_argument('--compare', action='store_true', help='與基準線比較')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='允許的退步比例')
+    parser.add_argument('--slack-ms', type=float, default=100, help='p99 至少要慢這麼多毫秒才算退步')
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"未知的情境：{' '.join(sorted(unknown))}")
+    random.seed(0)
+
+    os.chdir(ROOT)
+    line, servers, workdir = start_fakes(args)
+    app_module, url = start_app(workdir, args.users)
+    session = requests.Session()
+    session.mount('http://', HTTPAdapter(pool_maxsize=args.concurrency))
+
+    results = {}
+    print(f"{'情境':<12} {'請求':>6} {'失敗':>5} {'p50':>10} {'p99':>10} {'req/s':>9}")
+    for name in args.scenarios or SCENARIOS:
+        if name == 'post_data':
+            measured = scenario_post_data(session, url, args)
+        elif name == 'webhook_ack':
+            measured = scenario_webhook_ack(session, url, args)
+            while app_module.event_dispatcher.depth():  # 等背景處理完，不影響下一個情境
+                time.sleep(0.05)
+        else:
+            measured = scenario_event(name, session, url, args, line)
+        results[name] = summary = summarize(*measured)
+        print(f"{name:<12} {summary['requests']:>6} {summary['errors']:>5} {summary['p50_ms']:>8.1f}ms "
+              f"{summary['p99_ms']:>8.1f}ms {summary['rps']:>9.1f}")
+
+    for server in servers:
+        server.stop()
+
+    if args.save:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({'settings': {key: value for key, value in vars(args).items()
+                                    if key not in ('scenarios', 'baseline', 'save', 'compare', 'tolerance', 'slack_ms')},
+                       'results': results}, f, ensure_ascii=False, indent=2)
+        print(f"已儲存基準線：{args.baseline}")
+    if args.compare:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance, args.slack_ms)
+        for regression in regressions:
+            print(f"退步：{regression}")
+        if regressions:
+            sys.exit(1)
+        print("與基準線相比沒有明顯退步")
+
+
+if __name__ == "__main__":
+    main()
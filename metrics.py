@@ -0,0 +1,262 @@
+# metrics.py - 行程內的效能指標（Prometheus 文字格式）與可在執行中開關的取樣分析器
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter as TallyCounter
+from contextlib import contextmanager
+from dotenv import load_dotenv
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+load_dotenv()
+
+PROFILER_INTERVAL = float(os.getenv('PROFILER_INTERVAL', 0.01))  # 取樣間隔秒數
+PROFILER_MAX_SECONDS = float(os.getenv('PROFILER_MAX_SECONDS', 300))  # 忘記關閉時自動停止
+PROFILER_TOKEN = os.getenv('PROFILER_TOKEN')  # 未設定時不開放 /debug/profiler
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Metric:
+    def __init__(self, name, help, labelnames=(), kind='untyped'):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.kind = kind
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    """只會增加的計數"""
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames, 'counter')
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return self.header() + [f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in values]
+
+
+class Histogram(Metric):
+    """延遲分布，依固定的上限分桶"""
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames, 'histogram')
+        self.buckets = tuple(buckets)
+        self._values = {}  # labels -> [各桶次數..., +Inf 次數, 總和]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            entry[index] += 1
+            entry[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        with self._lock:
+            entry = self._values.get(self._key(labels))
+            return sum(entry[:-1]) if entry else 0
+
+    def render(self):
+        with self._lock:
+            values = sorted((key, list(entry)) for key, entry in self._values.items())
+        lines = self.header()
+        for key, entry in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), entry[:-1]):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, ('le', bound))} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {entry[-1]}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Gauge(Metric):
+    """抓取時才呼叫 func 讀取目前的值，func 回傳數字或 {標籤值 tuple: 數字}"""
+
+    def __init__(self, name, help, func, labelnames=()):
+        super().__init__(name, help, labelnames, 'gauge')
+        self.func = func
+
+    def render(self):
+        try:
+            values = self.func()
+        except Exception as e:
+            print(f"讀取指標 {self.name} 時出錯：{e}")
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return self.header() + [f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+                                for key, value in sorted(values.items())]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics[metric.name] = metric  # 同名時以後註冊的為準，方便重新載入模組
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def gauge(self, name, help, func, labelnames=()):
+        return self.register(Gauge(name, help, func, labelnames))
+
+    def render(self):
+        """Prometheus 文字格式，每個 worker 行程各自統計"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+command_seconds = registry.histogram('fridge_command_seconds', 'LINE 指令的處理時間', ['command'])
+command_errors = registry.counter('fridge_command_errors_total', 'LINE 指令處理失敗次數', ['command'])
+dependency_seconds = registry.histogram('fridge_dependency_seconds', '外部相依服務每次呼叫的時間', ['dependency'])
+dependency_errors = registry.counter('fridge_dependency_errors_total', '外部相依服務呼叫失敗次數', ['dependency'])
+webhook_requests = registry.counter('fridge_webhook_requests_total', 'webhook 請求數', ['status'])
+food_recognitions = registry.counter('fridge_food_recognitions_total', '圖片辨識結果的解析方式（json、text、empty）', ['result'])
+
+
+@contextmanager
+def track(dependency):
+    """量測一次外部呼叫，例外時計入錯誤並重新丟出"""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        dependency_errors.inc(dependency=dependency)
+        raise
+    finally:
+        dependency_seconds.observe(time.perf_counter() - start, dependency=dependency)
+
+
+# 所有 SQLAlchemy 引擎的查詢時間
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    dependency_seconds.observe(time.perf_counter() - conn.info['query_start'].pop(), dependency='db')
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+    dependency_errors.inc(dependency='db')
+    starts = context.connection.info.get('query_start') if context.connection is not None else None
+    if starts:
+        starts.pop()
+
+
+class SamplingProfiler:
+    """定時擷取所有執行緒的呼叫堆疊，輸出 flamegraph 可用的 collapsed 格式；只在開啟期間有額外成本"""
+
+    def __init__(self, interval=PROFILER_INTERVAL, max_seconds=PROFILER_MAX_SECONDS):
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.samples = TallyCounter()
+        self.started_at = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        with self._lock:
+            if self.running:
+                return False
+            self.samples.clear()
+            self.started_at = time.time()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self.collapsed()
+
+    def collapsed(self):
+        """每行為「外層;...;內層 次數」"""
+        with self._lock:
+            samples = self.samples.most_common()
+        return ''.join(f"{stack} {count}\n" for stack, count in samples)
+
+    def _run(self):
+        me = threading.get_ident()
+        deadline = time.monotonic() + self.max_seconds
+        while not self._stop.wait(self.interval) and time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stacks.append(';'.join(reversed(stack)))
+            with self._lock:
+                self.samples.update(stacks)
+
+
+profiler = SamplingProfiler()
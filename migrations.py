@@ -0,0 +1,148 @@
+# migrations.py - 資料庫結構的版本化遷移，讓既有的部署也能補上新的索引與限制
+# 用法: python migrations.py          套用尚未執行的遷移
+#       python migrations.py --check  以 EXPLAIN QUERY PLAN 確認熱門查詢都有用到索引（SQLite）
+# 遷移只使用 SQLAlchemy 產生的 DDL 與各資料庫都支援的 SQL，SQLite、MySQL、PostgreSQL 都可以執行
+import sys
+from datetime import datetime
+from sqlalchemy import Column, DateTime, Index, Integer, MetaData, String, Table, func, inspect, select, text
+
+MIGRATIONS = []  # (版本, 說明, 函式)
+
+schema_version = Table(
+    'schema_version', MetaData(),
+    Column('version', Integer, primary_key=True, autoincrement=False),
+    Column('description', String(200)),
+    Column('applied_at', DateTime),
+)
+
+
+def migration(version, description):
+    """註冊一個遷移，版本號必須遞增"""
+    def register(func):
+        MIGRATIONS.append((version, description, func))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return func
+    return register
+
+
+def ensure_index(conn, table, name, columns, unique=False):
+    """索引不存在時才建立；MySQL 沒有 CREATE INDEX IF NOT EXISTS，改以 inspector 檢查"""
+    if name in {index['name'] for index in inspect(conn).get_indexes(table)}:
+        return
+    reflected = Table(table, MetaData(), autoload_with=conn)
+    Index(name, *(reflected.c[column] for column in columns), unique=unique).create(conn)
+
+
+@migration(1, '熱門查詢的複合索引與 food(user_id, name) 唯一限制')
+def add_hot_query_indexes(conn):
+    # 建立唯一索引前先合併重複的食品，數量加總到最早的那一筆
+    # 逐組更新：MySQL 不允許 UPDATE/DELETE 的子查詢讀取同一張表
+    duplicates = conn.execute(text(
+        "SELECT user_id, name, MIN(id), SUM(quantity) FROM food GROUP BY user_id, name HAVING COUNT(*) > 1")).all()
+    for user_id, name, keep_id, quantity in duplicates:
+        conn.execute(text("UPDATE food SET quantity = :quantity WHERE id = :id"), {'quantity': quantity, 'id': keep_id})
+        conn.execute(text("DELETE FROM food WHERE user_id = :user_id AND name = :name AND id <> :id"),
+                     {'user_id': user_id, 'name': name, 'id': keep_id})
+    ensure_index(conn, 'food', 'ux_food_user_name', ['user_id', 'name'], unique=True)
+    ensure_index(conn, 'food', 'ix_food_user_expiration', ['user_id', 'expiration_date'])
+    ensure_index(conn, 'sensor_data', 'ix_sensor_data_esp32_timestamp', ['esp32_id', 'timestamp'])
+    ensure_index(conn, 'food_expiration', 'ix_food_expiration_food_name', ['food_name'])
+
+
+@migration(2, '到期提醒：food.reminded_at 與 expiration_date 索引')
+def add_expiry_reminders(conn):
+    if 'reminded_at' not in {column['name'] for column in inspect(conn).get_columns('food')}:
+        # 型別依資料庫產生，PostgreSQL 沒有 DATETIME
+        conn.execute(text(f"ALTER TABLE food ADD COLUMN reminded_at {DateTime().compile(dialect=conn.dialect)}"))
+    ensure_index(conn, 'food', 'ix_food_expiration_date', ['expiration_date'])
+
+
+@migration(3, '感應器彙總表回填與 sensor_data(timestamp) 索引')
+def add_sensor_rollups(conn):
+    from sensor_history import backfill_rollups
+
+    # sensor_rollup 表由 create_all 建立，這裡只需補上既有讀數的彙總
+    if conn.execute(text("SELECT COUNT(*) FROM sensor_rollup")).scalar() == 0:
+        backfill_rollups(conn)
+    ensure_index(conn, 'sensor_data', 'ix_sensor_data_timestamp', ['timestamp'])
+
+
+def current_version(engine):
+    with engine.begin() as conn:
+        schema_version.create(conn, checkfirst=True)
+        return conn.execute(select(func.max(schema_version.c.version))).scalar() or 0
+
+
+def upgrade(engine):
+    """依序套用尚未執行的遷移，每個遷移在自己的交易中完成，回傳套用的版本列表
+    MySQL 的 DDL 不在交易內，中途失敗時已建立的索引會留下，所以每個遷移都要能重複執行"""
+    applied = []
+    version = current_version(engine)
+    for target, description, func in MIGRATIONS:
+        if target <= version:
+            continue
+        with engine.begin() as conn:
+            func(conn)
+            conn.execute(schema_version.insert().values(
+                version=target, description=description, applied_at=datetime.utcnow()))
+        print(f"已套用資料庫遷移 {target}: {description}")
+        applied.append(target)
+    return applied
+
+
+def hot_queries():
+    """熱門查詢，以 (名稱, 查詢) 列出；由 app 實際使用的函式產生，查詢改變時檢查也會跟著改變"""
+    from food_service import user_foods_query, foods_query, expiring_foods_query
+    from models import SensorData, SensorRollup, device_query
+    from reminders import expiry_reminders
+    from sensor_buffer import latest_reading_query
+    from sensor_history import (raw_history_query, rollup_history_query, expired_ids, raw_expired,
+                                minute_rollups_expired)
+    from users import user_query
+
+    now = datetime.utcnow()
+    return [
+        ('add_foods/remove_foods 現有食品', user_foods_query(1, ['蘋果', '香蕉'])),
+        ('get_foods', foods_query(1)),
+        ('get_expiring_food', expiring_foods_query(1, now)),
+        ('冰箱現況 最新讀數', latest_reading_query('123456')),
+        ('冰箱現況 感應器', device_query('123456')),
+        ('handle_event 使用者', user_query('U123')),
+        ('sensor_history 原始讀數', raw_history_query('123456', now, now)),
+        ('sensor_history 彙總', rollup_history_query('123456', 60, now, now)),
+        ('到期提醒 視窗', expiry_reminders.window_query(now, now)),
+        ('到期提醒 新增的食品', expiry_reminders.new_foods_query(0)),
+        ('保留期限 原始讀數', expired_ids(SensorData, raw_expired(now))),
+        ('保留期限 每分鐘彙總', expired_ids(SensorRollup, minute_rollups_expired(now))),
+    ]
+
+
+def explain(engine, query):
+    """回傳 SQLite EXPLAIN QUERY PLAN 的說明文字列表，query 可以是 Query 或 select()"""
+    statement = getattr(query, 'statement', query)
+    sql = str(statement.compile(dialect=engine.dialect, compile_kwargs={'literal_binds': True}))
+    with engine.connect() as conn:
+        return [row[-1] for row in conn.execute(text(f"EXPLAIN QUERY PLAN {sql}"))]
+
+
+def check_query_plans(engine):
+    """確認每個熱門查詢都使用索引、不需要額外排序，回傳有問題的查詢與其查詢計畫"""
+    problems = []
+    for name, query in hot_queries():
+        plan = explain(engine, query)
+        if any(step.startswith('SCAN') or 'TEMP B-TREE' in step for step in plan):
+            problems.append((name, plan))
+    return problems
+
+
+if __name__ == "__main__":
+    from app import app
+    from models import db, init_db
+
+    with app.app_context():
+        if '--check' in sys.argv:
+            problems = check_query_plans(db.engine)
+            for name, plan in problems:
+                print(f"{name} 沒有使用索引：{plan}")
+            sys.exit(1 if problems else 0)
+        init_db()
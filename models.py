@@ -14,6 +14,9 @@ class User(db.Model):
 # 食品保质期模型
 class FoodExpiration(db.Model):
     __tablename__ = 'food_expiration'
+    __table_args__ = (
+        db.Index('ix_food_expiration_food_name', 'food_name'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     food_name = db.Column(db.String(100), nullable=False)
     shelf_life_days = db.Column(db.Integer, nullable=False)
@@ -21,6 +24,11 @@ class FoodExpiration(db.Model):
 # 食品模型
 class Food(db.Model):
     __tablename__ = 'food'
+    __table_args__ = (
+        db.Index('ux_food_user_name', 'user_id', 'name', unique=True),  # 每位使用者的同一種食品只有一筆
+        db.Index('ix_food_user_expiration', 'user_id', 'expiration_date'),
+        db.Index('ix_food_expiration_date', 'expiration_date'),  # 到期提醒依時間載入
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     quantity = db.Column(db.Integer, nullable=False)
@@ -28,6 +36,7 @@ class Food(db.Model):
     expiration_date = db.Column(db.DateTime, nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     expiration_id = db.Column(db.Integer, db.ForeignKey('food_expiration.id'), nullable=True)
+    reminded_at = db.Column(db.DateTime, nullable=True)  # 已發送到期提醒的時間
 
     def set_expiration_date(self):
         if self.expiration_id is not None:
@@ -37,12 +46,46 @@ class Food(db.Model):
 
 class SensorData(db.Model):
     __tablename__ = 'sensor_data'
+    __table_args__ = (
+        db.Index('ix_sensor_data_esp32_timestamp', 'esp32_id', 'timestamp'),
+        db.Index('ix_sensor_data_timestamp', 'timestamp'),  # 保留期限依時間刪除
+    )
     id = db.Column(db.Integer, primary_key=True)
     temperature = db.Column(db.Float, nullable=False)
     humidity = db.Column(db.Float, nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     esp32_id = db.Column(db.String(50), db.ForeignKey('esp32_device.esp32_id'), nullable=False)
 
+# 感應器讀數的每分鐘、每小時彙總，寫入讀數時同步累加
+class SensorRollup(db.Model):
+    __tablename__ = 'sensor_rollup'
+    __table_args__ = (
+        db.Index('ux_sensor_rollup_bucket', 'esp32_id', 'resolution', 'bucket', unique=True),
+        db.Index('ix_sensor_rollup_resolution_bucket', 'resolution', 'bucket'),  # 保留期限依時間刪除
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    esp32_id = db.Column(db.String(50), nullable=False)
+    resolution = db.Column(db.Integer, nullable=False)  # 彙總的秒數：60 或 3600
+    bucket = db.Column(db.Integer, nullable=False)  # 區間開始的 UTC epoch 秒數
+    count = db.Column(db.Integer, nullable=False)
+    temperature_min = db.Column(db.Float, nullable=False)
+    temperature_max = db.Column(db.Float, nullable=False)
+    temperature_sum = db.Column(db.Float, nullable=False)
+    humidity_min = db.Column(db.Float, nullable=False)
+    humidity_max = db.Column(db.Float, nullable=False)
+    humidity_sum = db.Column(db.Float, nullable=False)
+
+# 已送出的感應器警告，多個 worker 以此確認同一則警告只通知一次
+class SensorAlert(db.Model):
+    __tablename__ = 'sensor_alert'
+    __table_args__ = (
+        db.Index('ux_sensor_alert_device_kind', 'esp32_id', 'kind', unique=True),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    esp32_id = db.Column(db.String(50), nullable=False)
+    kind = db.Column(db.String(20), nullable=False)
+    sent_at = db.Column(db.DateTime, nullable=False)
+
 class ESP32Device(db.Model):
     __tablename__ = 'esp32_device'
     id = db.Column(db.Integer, primary_key=True)
@@ -51,8 +94,14 @@ class ESP32Device(db.Model):
     sensor_data = db.relationship('SensorData', backref='device', lazy=True)
 
 
+def device_query(esp32_id):
+    return ESP32Device.query.filter_by(esp32_id=esp32_id)
+
+
 def init_db():
+    from migrations import upgrade
     db.create_all()
+    upgrade(db.engine)  # 舊的資料庫補上新的索引等結構變更
     if FoodExpiration.query.first() is None:  # 检查表格是否已有数据
         foods = [
             {'food_name': '香蕉', 'shelf_life_days': 9},
@@ -0,0 +1,105 @@
+# places.py - 附近餐廳查詢：以 geohash 格子快取 Google Places 結果，同一區域的使用者共用一次 API 呼叫
+import os
+import threading
+from dotenv import load_dotenv
+from cache import TTLCache, _MISSING
+from lazy import lazy
+from metrics import track
+
+load_dotenv()
+
+PLACE_API_KEY = os.getenv('PLACE_API_KEY')
+PLACES_BASE_URL = os.getenv('PLACES_BASE_URL', 'https://maps.googleapis.com')  # 負載測試時指向 fake_services 的假 Places
+PLACES_RADIUS = int(os.getenv('PLACES_RADIUS', 1000))  # 搜尋半徑（公尺）
+PLACES_GEOHASH_PRECISION = int(os.getenv('PLACES_GEOHASH_PRECISION', 6))  # 6 碼約 1.2 x 0.6 公里
+PLACES_CACHE_SIZE = int(os.getenv('PLACES_CACHE_SIZE', 5000))
+PLACES_CACHE_TTL = float(os.getenv('PLACES_CACHE_TTL', 6 * 3600))
+PLACES_LIMIT = 10  # 輪播最多顯示幾間
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+PLACE_FIELDS = ('name', 'vicinity', 'geometry', 'photos')  # 組成輪播需要的欄位
+
+
+def geohash_cell(lat, lng, precision=PLACES_GEOHASH_PRECISION):
+    """回傳 (geohash, 格子中心的緯度, 經度)"""
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars, bits, value, even = [], 0, 0, True
+    while len(chars) < precision:
+        interval, coordinate = (lng_range, lng) if even else (lat_range, lat)
+        middle = (interval[0] + interval[1]) / 2
+        value <<= 1
+        if coordinate >= middle:
+            value |= 1
+            interval[0] = middle
+        else:
+            interval[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(BASE32[value])
+            bits, value = 0, 0
+    return ''.join(chars), (lat_range[0] + lat_range[1]) / 2, (lng_range[0] + lng_range[1]) / 2
+
+
+def _create_client():
+    # 第一次查詢時才匯入並建立，沒有設定 PLACE_API_KEY 時也不會影響啟動
+    import googlemaps
+    return googlemaps.Client(key=PLACE_API_KEY, base_url=PLACES_BASE_URL)
+
+
+maps_client = lazy.register('googlemaps', _create_client)
+
+
+class PlacesCache:
+    """同一個 geohash 格子內的查詢都以格子中心搜尋，結果快取 ttl 秒；同一格子同時的查詢只呼叫一次 API"""
+
+    def __init__(self, client=None, precision=PLACES_GEOHASH_PRECISION, radius=PLACES_RADIUS,
+                 maxsize=PLACES_CACHE_SIZE, ttl=PLACES_CACHE_TTL):
+        self.client = client or maps_client
+        self.precision = precision
+        self.radius = radius
+        self.api_calls = 0
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._inflight = {}  # geohash -> 查詢中的鎖
+        self._lock = threading.Lock()
+
+    def nearby_restaurants(self, lat, lng):
+        """回傳附近餐廳的列表（只保留輪播需要的欄位），API 失敗時丟出例外且不快取"""
+        cell, center_lat, center_lng = geohash_cell(lat, lng, self.precision)
+        places = self._cache.get(cell)
+        if places is not None:
+            return places
+
+        with self._lock:
+            lock = self._inflight.setdefault(cell, threading.Lock())
+        try:
+            with lock:
+                places = self._cache._get(cell)  # 等待期間其他執行緒可能已經查好，不重複計入命中統計
+                if places is _MISSING:
+                    with self._lock:
+                        self.api_calls += 1
+                    with track('places'):
+                        result = self.client.places_nearby(location=(center_lat, center_lng), radius=self.radius,
+                                                           type='restaurant')
+                    places = [{field: place[field] for field in PLACE_FIELDS if field in place}
+                              for place in result.get('results', [])[:PLACES_LIMIT]]
+                    self._cache.set(cell, places)
+        finally:
+            with self._lock:
+                self._inflight.pop(cell, None)
+        return places
+
+    def stats(self):
+        """快取命中率與省下的 API 呼叫數"""
+        cache = self._cache.stats()
+        lookups = cache['hits'] + cache['misses']
+        return {
+            'cells': cache['size'],
+            'lookups': lookups,
+            'api_calls': self.api_calls,
+            'saved_calls': lookups - self.api_calls,
+            'hit_rate': (lookups - self.api_calls) / lookups if lookups else 0.0,
+        }
+
+
+places_cache = PlacesCache()
@@ -0,0 +1,168 @@
+# reminders.py - 食品到期提醒：以優先佇列記錄即將到期的時間點，只處理到期的項目
+import heapq
+import os
+import threading
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+from sqlalchemy import func
+from models import db, Food, User
+
+load_dotenv()
+
+REMINDER_LEAD_HOURS = float(os.getenv('REMINDER_LEAD_HOURS', 24))  # 到期前多久提醒，與「查詢即期品」的一天一致
+REMINDER_INTERVAL = int(os.getenv('REMINDER_INTERVAL', 60))  # 排程檢查的秒數
+REMINDER_WINDOW_HOURS = float(os.getenv('REMINDER_WINDOW_HOURS', 6))  # 每次從資料庫預先載入多久之內的提醒
+REMINDER_RETRY_SECONDS = float(os.getenv('REMINDER_RETRY_SECONDS', 600))  # 推播失敗後多久再試
+# 自動編號不一定依提交順序出現（例如 MySQL），查詢新增的食品時多看最後幾個 id，重複的項目會被去除
+REMINDER_ID_OVERLAP = 100
+
+
+def format_expiring(food):
+    """即期品的顯示格式，日期格式為 YYYY/MM/DD HH:MM"""
+    return f"{food.name}, 剩餘數量：{food.quantity} \n到期時間：{food.expiration_date.strftime('%Y/%m/%d %H:%M')}"
+
+
+class ExpiryReminder:
+    """以 (提醒時間, user_id) 的最小堆積記錄接下來要提醒的使用者
+
+    只有提醒時間落在目前視窗內的項目會放進記憶體，視窗往前推進時才以 expiration_date 索引載入下一段。
+    同一個行程新增食品時由 food_service 直接加入；其他行程（沒有執行排程的 webhook worker）新增的食品，
+    每次檢查以主鍵查詢上次之後新增的列，所以每次檢查的成本只與新增及到期的項目有關，與視窗大小無關。每次檢查只處理到期的使用者，並以 Food.reminded_at 標記已提醒的食品，多個 worker 同時執行也不會
+    重複通知；推播失敗時取消標記，REMINDER_RETRY_SECONDS 後再試。刪除的食品不需要另外處理，到期時查不到就不會通知。"""
+
+    def __init__(self, lead=timedelta(hours=REMINDER_LEAD_HOURS), window=timedelta(hours=REMINDER_WINDOW_HOURS),
+                 retry=timedelta(seconds=REMINDER_RETRY_SECONDS), notify=None):
+        self.lead = lead
+        self.window = window
+        self.retry = retry
+        self.notify = notify  # 接收 {line_id: 訊息文字} 的函式，回傳推播失敗的 line_id
+        self._heap = []
+        self._scheduled = set()  # 堆積中的 (提醒時間, user_id)，重新查詢時不重複加入
+        self._retry_at = {}  # user_id -> 推播失敗後最早重試的時間
+        self._loaded_until = None  # 已載入到哪個提醒時間
+        self._last_id = None  # 已看過的最大 Food.id
+        self._lock = threading.Lock()
+
+    def _push(self, remind_at, user_id):
+        # 需持有 self._lock
+        if (remind_at, user_id) not in self._scheduled:
+            self._scheduled.add((remind_at, user_id))
+            heapq.heappush(self._heap, (remind_at, user_id))
+
+    def schedule(self, user_id, expiration_date):
+        """新增食品後呼叫，提醒時間在已載入的視窗內才需要放進堆積"""
+        remind_at = expiration_date - self.lead
+        with self._lock:
+            if self._loaded_until is not None and remind_at <= self._loaded_until:
+                self._push(remind_at, user_id)
+
+    def pending(self):
+        with self._lock:
+            return len(self._heap)
+
+    def window_query(self, start, end):
+        """提醒時間在 (start, end] 之間、尚未提醒的食品；start 為 None 時從 now 開始"""
+        return db.session.query(Food.user_id, Food.expiration_date).filter(
+            Food.reminded_at.is_(None),
+            Food.expiration_date > start + self.lead,
+            Food.expiration_date <= end + self.lead,
+        )
+
+    def new_foods_query(self, after_id):
+        """id 大於 after_id 的食品，其他行程新增的食品由此取得"""
+        return db.session.query(Food.id, Food.user_id, Food.expiration_date, Food.reminded_at).filter(
+            Food.id > after_id - REMINDER_ID_OVERLAP)
+
+    def _extend_window(self, now):
+        # 視窗用掉一半時才載入提醒時間在 (已載入位置, now + window] 之間的食品
+        if self._last_id is None:
+            self._last_id = db.session.query(func.max(Food.id)).scalar() or 0
+        start = self._loaded_until
+        end = now + self.window
+        if start is not None and start >= now + self.window / 2:
+            return
+        rows = self.window_query(start if start is not None else now - self.lead, end).all()
+        with self._lock:
+            for user_id, expiration_date in rows:
+                self._add(user_id, expiration_date)
+            self._loaded_until = end
+
+    def _load_new(self, now):
+        # 其他行程新增、提醒時間落在已載入視窗內的食品；視窗之後的會在視窗推進時載入
+        rows = self.new_foods_query(self._last_id).all()
+        with self._lock:
+            for food_id, user_id, expiration_date, reminded_at in rows:
+                self._last_id = max(self._last_id, food_id)
+                if reminded_at is None and now <= expiration_date <= self._loaded_until + self.lead:
+                    self._add(user_id, expiration_date)
+
+    def _add(self, user_id, expiration_date):
+        # 需持有 self._lock；推播失敗過的使用者等到重試時間
+        remind_at = expiration_date - self.lead
+        retry_at = self._retry_at.get(user_id)
+        self._push(remind_at if retry_at is None else max(remind_at, retry_at), user_id)
+
+    def tick(self, now=None):
+        """排程呼叫：通知所有已到提醒時間的使用者，回傳通知的人數"""
+        now = now or datetime.now()
+        self._extend_window(now)
+        self._load_new(now)
+
+        due_users = set()
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                entry = heapq.heappop(self._heap)
+                self._scheduled.discard(entry)
+                due_users.add(entry[1])
+            for user_id in due_users:
+                self._retry_at.pop(user_id, None)
+        if not due_users:
+            return 0
+
+        # 先找出要提醒的食品，再逐筆標記；其他 worker 已標記的會更新 0 列，只有這次標記到的食品會被通知
+        # 以 id 讀回而不是比對 reminded_at，MySQL 的 DATETIME 只存到秒，與標記時的時間不會相等
+        candidates = [food_id for food_id, in db.session.query(Food.id).filter(
+            Food.user_id.in_(due_users),
+            Food.reminded_at.is_(None),
+            Food.expiration_date >= now,
+            Food.expiration_date <= now + self.lead,
+        )]
+        stamp = now.replace(microsecond=0)
+        claimed = [food_id for food_id in candidates if Food.query.filter(
+            Food.id == food_id, Food.reminded_at.is_(None),
+        ).update({Food.reminded_at: stamp}, synchronize_session=False)]
+        db.session.commit()
+        if not claimed:
+            return 0
+        rows = db.session.query(Food, User.line_id).join(User, User.id == Food.user_id).filter(
+            Food.id.in_(claimed),
+        ).order_by(Food.expiration_date).all()
+
+        grouped, food_ids = {}, {}
+        for food, line_id in rows:
+            grouped.setdefault(line_id, []).append(format_expiring(food))
+            food_ids.setdefault(line_id, (food.user_id, []))[1].append(food.id)
+        messages = {line_id: "即將到期的食物: \n" + "\n".join(lines) for line_id, lines in grouped.items()}
+        if not messages or not self.notify:
+            return len(messages)
+        try:
+            failed = self.notify(messages) or []
+        except Exception:
+            self._unmark([food_ids[line_id] for line_id in messages], now)
+            raise
+        if failed:
+            self._unmark([food_ids[line_id] for line_id in failed], now)
+        return len(messages) - len(failed)
+
+    def _unmark(self, users, now):
+        # 推播失敗的食品取消標記，稍後重試；users 為 (user_id, 食品 id 列表)
+        ids = [food_id for _, user_food_ids in users for food_id in user_food_ids]
+        Food.query.filter(Food.id.in_(ids)).update({Food.reminded_at: None}, synchronize_session=False)
+        db.session.commit()
+        with self._lock:
+            for user_id, _ in users:
+                self._retry_at[user_id] = now + self.retry
+                self._push(now + self.retry, user_id)
+
+
+expiry_reminders = ExpiryReminder()
@@ -0,0 +1,214 @@
+# sensor_buffer.py - 感應器資料的寫入緩衝區，累積多台 ESP32 的讀數後批次寫入資料庫
+import math
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+from sqlalchemy.exc import DataError, IntegrityError
+from models import db, SensorData
+from cache import LatestReadingCache
+from sensor_monitor import sensor_monitor, SENSOR_ALERT_INTERVAL
+from sensor_history import upsert_rollups, parse_time
+
+load_dotenv()
+
+SENSOR_BATCH_SIZE = int(os.getenv('SENSOR_BATCH_SIZE', 500))  # 累積多少筆就寫入
+SENSOR_FLUSH_INTERVAL = float(os.getenv('SENSOR_FLUSH_INTERVAL', 1.0))  # 最久多少秒寫入一次
+SENSOR_CACHE_SIZE = int(os.getenv('SENSOR_CACHE_SIZE', 10000))  # 最多快取幾台裝置
+SENSOR_CACHE_TTL = float(os.getenv('SENSOR_CACHE_TTL', 60))  # 多 worker 時，其他行程的讀數最晚多久後可見
+SENSOR_MAX_PENDING = int(os.getenv('SENSOR_MAX_PENDING', 50000))  # 資料庫無法寫入時最多暫存幾筆，超過時丟棄最舊的
+SENSOR_DEAD_LETTER_SIZE = int(os.getenv('SENSOR_DEAD_LETTER_SIZE', 1000))  # 保留最近幾筆寫入被拒絕的讀數
+SENSOR_MAX_CLOCK_SKEW = float(os.getenv('SENSOR_MAX_CLOCK_SKEW', 300))  # 讀數自帶的時間最多可以比伺服器快幾秒
+
+# 讀數違反資料庫限制（例如未登記的裝置），重試也不會成功
+BAD_DATA_ERRORS = (IntegrityError, DataError)
+
+# 每台 ESP32 最新的讀數，寫入路徑負責更新，冰箱現況直接從這裡讀取
+latest_readings = LatestReadingCache(maxsize=SENSOR_CACHE_SIZE, ttl=SENSOR_CACHE_TTL)
+
+
+def parse_readings(data):
+    """將 /post_data 收到的 JSON（單筆物件或陣列）轉成讀數列表，格式錯誤時丟出 ValueError
+    每筆可以帶 timestamp（ISO 8601 或 epoch 秒數），沒有時使用收到的時間"""
+    items = data if isinstance(data, list) else [data]
+    now = datetime.utcnow()
+    readings = []
+    for item in items:
+        if not isinstance(item, dict):
+            raise ValueError("每筆資料必須是 JSON 物件")
+        try:
+            reading = {
+                'temperature': float(item['temperature']),
+                'humidity': float(item['humidity']),
+                'esp32_id': str(item['esp32_id']),
+            }
+        except (KeyError, TypeError, ValueError):
+            raise ValueError("每筆資料都需要 temperature、humidity 與 esp32_id")
+        if not (math.isfinite(reading['temperature']) and math.isfinite(reading['humidity'])):
+            raise ValueError("temperature 與 humidity 必須是有限的數字")
+        timestamp = item.get('timestamp')
+        if timestamp is None:
+            reading['timestamp'] = now
+        else:
+            reading['timestamp'] = parse_time(timestamp)
+            if reading['timestamp'] > now + timedelta(seconds=SENSOR_MAX_CLOCK_SKEW):
+                raise ValueError("timestamp 不能是未來的時間")
+        readings.append(reading)
+    return readings
+
+
+def latest_reading_query(esp32_id):
+    return SensorData.query.filter_by(esp32_id=esp32_id).order_by(SensorData.timestamp.desc()).limit(1)
+
+
+def load_latest_reading(esp32_id):
+    """快取未命中時從資料庫讀取最新一筆讀數並放回快取"""
+    sensor_data = latest_reading_query(esp32_id).first()
+    if sensor_data is None:
+        return None
+    reading = {
+        'temperature': sensor_data.temperature,
+        'humidity': sensor_data.humidity,
+        'esp32_id': sensor_data.esp32_id,
+        'timestamp': sensor_data.timestamp,
+    }
+    latest_readings.update([reading])
+    return reading
+
+
+class SensorBuffer:
+    """把讀數暫存在記憶體，達到筆數或時間門檻時以一次交易批次寫入"""
+
+    def __init__(self, app, batch_size=SENSOR_BATCH_SIZE, flush_interval=SENSOR_FLUSH_INTERVAL,
+                 max_pending=SENSOR_MAX_PENDING):
+        self.app = app
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.rejected = 0  # 違反資料庫限制而放棄的讀數
+        self.dropped = 0  # 資料庫無法寫入、暫存超過上限而丟棄的讀數
+        self.dead_letters = deque(maxlen=SENSOR_DEAD_LETTER_SIZE)  # (讀數, 錯誤訊息)
+        self._pending = []
+        self._lock = threading.Lock()  # 保護 _pending
+        self._flush_lock = threading.Lock()  # 同一時間只允許一個批次寫入
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._thread = None
+        self._last_dispatch = time.monotonic()
+
+    def add(self, readings):
+        """加入讀數，由背景執行緒負責寫入"""
+        latest_readings.update(readings)
+        sensor_monitor.observe(readings)
+        if self._closed:
+            # 關閉後收到的讀數直接寫入，避免遺失
+            self._write(readings)
+            return
+        with self._lock:
+            self._pending.extend(readings)
+            full = len(self._pending) >= self.batch_size
+        self._ensure_started()
+        if full:
+            self._wakeup.set()
+
+    def pending(self):
+        """目前尚未寫入的筆數"""
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self):
+        """立即把緩衝區內的讀數寫入資料庫，回傳寫入筆數"""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return 0
+            try:
+                self._write(batch)
+            except BAD_DATA_ERRORS:
+                # 有讀數違反限制，逐筆寫入把它找出來，其他裝置的讀數照常寫入
+                return self._write_each(batch)
+            except Exception:
+                self._requeue(batch)
+                raise
+            return len(batch)
+
+    def _write_each(self, batch):
+        written = 0
+        for i, reading in enumerate(batch):
+            try:
+                self._write([reading])
+            except BAD_DATA_ERRORS as e:
+                with self._lock:
+                    self.rejected += 1
+                    self.dead_letters.append((reading, str(e.orig)))
+                print(f"放棄無法寫入的感應器讀數 {reading.get('esp32_id')}：{e.orig}")
+            except Exception:
+                self._requeue(batch[i:])
+                raise
+            else:
+                written += 1
+        return written
+
+    def _requeue(self, batch):
+        # 資料庫暫時無法寫入（例如被鎖住），放回緩衝區前端下次再試；超過上限時丟棄最舊的讀數
+        with self._lock:
+            self._pending[:0] = batch
+            overflow = len(self._pending) - self.max_pending
+            if overflow > 0:
+                del self._pending[:overflow]
+                self.dropped += overflow
+
+    def close(self):
+        """停止背景執行緒並寫入剩餘的讀數"""
+        self._closed = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_interval + 5)
+        self.flush()
+
+    def _ensure_started(self):
+        # gunicorn 會在 fork 之後才處理請求，因此背景執行緒在第一次收到資料時才啟動
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='sensor-buffer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while not self._closed:
+            deadline = time.monotonic() + self.flush_interval
+            while not self._closed and self.pending() < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._wakeup.wait(remaining)
+                self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"寫入感應器資料時出錯：{e}")
+            if time.monotonic() - self._last_dispatch >= SENSOR_ALERT_INTERVAL:
+                self._last_dispatch = time.monotonic()
+                self._dispatch_alerts()
+
+    def _dispatch_alerts(self):
+        # 異常警告與斷線偵測由寫入執行緒順便處理，不佔用請求
+        with self.app.app_context():
+            try:
+                sensor_monitor.dispatch()
+            except Exception as e:
+                print(f"發送感應器警告時出錯：{e}")
+
+    def _write(self, batch):
+        with self.app.app_context():
+            try:
+                db.session.execute(SensorData.__table__.insert(), batch)
+                upsert_rollups(db.session, batch)  # 彙總與讀數同一個交易，重試時不會重複累加
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
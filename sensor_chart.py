@@ -0,0 +1,153 @@
+# sensor_chart.py - 冰箱溫溼度歷史圖表：一次查詢載入 NumPy 陣列、向量化重新取樣，圖片依裝置與時間範圍快取
+import hashlib
+import hmac
+import itertools
+import os
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+from datetime import datetime, timedelta
+from sqlalchemy import select
+from cache import TTLCache
+from lazy import lazy
+from models import db, SensorRollup
+from sensor_history import choose_resolution, to_epoch, SENSOR_API_SECRET
+from sensor_monitor import TEMPERATURE_LIMIT, HUMIDITY_LIMIT
+from table_renderer import table_renderer, RENDER_DIR, mpl_figure, mpl_agg
+
+load_dotenv()
+
+CHART_POINTS = int(os.getenv('CHART_POINTS', 240))  # 圖上最多幾個時間點
+CHART_DAYS = (1, 7, 30, 90, 365)  # 可查詢的範圍（天），LINE 指令與 API 共用，每台裝置的圖片數量才有上限
+CHART_CACHE_SIZE = int(os.getenv('CHART_CACHE_SIZE', 1000))
+CHART_CACHE_TTL = float(os.getenv('CHART_CACHE_TTL', 60))  # 最新的區間仍在累積資料，多久後重畫
+CHART_UTC_OFFSET = float(os.getenv('CHART_UTC_OFFSET', 8))  # 圖上顯示的時區，讀數以 UTC 儲存
+
+# 只負責 /post_data 的 worker 用不到，第一次產生圖表時才匯入
+np = lazy.module('numpy')
+mpl_dates = lazy.module('matplotlib.dates')
+
+COLUMNS = ('bucket', 'count', 'temperature_min', 'temperature_max', 'temperature_sum',
+           'humidity_min', 'humidity_max', 'humidity_sum')
+
+
+def load_series(esp32_id, start_epoch, end_epoch, resolution):
+    """以一次查詢把 [start, end) 的彙總載入成 (筆數, len(COLUMNS)) 的 float64 陣列，依時間排序"""
+    c = SensorRollup.__table__.c
+    stmt = select(*(c[name] for name in COLUMNS)).where(
+        c.esp32_id == esp32_id,
+        c.resolution == resolution,
+        c.bucket >= start_epoch,
+        c.bucket < end_epoch,
+    ).order_by(c.bucket)
+    rows = db.session.execute(stmt).all()
+    # 直接由查詢結果填入陣列，不逐列建立 Python 物件
+    return np.fromiter(itertools.chain.from_iterable(rows), dtype=np.float64,
+                       count=len(rows) * len(COLUMNS)).reshape(-1, len(COLUMNS))
+
+
+def resample(data, start_epoch, step, points):
+    """把彙總列合併成 points 個長度為 step 秒的區間，沒有資料的區間為 NaN，回傳欄位名稱 -> 陣列"""
+    index = ((data[:, 0] - start_epoch) // step).astype(np.int64)
+    count = np.bincount(index, weights=data[:, 1], minlength=points)
+    series = {'time': (start_epoch + np.arange(points) * step + CHART_UTC_OFFSET * 3600).astype('datetime64[s]'),
+              'count': count}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        series['temperature_mean'] = np.bincount(index, weights=data[:, 4], minlength=points) / count
+        series['humidity_mean'] = np.bincount(index, weights=data[:, 7], minlength=points) / count
+
+    # 資料已依時間排序，同一區間的列是連續的一段，以 reduceat 一次算出每段的最小、最大值
+    starts = np.flatnonzero(np.r_[True, index[1:] != index[:-1]]) if len(index) else index
+    for name, column, reduce in (('temperature_min', 2, np.minimum), ('temperature_max', 3, np.maximum),
+                                 ('humidity_min', 5, np.minimum), ('humidity_max', 6, np.maximum)):
+        values = np.full(points, np.nan)
+        if len(index):
+            values[index[starts]] = reduce.reduceat(data[:, column], starts)
+        series[name] = values
+    return series
+
+
+def chart_window(hours, now=None):
+    """依查詢範圍決定 (彙總解析度, 區間秒數, 開始, 結束, 點數)，結束時間對齊區間，短時間內的請求會得到同一張圖"""
+    now = now or datetime.utcnow()
+    span = int(hours * 3600)
+    resolution = choose_resolution(now - timedelta(seconds=span), now) or 60  # 圖表至少以分鐘為單位
+    step = resolution * max(1, -(-span // (CHART_POINTS * resolution)))
+    end_epoch = -(-to_epoch(now) // step) * step
+    points = -(-span // step)
+    return resolution, step, end_epoch - points * step, end_epoch, points
+
+
+def chart_days(days):
+    """回傳涵蓋 days 天的最短固定範圍，超過時使用最長的範圍"""
+    return next((n for n in CHART_DAYS if n >= days), CHART_DAYS[-1])
+
+
+class SensorChartRenderer:
+    """每個 (裝置, 範圍, 解析度) 只保留最新的一張圖，快取時間內的請求直接使用已產生的圖片"""
+
+    def __init__(self, output_dir=RENDER_DIR, maxsize=CHART_CACHE_SIZE, ttl=CHART_CACHE_TTL):
+        self.output_dir = output_dir
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)  # 鍵 -> 檔名
+        self._latest = OrderedDict()  # 鍵 -> 最新的檔名，用來刪除舊圖，超過 maxsize 時連同圖片一起淘汰
+        self._maxsize = maxsize
+        self._lock = threading.Lock()
+
+    def render(self, esp32_id, days, now=None):
+        """回傳裝置近 days 天（需為 CHART_DAYS 之一）的圖片檔名，範圍內沒有資料時回傳 None，需在 app context 中呼叫"""
+        if days not in CHART_DAYS:
+            raise ValueError(f"不支援的範圍：{days} 天")
+        resolution, step, start_epoch, end_epoch, points = chart_window(days * 24, now)
+        key = (esp32_id, days)
+        # 圖片放在公開的 /tmp 下，檔名以密鑰簽出，無法由裝置 ID 與時間推算
+        digest = hmac.new(SENSOR_API_SECRET.encode('utf-8'), repr((esp32_id, step, start_epoch, end_epoch)).encode('utf-8'),
+                          hashlib.sha256).hexdigest()[:32]
+        filename = f"chart_{digest}.png"
+        path = os.path.join(self.output_dir, filename)
+        if self._cache.get(key) == filename and os.path.exists(path):
+            return filename
+
+        data = load_series(esp32_id, start_epoch, end_epoch, resolution)
+        if not len(data):
+            return None
+        series = resample(data, start_epoch, step, points)
+        title = f"{esp32_id}  近 {days} 天"
+        table_renderer.run(self._draw, series, title, path)
+
+        self._cache.set(key, filename)
+        with self._lock:
+            stale = [self._latest.pop(key, None)]
+            self._latest[key] = filename
+            while len(self._latest) > self._maxsize:
+                stale.append(self._latest.popitem(last=False)[1])
+        for previous in stale:
+            if previous and previous != filename:
+                try:
+                    os.remove(os.path.join(self.output_dir, previous))
+                except OSError:
+                    pass
+        return filename
+
+    def _draw(self, series, title, path):
+        # 在 table_renderer 的繪圖執行緒中執行
+        table_renderer.ensure_font()
+        fig = mpl_figure.Figure(figsize=(10, 6))
+        mpl_agg.FigureCanvasAgg(fig)
+        ax_temp, ax_hum = fig.subplots(2, 1, sharex=True)
+        time = series['time']
+        for ax, name, limit, color, label in ((ax_temp, 'temperature', TEMPERATURE_LIMIT, '#d32f2f', '溫度 (°C)'),
+                                              (ax_hum, 'humidity', HUMIDITY_LIMIT, '#1976d2', '濕度 (%)')):
+            ax.fill_between(time, series[f'{name}_min'], series[f'{name}_max'], color=color, alpha=0.2, linewidth=0)
+            ax.plot(time, series[f'{name}_mean'], color=color, linewidth=1.5)
+            ax.axhline(limit, color=color, linestyle='--', linewidth=0.8)  # 冰箱現況的警告門檻
+            ax.set_ylabel(label)
+            ax.grid(True, alpha=0.3)
+        locator = mpl_dates.AutoDateLocator()
+        ax_hum.xaxis.set_major_locator(locator)
+        ax_hum.xaxis.set_major_formatter(mpl_dates.ConciseDateFormatter(locator))
+        fig.suptitle(title)
+        fig.tight_layout()
+        table_renderer.save(fig, path)
+
+
+sensor_chart = SensorChartRenderer()
@@ -0,0 +1,277 @@
+# sensor_history.py - 感應器讀數的分鐘/小時彙總、原始資料保留期限與歷史查詢
+import hashlib
+import hmac
+import math
+import os
+from datetime import datetime, timedelta, timezone
+from dotenv import load_dotenv
+from sqlalchemy import func, select
+from models import db, SensorData, SensorRollup
+
+load_dotenv()
+
+ROLLUP_RESOLUTIONS = (60, 3600)  # 每分鐘、每小時
+SENSOR_RAW_RETENTION_DAYS = float(os.getenv('SENSOR_RAW_RETENTION_DAYS', 7))  # 原始讀數保留天數，0 表示不刪除
+SENSOR_MINUTE_RETENTION_DAYS = float(os.getenv('SENSOR_MINUTE_RETENTION_DAYS', 90))  # 每分鐘彙總保留天數，每小時彙總永久保留
+SENSOR_RETENTION_INTERVAL = int(os.getenv('SENSOR_RETENTION_INTERVAL', 3600))  # 排程清理的秒數
+SENSOR_RETENTION_CHUNK = int(os.getenv('SENSOR_RETENTION_CHUNK', 5000))  # 每個交易最多刪除幾筆，避免長時間鎖住資料庫
+SENSOR_HISTORY_RAW_SECONDS = float(os.getenv('SENSOR_HISTORY_RAW_SECONDS', 3600))  # 查詢範圍在此之內才回傳原始讀數
+SENSOR_HISTORY_MAX_POINTS = int(os.getenv('SENSOR_HISTORY_MAX_POINTS', 1500))  # 彙總查詢最多回傳的點數
+SENSOR_HISTORY_MAX_HOURS = float(os.getenv('SENSOR_HISTORY_MAX_HOURS', 24 * 365))  # 一次可查詢的最長範圍
+# 簽出每台裝置查詢金鑰的密鑰，未設定時沿用 LINE_CHANNEL_SECRET
+SENSOR_API_SECRET = os.getenv('SENSOR_API_SECRET') or os.getenv('LINE_CHANNEL_SECRET', '')
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def to_epoch(ts):
+    """讀數時間為不含時區的 UTC"""
+    return int((ts - EPOCH).total_seconds())
+
+
+def from_epoch(seconds):
+    return EPOCH + timedelta(seconds=seconds)
+
+
+def device_token(esp32_id):
+    """裝置的查詢金鑰，由 SENSOR_API_SECRET 簽出，不需要另外儲存；使用者設定感應器時由機器人告知"""
+    return hmac.new(SENSOR_API_SECRET.encode(), str(esp32_id).encode(), hashlib.sha256).hexdigest()[:32]
+
+
+def verify_device_token(esp32_id, token):
+    return bool(SENSOR_API_SECRET and token) and hmac.compare_digest(device_token(esp32_id), str(token))
+
+
+def parse_time(value):
+    """把 ISO 8601 字串或 epoch 秒數轉成不含時區的 UTC；帶時區的時間先換算成 UTC，格式錯誤時丟出 ValueError"""
+    if isinstance(value, bool):
+        raise ValueError("時間格式錯誤")
+    try:
+        if isinstance(value, (int, float)):
+            if not math.isfinite(value):
+                raise ValueError("時間格式錯誤")
+            return from_epoch(value)
+        text = str(value).strip()
+        if text.endswith(('Z', 'z')):
+            text = text[:-1] + '+00:00'
+        ts = datetime.fromisoformat(text)
+    except (OverflowError, ValueError):
+        raise ValueError("時間必須是 ISO 8601 或 epoch 秒數")
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+    return ts
+
+
+def rollup_rows(readings):
+    """把一批讀數依 (裝置, 解析度, 區間) 先在記憶體中合併，回傳要累加的列"""
+    rows = {}
+    for reading in readings:
+        epoch = to_epoch(reading['timestamp'])
+        temperature, humidity = reading['temperature'], reading['humidity']
+        for resolution in ROLLUP_RESOLUTIONS:
+            key = (reading['esp32_id'], resolution, epoch - epoch % resolution)
+            row = rows.get(key)
+            if row is None:
+                rows[key] = {
+                    'esp32_id': key[0], 'resolution': resolution, 'bucket': key[2], 'count': 1,
+                    'temperature_min': temperature, 'temperature_max': temperature, 'temperature_sum': temperature,
+                    'humidity_min': humidity, 'humidity_max': humidity, 'humidity_sum': humidity,
+                }
+                continue
+            row['count'] += 1
+            row['temperature_min'] = min(row['temperature_min'], temperature)
+            row['temperature_max'] = max(row['temperature_max'], temperature)
+            row['temperature_sum'] += temperature
+            row['humidity_min'] = min(row['humidity_min'], humidity)
+            row['humidity_max'] = max(row['humidity_max'], humidity)
+            row['humidity_sum'] += humidity
+    return list(rows.values())
+
+
+def _rollup_updates(table, new, least, greatest):
+    # 已有的列加上這批的筆數與總和，最小、最大值取兩者之一；每個欄位只引用自己，MySQL 依序賦值也不受影響
+    return {
+        'count': table.c.count + new.count,
+        'temperature_min': least(table.c.temperature_min, new.temperature_min),
+        'temperature_max': greatest(table.c.temperature_max, new.temperature_max),
+        'temperature_sum': table.c.temperature_sum + new.temperature_sum,
+        'humidity_min': least(table.c.humidity_min, new.humidity_min),
+        'humidity_max': greatest(table.c.humidity_max, new.humidity_max),
+        'humidity_sum': table.c.humidity_sum + new.humidity_sum,
+    }
+
+
+def _upsert_statement(dialect):
+    table = SensorRollup.__table__
+    if dialect in ('mysql', 'mariadb'):
+        from sqlalchemy.dialects.mysql import insert
+        stmt = insert(table)
+        # ux_sensor_rollup_bucket 唯一索引衝突時累加，多個 worker 同時寫入同一個區間也不會少算
+        return stmt.on_duplicate_key_update(_rollup_updates(table, stmt.inserted, func.least, func.greatest))
+    if dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+        least, greatest = func.min, func.max  # SQLite 的多參數 min/max 是純量函式
+    elif dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        least, greatest = func.least, func.greatest
+    else:
+        return None
+    stmt = insert(table)
+    return stmt.on_conflict_do_update(
+        index_elements=['esp32_id', 'resolution', 'bucket'],
+        set_=_rollup_updates(table, stmt.excluded, least, greatest),
+    )
+
+
+def upsert_rollups(conn, readings):
+    """把讀數累加到彙總表，conn 可以是 session 或 Connection，與寫入讀數在同一個交易中呼叫，回傳更新的列數"""
+    rows = rollup_rows(readings)
+    if not rows:
+        return 0
+    if not hasattr(conn, 'dialect'):
+        conn = conn.connection()  # session 取得目前交易的連線
+    stmt = _upsert_statement(conn.dialect.name)
+    if stmt is not None:
+        conn.execute(stmt, rows)
+        return len(rows)
+
+    # 其他資料庫：先更新，沒有對應的列才新增
+    table = SensorRollup.__table__
+    c = table.c
+    for row in rows:
+        key = (c.esp32_id == row['esp32_id']) & (c.resolution == row['resolution']) & (c.bucket == row['bucket'])
+        existing = conn.execute(select(table).where(key)).first()
+        if existing is None:
+            conn.execute(table.insert(), row)
+            continue
+        conn.execute(table.update().where(key).values(
+            count=existing.count + row['count'],
+            temperature_min=min(existing.temperature_min, row['temperature_min']),
+            temperature_max=max(existing.temperature_max, row['temperature_max']),
+            temperature_sum=existing.temperature_sum + row['temperature_sum'],
+            humidity_min=min(existing.humidity_min, row['humidity_min']),
+            humidity_max=max(existing.humidity_max, row['humidity_max']),
+            humidity_sum=existing.humidity_sum + row['humidity_sum'],
+        ))
+    return len(rows)
+
+
+def backfill_rollups(conn, chunk=SENSOR_RETENTION_CHUNK * 10):
+    """由現有的原始讀數重建彙總表，依 id 分段讀取，不必一次載入整張表"""
+    table = SensorData.__table__
+    columns = [table.c.id, table.c.esp32_id, table.c.timestamp, table.c.temperature, table.c.humidity]
+    last_id, total = 0, 0
+    while True:
+        rows = conn.execute(select(*columns).where(table.c.id > last_id).order_by(table.c.id).limit(chunk)).all()
+        if not rows:
+            return total
+        readings = [dict(row._mapping) for row in rows if row.timestamp is not None]
+        upsert_rollups(conn, readings)
+        last_id, total = rows[-1].id, total + len(rows)
+
+
+def expired_ids(model, condition, chunk=SENSOR_RETENTION_CHUNK):
+    """下一段要刪除的 id"""
+    return select(model.id).where(condition).limit(chunk)
+
+
+def raw_expired(now, days=SENSOR_RAW_RETENTION_DAYS):
+    return SensorData.timestamp < now - timedelta(days=days)
+
+
+def minute_rollups_expired(now, days=SENSOR_MINUTE_RETENTION_DAYS):
+    return (SensorRollup.resolution == 60) & (SensorRollup.bucket < to_epoch(now - timedelta(days=days)))
+
+
+def _delete_in_chunks(model, condition, chunk):
+    # 每次刪除一段並提交，讓寫入讀數的交易不必等太久
+    # 先讀出 id 再依列表刪除：MySQL 不允許 IN 子查詢使用 LIMIT，也不允許子查詢讀取正在刪除的表
+    deleted = 0
+    while True:
+        ids = db.session.execute(expired_ids(model, condition, chunk)).scalars().all()
+        if ids:
+            deleted += model.query.filter(model.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        if len(ids) < chunk:
+            return deleted
+
+
+def prune_sensor_data(now=None, raw_days=SENSOR_RAW_RETENTION_DAYS, minute_days=SENSOR_MINUTE_RETENTION_DAYS,
+                      chunk=SENSOR_RETENTION_CHUNK):
+    """排程呼叫：刪除超過保留期限的原始讀數與每分鐘彙總，需在 app context 中呼叫，回傳 (讀數, 彙總) 刪除筆數"""
+    now = now or datetime.utcnow()
+    raw = minute = 0
+    if raw_days > 0:
+        raw = _delete_in_chunks(SensorData, raw_expired(now, raw_days), chunk)
+    if minute_days > 0:
+        minute = _delete_in_chunks(SensorRollup, minute_rollups_expired(now, minute_days), chunk)
+    if raw or minute:
+        print(f"已清除過期的感應器資料：原始讀數 {raw} 筆、每分鐘彙總 {minute} 筆")
+    return raw, minute
+
+
+def choose_resolution(start, end, now=None, max_points=SENSOR_HISTORY_MAX_POINTS):
+    """選出能涵蓋查詢範圍、點數又不超過上限的解析度，0 表示原始讀數"""
+    now = now or datetime.utcnow()
+    span = (end - start).total_seconds()
+    if span <= SENSOR_HISTORY_RAW_SECONDS and (
+            SENSOR_RAW_RETENTION_DAYS <= 0 or start >= now - timedelta(days=SENSOR_RAW_RETENTION_DAYS)):
+        return 0
+    if span / 60 <= max_points and (
+            SENSOR_MINUTE_RETENTION_DAYS <= 0 or start >= now - timedelta(days=SENSOR_MINUTE_RETENTION_DAYS)):
+        return 60
+    return 3600
+
+
+def max_span(resolution):
+    """明確指定解析度時可查詢的最長秒數，與自動選擇的規則相同：原始讀數到 SENSOR_HISTORY_RAW_SECONDS，
+    每分鐘彙總最多 SENSOR_HISTORY_MAX_POINTS 點，最粗的每小時彙總到 SENSOR_HISTORY_MAX_HOURS"""
+    if resolution == 0:
+        return SENSOR_HISTORY_RAW_SECONDS
+    if resolution == ROLLUP_RESOLUTIONS[-1]:
+        return max(resolution * SENSOR_HISTORY_MAX_POINTS, SENSOR_HISTORY_MAX_HOURS * 3600)
+    return resolution * SENSOR_HISTORY_MAX_POINTS
+
+
+def raw_history_query(esp32_id, start, end):
+    return db.session.query(SensorData.timestamp, SensorData.temperature, SensorData.humidity).filter(
+        SensorData.esp32_id == esp32_id,
+        SensorData.timestamp >= start,
+        SensorData.timestamp < end,
+    ).order_by(SensorData.timestamp)
+
+
+def rollup_history_query(esp32_id, resolution, start, end):
+    """涵蓋 [start, end) 的彙總列，第一個區間從 start 所在的區間開始"""
+    first = to_epoch(start)
+    return SensorRollup.query.filter(
+        SensorRollup.esp32_id == esp32_id,
+        SensorRollup.resolution == resolution,
+        SensorRollup.bucket >= first - first % resolution,
+        SensorRollup.bucket < to_epoch(end),
+    ).order_by(SensorRollup.bucket)
+
+
+def get_history(esp32_id, start, end, resolution=None):
+    """查詢裝置在 [start, end) 的歷史，需在 app context 中呼叫
+
+    回傳 (解析度, 點列表)，每個點包含時間、筆數與溫溼度的最小、最大、平均值"""
+    if resolution is None:
+        resolution = choose_resolution(start, end)
+
+    if resolution == 0:
+        rows = raw_history_query(esp32_id, start, end).all()
+        return 0, [{
+            'timestamp': ts, 'count': 1,
+            'temperature_min': t, 'temperature_max': t, 'temperature_mean': t,
+            'humidity_min': h, 'humidity_max': h, 'humidity_mean': h,
+        } for ts, t, h in rows]
+
+    rows = rollup_history_query(esp32_id, resolution, start, end).all()
+    return resolution, [{
+        'timestamp': from_epoch(row.bucket), 'count': row.count,
+        'temperature_min': row.temperature_min, 'temperature_max': row.temperature_max,
+        'temperature_mean': row.temperature_sum / row.count,
+        'humidity_min': row.humidity_min, 'humidity_max': row.humidity_max,
+        'humidity_mean': row.humidity_sum / row.count,
+    } for row in rows]
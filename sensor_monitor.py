@@ -0,0 +1,223 @@
+# sensor_monitor.py - 即時監測感應器讀數，冰箱溫溼度異常或感應器斷線時主動通知使用者
+import os
+import threading
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from models import db, SensorData, SensorAlert, User
+
+load_dotenv()
+
+TEMPERATURE_LIMIT = 7  # 正常應該是 7 度以下
+HUMIDITY_LIMIT = 78  # 正常應該是 78% 以下
+SENSOR_EWMA_ALPHA = float(os.getenv('SENSOR_EWMA_ALPHA', 0.3))  # 指數移動平均的權重，越大越靈敏
+SENSOR_BREACH_SECONDS = float(os.getenv('SENSOR_BREACH_SECONDS', 300))  # 超標持續多久才警告，開關門不會誤報
+SENSOR_RISE_PER_MINUTE = float(os.getenv('SENSOR_RISE_PER_MINUTE', 1.5))  # 溫度每分鐘上升超過幾度視為異常
+SENSOR_RISE_MIN_SECONDS = float(os.getenv('SENSOR_RISE_MIN_SECONDS', 30))  # 上升速度至少以多長的區間計算，同一批讀數不會誤報
+SENSOR_ALERT_COOLDOWN = float(os.getenv('SENSOR_ALERT_COOLDOWN', 1800))  # 同一種警告的最短間隔秒數
+SENSOR_SILENT_SECONDS = float(os.getenv('SENSOR_SILENT_SECONDS', 600))  # 多久沒有資料視為斷線，與冰箱現況的 10 分鐘一致
+SENSOR_ALERT_INTERVAL = float(os.getenv('SENSOR_ALERT_INTERVAL', 30))  # 多久送出一次暫存的警告
+SENSOR_ALERT_RETRIES = int(os.getenv('SENSOR_ALERT_RETRIES', 5))  # 推播失敗的警告最多重送幾次
+
+
+class DeviceState:
+    """單一裝置的監測狀態，大小固定，與讀數數量無關"""
+    __slots__ = ('ewma_temp', 'ewma_hum', 'last_ts', 'rise_ts', 'rise_temp', 'temp_since', 'hum_since',
+                 'last_alert', 'silent')
+
+    def __init__(self):
+        self.ewma_temp = None
+        self.ewma_hum = None
+        self.last_ts = None
+        self.rise_ts = None  # 計算上升速度的起點
+        self.rise_temp = None
+        self.temp_since = None  # 溫度開始超標的時間
+        self.hum_since = None
+        self.last_alert = {}  # 警告種類 -> 上次警告時間
+        self.silent = False
+
+
+class SensorMonitor:
+    """在寫入路徑上逐筆評估讀數，產生的警告先暫存，由背景執行緒批次通知裝置的使用者"""
+
+    def __init__(self, alpha=SENSOR_EWMA_ALPHA, breach_seconds=SENSOR_BREACH_SECONDS,
+                 rise_per_minute=SENSOR_RISE_PER_MINUTE, rise_min_seconds=SENSOR_RISE_MIN_SECONDS,
+                 cooldown=SENSOR_ALERT_COOLDOWN,
+                 silent_seconds=SENSOR_SILENT_SECONDS, notify=None):
+        self.alpha = alpha
+        self.breach = timedelta(seconds=breach_seconds)
+        self.rise_per_minute = rise_per_minute
+        self.rise_min = timedelta(seconds=rise_min_seconds)
+        self.cooldown = timedelta(seconds=cooldown)
+        self.silent_after = timedelta(seconds=silent_seconds)
+        self.notify = notify  # 接收 {line_id: 訊息文字} 的函式
+        self._states = {}
+        self._alerts = []  # (esp32_id, 警告種類, 警告文字, 是否套用冷卻時間, 只送給哪些 line_id, 已重送次數)
+        self._lock = threading.Lock()
+
+    def observe(self, readings):
+        """評估一批讀數，readings 的格式與 SensorBuffer 相同"""
+        with self._lock:
+            for reading in readings:
+                self._observe(reading['esp32_id'], reading['timestamp'], reading['temperature'], reading['humidity'])
+
+    def _observe(self, esp32_id, ts, temperature, humidity):
+        state = self._states.get(esp32_id)
+        if state is None:
+            state = self._states[esp32_id] = DeviceState()
+        if state.last_ts is not None and ts <= state.last_ts:
+            return  # 批次中較舊的讀數不影響狀態
+
+        if state.last_ts is not None and ts - state.last_ts > self.silent_after:
+            # 中斷太久，之前的平均值與超標時間不再代表目前狀況
+            state.ewma_temp = state.rise_ts = state.temp_since = state.hum_since = None
+        if state.ewma_temp is None:
+            state.ewma_temp, state.ewma_hum = temperature, humidity
+        else:
+            state.ewma_temp += self.alpha * (temperature - state.ewma_temp)
+            state.ewma_hum += self.alpha * (humidity - state.ewma_hum)
+        state.last_ts = ts
+
+        # 上升速度以至少 rise_min 前的平均值為起點計算，間隔太短時誤差會被放大
+        if state.rise_ts is None or ts - state.rise_ts > timedelta(minutes=5):
+            state.rise_ts, state.rise_temp = ts, state.ewma_temp
+        elif ts - state.rise_ts >= self.rise_min:
+            minutes = (ts - state.rise_ts).total_seconds() / 60
+            if (state.ewma_temp - state.rise_temp) / minutes > self.rise_per_minute:
+                self._raise(state, esp32_id, 'rise', ts,
+                            f"您的冰箱溫度正在快速上升，目前約 {state.ewma_temp:.1f} 度，請確認冰箱門是否關好。")
+            state.rise_ts, state.rise_temp = ts, state.ewma_temp
+
+        if state.silent:
+            state.silent = False
+            self._raise(state, esp32_id, 'online', ts, "感應器已恢復連線。", cooldown=False)
+
+        # 平均值持續超標一段時間才警告
+        if state.ewma_temp > TEMPERATURE_LIMIT:
+            state.temp_since = state.temp_since or ts
+            if ts - state.temp_since >= self.breach:
+                self._raise(state, esp32_id, 'temperature', ts,
+                            f"警告：您的冰箱溫度異常，正常應該是{TEMPERATURE_LIMIT}度以下，目前溫度是 {temperature} 度。")
+        else:
+            state.temp_since = None
+        if state.ewma_hum > HUMIDITY_LIMIT:
+            state.hum_since = state.hum_since or ts
+            if ts - state.hum_since >= self.breach:
+                self._raise(state, esp32_id, 'humidity', ts,
+                            f"警告：您的冰箱濕度異常，正常應該是{HUMIDITY_LIMIT}%以下，目前濕度是 {humidity}%。")
+        else:
+            state.hum_since = None
+
+    def _raise(self, state, esp32_id, kind, ts, text, cooldown=True):
+        last = state.last_alert.get(kind)
+        if cooldown and last is not None and ts - last < self.cooldown:
+            return
+        state.last_alert[kind] = ts
+        self._alerts.append((esp32_id, kind, text, cooldown, None, 0))
+
+    def _claim(self, esp32_id, kind, now, window):
+        """在資料庫登記即將送出的警告；其他 worker 在 window 內已送出同一種警告時回傳 False"""
+        table = SensorAlert.__table__
+        try:
+            updated = db.session.execute(table.update().where(
+                table.c.esp32_id == esp32_id, table.c.kind == kind, table.c.sent_at <= now - window,
+            ).values(sent_at=now)).rowcount
+            if not updated:
+                db.session.execute(table.insert().values(esp32_id=esp32_id, kind=kind, sent_at=now))
+            db.session.commit()
+            return True
+        except IntegrityError:
+            db.session.rollback()  # 已有紀錄且還在 window 內，或另一個 worker 同時新增
+            return False
+
+    def _release(self, esp32_id, kind, stamp):
+        # 推播失敗時取消登記，重送或其他 worker 的同一則警告才不會被冷卻時間擋住
+        table = SensorAlert.__table__
+        db.session.execute(table.delete().where(
+            table.c.esp32_id == esp32_id, table.c.kind == kind, table.c.sent_at == stamp))
+        db.session.commit()
+
+    def check_silent(self, now=None):
+        """標記超過門檻時間沒有資料的裝置並產生警告，需在 app context 中呼叫
+
+        多個 worker 時讀數可能送到其他行程，所以先以資料庫中的最新時間確認真的斷線"""
+        now = now or datetime.utcnow()
+        with self._lock:
+            suspects = [esp32_id for esp32_id, state in self._states.items()
+                        if not state.silent and state.last_ts is not None and now - state.last_ts > self.silent_after]
+        for esp32_id in suspects:
+            latest = db.session.query(func.max(SensorData.timestamp)).filter(SensorData.esp32_id == esp32_id).scalar()
+            with self._lock:
+                state = self._states[esp32_id]
+                if latest is not None and latest > state.last_ts:
+                    state.last_ts = latest
+                if now - state.last_ts > self.silent_after:
+                    state.silent = True
+                    self._raise(state, esp32_id, 'silent', now,
+                                "感應器數據超過10分鐘未更新，可能存在連線問題。請檢查WiFi連接狀態。", cooldown=False)
+
+    def dispatch(self, now=None):
+        """通知暫存的警告，同一位使用者的多則警告合併成一則訊息，需在 app context 中呼叫
+
+        每個 worker 各自監測收到的讀數，送出前先在 sensor_alert 表登記，同一則警告只有一個行程會通知；
+        推播失敗的警告在下次通知時重送，所有收件人都失敗時先取消登記"""
+        now = now or datetime.utcnow()
+        self.check_silent(now)
+        with self._lock:
+            alerts, self._alerts = self._alerts, []
+        if not alerts:
+            return 0
+
+        stamp = now.replace(microsecond=0)  # MySQL 的 DATETIME 只存到秒，取消登記時才比對得到
+        claimed = []
+        for alert in alerts:
+            esp32_id, kind, _, cooldown, line_ids, _ = alert
+            # 只重送給部分使用者的警告已經登記過；斷線與恢復連線沒有冷卻時間，以斷線門檻作為去重的區間
+            if line_ids is not None or self._claim(esp32_id, kind, stamp,
+                                                   self.cooldown if cooldown else self.silent_after):
+                claimed.append(alert)
+        if not claimed:
+            return 0
+
+        recipients = {}
+        for user in User.query.filter(User.esp32_id.in_({alert[0] for alert in claimed})):
+            recipients.setdefault(user.esp32_id, []).append(user.line_id)
+        messages, targets = {}, []
+        for alert in claimed:
+            line_ids = [line_id for line_id in recipients.get(alert[0], ())
+                        if alert[4] is None or line_id in alert[4]]
+            targets.append((alert, line_ids))
+            for line_id in line_ids:
+                messages.setdefault(line_id, []).append(alert[2])
+        messages = {line_id: "\n".join(texts) for line_id, texts in messages.items()}
+        if not messages or not self.notify:
+            return len(messages)
+        try:
+            failed = set(self.notify(messages) or ())
+        except Exception:
+            self._retry(targets, set(messages), stamp)
+            raise
+        self._retry(targets, failed, stamp)
+        return len(messages) - len(failed)
+
+    def _retry(self, targets, failed, stamp):
+        # 推播失敗的警告放回佇列，只重送給失敗的使用者
+        requeue = []
+        for (esp32_id, kind, text, cooldown, only, attempts), line_ids in targets:
+            missed = {line_id for line_id in line_ids if line_id in failed}
+            if not missed:
+                continue
+            if attempts >= SENSOR_ALERT_RETRIES:
+                print(f"感應器警告推播失敗 {attempts + 1} 次，放棄：{esp32_id} {kind}")
+                continue
+            if only is None and len(missed) == len(line_ids):
+                self._release(esp32_id, kind, stamp)
+                missed = None  # 重新登記後送給裝置目前的所有使用者
+            requeue.append((esp32_id, kind, text, cooldown, missed, attempts + 1))
+        if requeue:
+            with self._lock:
+                self._alerts.extend(requeue)
+
+
+sensor_monitor = SensorMonitor()
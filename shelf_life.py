@@ -0,0 +1,106 @@
+# shelf_life.py - 行程內的食品保質期索引，讓辨識出的名稱對應到最接近的已知食品
+import os
+import threading
+import time
+from collections import defaultdict
+from dotenv import load_dotenv
+from models import FoodExpiration
+
+load_dotenv()
+
+SHELF_LIFE_MIN_SIMILARITY = float(os.getenv('SHELF_LIFE_MIN_SIMILARITY', 0.5))  # n-gram 相似度門檻
+SHELF_LIFE_REFRESH = float(os.getenv('SHELF_LIFE_REFRESH', 300))  # 多久重新載入一次，納入其他 worker 的寫入
+SHELF_LIFE_DEFAULT_DAYS = 7  # 找不到保質期時的預設天數，相似度比對的結果也不會超過這個天數
+
+
+def bigrams(name):
+    """字元 2-gram，單一字元的名稱以自己為 gram"""
+    if len(name) < 2:
+        return {name}
+    return {name[i:i + 2] for i in range(len(name) - 1)}
+
+
+class ShelfLifeIndex:
+    """FoodExpiration 的記憶體索引，支援完全相符、前後綴與字元 n-gram 相似度查詢"""
+
+    def __init__(self, min_similarity=SHELF_LIFE_MIN_SIMILARITY, refresh_interval=SHELF_LIFE_REFRESH):
+        self.min_similarity = min_similarity
+        self.refresh_interval = refresh_interval
+        self._exact = {}  # 名稱 -> 保質期天數
+        self._grams = defaultdict(set)  # 2-gram -> 含有此 gram 的名稱
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def load(self, entries):
+        """以 (名稱, 天數) 列表重建索引，同名時保留第一筆"""
+        exact = {}
+        grams = defaultdict(set)
+        for name, days in entries:
+            if name in exact:
+                continue
+            exact[name] = days
+            for gram in bigrams(name):
+                grams[gram].add(name)
+        with self._lock:
+            self._exact, self._grams = exact, grams
+            self._loaded_at = time.monotonic()
+
+    def load_from_db(self):
+        """從 FoodExpiration 表載入，需在 app context 中呼叫"""
+        rows = FoodExpiration.query.with_entities(FoodExpiration.food_name, FoodExpiration.shelf_life_days) \
+            .order_by(FoodExpiration.id).all()
+        self.load(rows)
+
+    def ensure_loaded(self):
+        if self._loaded_at is None or time.monotonic() - self._loaded_at > self.refresh_interval:
+            self.load_from_db()
+
+    def invalidate(self):
+        """下次查詢時重新從資料庫載入"""
+        self._loaded_at = None
+
+    def add(self, name, days):
+        """寫入新的保質期後同步更新索引"""
+        with self._lock:
+            if name in self._exact:
+                return
+            self._exact[name] = days
+            for gram in bigrams(name):
+                self._grams[gram].add(name)
+
+    def __len__(self):
+        return len(self._exact)
+
+    def lookup(self, name):
+        """回傳 (對應到的已知名稱, 保質期天數)，找不到時回傳 None"""
+        # 重新載入會整個換掉索引，整次查詢都使用開始時的同一份
+        with self._lock:
+            exact, grams = self._exact, self._grams
+        if name in exact:
+            return name, exact[name]
+
+        # 中文食品名稱的主體通常在後面，例如「紅蘋果」→「蘋果」、「雞腿便當」→「便當」，比對最長的後綴
+        # 後綴至少兩個字，單字的已知名稱太容易誤配；不比對前綴，「雞蛋沙拉」不是「雞蛋」
+        for i in range(1, len(name) - 1):
+            if name[i:] in exact:
+                return name[i:], exact[name[i:]]
+
+        # 以 2-gram 的 Dice 係數找最相近的名稱；相近不代表同一種食品（「雞蛋糕」與「雞蛋」），天數不超過預設值
+        query = bigrams(name)
+        counts = defaultdict(int)
+        with self._lock:  # add() 會在原地加入新的名稱
+            for gram in query:
+                for candidate in grams.get(gram, ()):
+                    counts[candidate] += 1
+        best, best_score = None, self.min_similarity
+        for candidate, common in counts.items():
+            score = 2 * common / (len(query) + len(bigrams(candidate)))
+            if score >= best_score:
+                if score > best_score or best is None or len(candidate) < len(best):
+                    best, best_score = candidate, score
+        if best is None:
+            return None
+        return best, min(exact[best], SHELF_LIFE_DEFAULT_DAYS)
+
+
+shelf_life_index = ShelfLifeIndex()
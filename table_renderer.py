@@ -0,0 +1,116 @@
+# table_renderer.py - 產生冰箱庫存表格圖片，依內容雜湊命名並快取，繪圖集中在專用的執行緒
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from lazy import lazy
+from metrics import track
+
+load_dotenv()
+
+RENDER_DIR = 'tmp'  # 由 /tmp/<filename> 路由提供給 LINE 下載
+RENDER_FONT = os.getenv('RENDER_FONT', 'Microsoft JhengHei')
+RENDER_TIMEOUT = float(os.getenv('RENDER_TIMEOUT', 30))
+
+# matplotlib 在繪圖執行緒第一次畫圖時才匯入
+matplotlib = lazy.module('matplotlib')
+mpl_figure = lazy.module('matplotlib.figure')
+mpl_agg = lazy.module('matplotlib.backends.backend_agg')
+
+
+class TableRenderer:
+    """庫存表格的繪圖服務：內容沒變就直接使用已產生的圖片，每位使用者只保留最新的一張"""
+
+    def __init__(self, output_dir=RENDER_DIR, font=RENDER_FONT):
+        self.output_dir = output_dir
+        self.font = font
+        self._executor = None
+        self._pid = None
+        self._latest = {}  # user_id -> 最新的檔名
+        self._lock = threading.Lock()
+        self._font_ready = False
+
+    @property
+    def executor(self):
+        # matplotlib 不是執行緒安全的，所有繪圖都排進同一條執行緒；fork 之後重新建立
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='render')
+                self._pid = os.getpid()
+            return self._executor
+
+    def warm_up(self):
+        """在背景先設定字型並畫一張小表格，載入字型快取，第一位使用者就不必等待"""
+        return self.executor.submit(self._warm_up)
+
+    def _warm_up(self):
+        self._draw([("暖機", 1, "2024-01-01")], None)
+
+    def run(self, func, *args):
+        """在繪圖執行緒執行 func 並等待結果，其他圖表也透過這裡使用 matplotlib"""
+        with track('render'):  # 包含等待繪圖執行緒的時間
+            return self.executor.submit(func, *args).result(timeout=RENDER_TIMEOUT)
+
+    def ensure_font(self):
+        if not self._font_ready:
+            matplotlib.rc('font', family=self.font)  # 字型只需設定一次
+            self._font_ready = True
+
+    def render_inventory(self, user_id, rows):
+        """rows 為 (名稱, 數量, 有效期限) 列表，回傳圖片檔名"""
+        digest = hashlib.sha1(json.dumps([user_id, rows], ensure_ascii=False).encode('utf-8')).hexdigest()[:20]
+        filename = f"fridge_{digest}.png"
+        path = os.path.join(self.output_dir, filename)
+        if not os.path.exists(path):
+            self.run(self._draw, rows, path)
+
+        with self._lock:
+            previous = self._latest.get(user_id)
+            self._latest[user_id] = filename
+        if previous and previous != filename:
+            try:
+                os.remove(os.path.join(self.output_dir, previous))
+            except OSError:
+                pass
+        return filename
+
+    def save(self, fig, path):
+        """先寫到暫存檔再改名，其他 worker 不會讀到寫到一半的圖片"""
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        fig.savefig(tmp_path, format='png')
+        os.replace(tmp_path, path)
+
+    def _draw(self, rows, path):
+        self.ensure_font()
+        # 使用 Figure 物件而非 pyplot，圖表不會留在全域狀態裡，畫完即可回收
+        fig = mpl_figure.Figure(figsize=(10, len(rows) * 0.6 + 2))
+        mpl_agg.FigureCanvasAgg(fig)
+        ax = fig.subplots()
+        ax.axis('tight')
+        ax.axis('off')
+
+        table_data = [["名稱", "數量", "有效期限"]]
+        table_data.extend([name, quantity, date] for name, quantity, date in rows)
+
+        table = ax.table(cellText=table_data, cellLoc='center', loc='center', cellColours=[['#f5f5f5']*3]*len(table_data))
+        table.auto_set_font_size(False)
+        table.set_fontsize(16)
+        table.scale(1, 2)
+
+        for i in range(len(table_data)):
+            for j in range(3):
+                cell = table[(i, j)]
+                cell.set_edgecolor('#000000')  # 邊框顏色
+                cell.set_linewidth(0.5)  # 邊框寬度
+                cell.set_facecolor('#e0f7fa' if i == 0 else '#ffffff')  # 頭部背景色 & 行背景色
+                cell.set_text_props(weight='bold' if i == 0 else 'normal')  # 字體樣式
+
+        if path is None:
+            fig.canvas.draw()
+            return
+        self.save(fig, path)
+
+
+table_renderer = TableRenderer()
@@ -0,0 +1,58 @@
+# users.py - LINE 使用者的快取：一般訊息直接由記憶體取得使用者，不必呼叫 LINE 個人資料 API 或查詢資料庫
+import os
+from collections import namedtuple
+from dotenv import load_dotenv
+from sqlalchemy.exc import IntegrityError
+from cache import TTLCache
+from models import db, User
+
+load_dotenv()
+
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 10000))  # 最多快取幾位使用者
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', 300))  # 多 worker 時，其他行程修改的設定最晚多久後可見
+
+# 處理訊息只需要這些欄位，不保留 ORM 物件，跨請求使用也不會碰到已關閉的 session
+UserRecord = namedtuple('UserRecord', ['id', 'name', 'line_id', 'esp32_id'])
+
+user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+
+def _record(user):
+    record = UserRecord(user.id, user.name, user.line_id, user.esp32_id)
+    user_cache.set(user.line_id, record)
+    return record
+
+
+def user_query(line_id):
+    return User.query.filter_by(line_id=line_id)
+
+
+def get_user(line_id):
+    """依 LINE userId 取得使用者，快取未命中才查詢資料庫，不存在時回傳 None"""
+    record = user_cache.get(line_id)
+    if record is not None:
+        return record
+    user = user_query(line_id).first()
+    return _record(user) if user else None
+
+
+def create_user(line_id, name):
+    """第一次互動時建立使用者並回傳"""
+    user = User(name=name, line_id=line_id)
+    db.session.add(user)
+    try:
+        db.session.commit()
+        return _record(user)
+    except IntegrityError:
+        # 同一位使用者的訊息同時送到其他 worker，已經建立過了
+        db.session.rollback()
+        return get_user(line_id)
+
+
+def set_esp32_id(user, esp32_id):
+    """更新使用者的感應器 ID 並同步快取，回傳更新後的使用者"""
+    User.query.filter_by(id=user.id).update({User.esp32_id: esp32_id})
+    db.session.commit()
+    record = user._replace(esp32_id=esp32_id)
+    user_cache.set(user.line_id, record)
+    return record